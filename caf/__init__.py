@@ -1,21 +1,32 @@
 import os
-import random
-import functools
+import json
 
 import click
 
+from caf.bench import run_benchmarks
+from caf.checkpoint import CHECKPOINT_FILES, interrupted_runs
+from caf.churn import ChurnRunner, ThroughputReporter, CHAIN_FILES, \
+    DEFAULT_MIX, parse_mix
+from caf.content import CONTENT_SOURCES
+from caf.durability import DURABILITY_MODES
 from caf.generator import FileGenerator
+from caf.hashes import HASH_ALGORITHMS, DEFAULT_HASH, get_hash, read_hash
+from caf.layout import Layout, read_layout, DEFAULT_LAYOUT
+from caf.pack import STORAGE_TYPES, PACK_SIZE, read_storage
+from caf.report import REPORT_FORMATS, VerificationAborted, create_reporter
+from caf.roots import has_roots
+from caf.sampling import DEFAULT_CONFIDENCE
+from caf.shards import parse_shard
+from caf.sizes import SIZE_TYPES, PARAMETRIC_SIZES, FixedSize, UniformSize, \
+    HistogramSize
 from caf.verifier import FileVerifier
+from caf.walker import WALK_THREADS
+from caf.writer import LARGE_FILE_SIZE
+from caf.stats import Stats, StatsReporter
+from caf.throttle import Throttle, parse_ionice, set_priority
 
 __version__ = '0.1.1'
-
-
-SIZE_TYPES = {
-    'kb': 1024,
-    'mb': 1024 ** 2,
-    'gb': 1024 ** 3,
-    'tb': 1024 ** 4,
-}
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
 
 
 def current_directory(ctx, param, value):
@@ -40,26 +51,112 @@ def convert_to_bytes(ctx, param, value):
         return int(value[:-2]) * multiplier
 
 
-def identity(value):
-    return lambda: value
+def convert_to_positive_bytes(ctx, param, value):
+    size = convert_to_bytes(ctx, param, value)
+    if size is not None and size <= 0:
+        raise click.BadParameter("Must be greater than 0")
+    return size
+
+
+def convert_to_layout(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return Layout.parse(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def convert_to_fraction(ctx, param, value):
+    # Either a fraction (0.005) or a percentage (0.5%).
+    if value is None:
+        return None
+    try:
+        if value.endswith('%'):
+            fraction = float(value[:-1]) / 100
+        else:
+            fraction = float(value)
+    except ValueError:
+        raise click.BadParameter("Invalid fraction or percentage")
+    if not 0 < fraction <= 1:
+        raise click.BadParameter("Must be between 0 and 100%")
+    return fraction
+
+
+def convert_to_fill(ctx, param, value):
+    # Either a percentage of the filesystem (80%) or a size (10GB).
+    # Returns a tuple of the target usage and the target fraction.
+    if value is None:
+        return None
+    if value.endswith('%'):
+        return None, convert_to_fraction(ctx, param, value)
+    return convert_to_bytes(ctx, param, value), None
+
+
+def convert_to_duration(ctx, param, value):
+    # A number of seconds, optionally suffixed with s, m, h or d.
+    if value is None:
+        return None
+    multiplier = DURATION_UNITS.get(value[-1:].lower())
+    if multiplier is None:
+        multiplier = 1
+    else:
+        value = value[:-1]
+    try:
+        duration = float(value) * multiplier
+    except ValueError:
+        raise click.BadParameter("Invalid duration")
+    if duration <= 0:
+        raise click.BadParameter("Must be greater than 0")
+    return duration
+
+
+def convert_to_mix(ctx, param, value):
+    try:
+        return parse_mix(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def convert_to_bandwidth(ctx, param, value):
+    # A size per second, e.g. "200MB/s", where the "/s" is optional.
+    if value is None:
+        return None
+    if value.lower().endswith('/s'):
+        value = value[:-2]
+    return convert_to_bytes(ctx, param, value)
+
+
+def convert_to_ionice(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_ionice(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def convert_to_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 class FileSizeType(click.ParamType):
     # ``name`` is used by the --help output.
     name = 'filesize'
 
-    RANDOM_FUNCTION = {
-        'normal': lambda Mean, StdDev: abs(int(random.gauss(Mean, StdDev))),
-        'gamma': lambda Alpha, Beta: abs(int(random.gammavariate(Alpha, Beta))),
-        'lognormal': lambda Mean, StdDev: abs(int(random.lognormvariate(Mean, StdDev))),
-    }
-
     def convert(self, value, param, ctx):
         try:
             v = int(value)
-            return identity(v)
+            return FixedSize(v)
         except ValueError:
             pass
+        if value.lower().startswith('histogram='):
+            return self._parse_histogram(value.split('=', 1)[1], param, ctx)
         if ',' in value:
             return self._parse_shorthand(value)
         elif '-' in value:
@@ -69,9 +166,9 @@ class FileSizeType(click.ParamType):
                           'startsize-endsize (e.g. 1mb-5mb).' % value)
             start = self._parse_with_size_suffix(parts[0])
             end = self._parse_with_size_suffix(parts[1])
-            return lambda: random.randint(start, end)
+            return UniformSize(start, end)
         elif self._is_size_identifier(value):
-            return identity(self._parse_with_size_suffix(value))
+            return FixedSize(self._parse_with_size_suffix(value))
         else:
             self.fail('Unknown size specifier "%s"' % value, param, ctx)
 
@@ -96,14 +193,130 @@ class FileSizeType(click.ParamType):
             self.fail("Missing Type=<type> in file size specifier: %s" %
                       value)
         param_type = shorthand_dict.pop('Type')
-        if param_type not in self.RANDOM_FUNCTION:
+        if param_type not in PARAMETRIC_SIZES:
             self.fail("Unknown Type '%s', must be one of: %s" %
-                      (param_type, ','.join(self.RANDOM_FUNCTION)))
+                      (param_type, ','.join(PARAMETRIC_SIZES)))
         for key, value in shorthand_dict.items():
             shorthand_dict[key] = self._parse_with_size_suffix(value)
-        func = functools.partial(self.RANDOM_FUNCTION[param_type],
-                                 **shorthand_dict)
-        return func
+        return PARAMETRIC_SIZES[param_type](**shorthand_dict)
+
+    def _parse_histogram(self, filename, param, ctx):
+        try:
+            return HistogramSize.from_csv(filename)
+        except (IOError, OSError) as e:
+            self.fail('Unable to read histogram %s: %s' % (filename, e),
+                      param, ctx)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
+def stats_options(func):
+    """Add the options for reporting stats to a command."""
+    options = [
+        click.option('--progress', is_flag=True,
+                     help='Show a live progress line on stderr.'),
+        click.option('--stats-json',
+                     help='Periodically write a JSON snapshot of the '
+                     'counters, bytes and latency histograms of each phase '
+                     'to this file.'),
+        click.option('--prometheus-textfile',
+                     help='Periodically write the stats of each phase to '
+                     'this file in the Prometheus text format.'),
+        click.option('--stats-interval', default=10, type=float,
+                     help='The number of seconds between stats reports.'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def report_options(func):
+    """Add the options for reporting corruption to a command."""
+    options = [
+        click.option('--report', 'report_format', default='text',
+                     type=click.Choice(sorted(REPORT_FORMATS)),
+                     help='How corruption is reported, either as lines of '
+                     'text or as a JSON object per line.'),
+        click.option('--report-file', type=click.File('w'),
+                     help='Where corruption is reported.  Defaults to '
+                     'stderr.'),
+        click.option('--fail-fast', is_flag=True,
+                     help='Stop as soon as any corruption is found.'),
+        click.option('--max-errors', type=click.IntRange(min=1),
+                     help='Stop as soon as this many corruptions have '
+                     'been found.'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def create_corruption_reporter(report_format, report_file, fail_fast,
+                               max_errors):
+    if fail_fast and max_errors is not None:
+        raise click.UsageError('--fail-fast and --max-errors can not be '
+                               'used together')
+    if fail_fast:
+        max_errors = 1
+    return create_reporter(report_format, report_file, max_errors)
+
+
+def throttle_options(func):
+    """Add the options for limiting I/O to a command."""
+    options = [
+        click.option('--max-bandwidth', callback=convert_to_bandwidth,
+                     help='The max bytes per second read or written '
+                     'across all the workers, e.g. "200MB/s".'),
+        click.option('--max-iops', type=click.IntRange(min=1),
+                     help='The max reads or writes per second across all '
+                     'the workers.'),
+        click.option('--latency-target', type=float,
+                     help='Adapt the rate of I/O to keep the average '
+                     'latency of each read or write below this many '
+                     'milliseconds.'),
+        click.option('--ionice', callback=convert_to_ionice,
+                     help='The I/O priority to run with, one of "idle", '
+                     '"best-effort[:0-7]" or "realtime[:0-7]".'),
+        click.option('--nice', type=click.IntRange(min=0, max=19),
+                     help='The amount to lower the CPU priority by.'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def create_throttle(max_bandwidth, max_iops, latency_target, ionice, nice):
+    """Set the priority of the process, and return a ``Throttle``.
+
+    ``None`` is returned if no limits were requested.
+    """
+    try:
+        set_priority(nice=nice, ionice=ionice)
+    except OSError as e:
+        raise click.ClickException('Could not set the priority: %s' % e)
+    if max_bandwidth is None and max_iops is None and \
+            latency_target is None:
+        return None
+    if latency_target is not None:
+        latency_target /= 1000.0
+    return Throttle(max_bandwidth, max_iops, latency_target)
+
+
+def start_stats_reporter(operation, progress, stats_json,
+                         prometheus_textfile, stats_interval):
+    """Return a tuple of ``(stats, reporter)``.
+
+    Both are ``None`` if no stats were requested, so that no stats
+    are collected at all.
+    """
+    if not (progress or stats_json or prometheus_textfile):
+        return None, None
+    stats = Stats()
+    reporter = StatsReporter(stats, operation, interval=stats_interval,
+                             progress=progress, stats_json=stats_json,
+                             prometheus_textfile=prometheus_textfile)
+    reporter.start()
+    return stats, reporter
 
 
 @click.group()
@@ -125,7 +338,63 @@ def main():
               'Value is either in bytes or can be suffixed with '
               'kb, mb, gb, etc.  Suffix is case insensitive (we '
               'know what you mean).')
-def gen(directory, max_files, max_disk_usage, file_size):
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='The number of worker processes used to generate '
+              'files.  Each worker builds its own chain of files.')
+@click.option('--content-source', default='urandom',
+              type=click.Choice(CONTENT_SOURCES),
+              help='Where the random content of each file comes from.')
+@click.option('--seed', type=int,
+              help='The seed used by the "seeded" content source.')
+@click.option('--durability', default='none',
+              type=click.Choice(DURABILITY_MODES),
+              help='How generated files are synced to disk.')
+@click.option('--durability-batch-files', default=1000,
+              type=click.IntRange(min=1),
+              help='The max number of files synced by a single barrier '
+              'with --durability batch or syncfs.')
+@click.option('--durability-batch-ms', default=1000,
+              type=click.IntRange(min=0),
+              help='The max number of milliseconds between barriers '
+              'with --durability batch or syncfs.')
+@click.option('--layout', callback=convert_to_layout,
+              help='The directory layout of the generated files, e.g. '
+              '"depth=3,width=2".  Defaults to the layout already '
+              'recorded in the directory, or "depth=2,width=2".')
+@click.option('--storage', type=click.Choice(STORAGE_TYPES),
+              help='Whether to store each file on its own ("files") or '
+              'as objects in pack files ("pack").  Defaults to the '
+              'storage already used by the directory, or "files".')
+@click.option('--pack-size', default=str(PACK_SIZE),
+              callback=convert_to_bytes,
+              help='The size at which a pack file is finished and a new '
+              'one is started, with --storage pack.')
+@click.option('--hash', 'hash_name', type=click.Choice(HASH_ALGORITHMS),
+              help='The hash algorithm files are named after.  Defaults '
+              'to the algorithm already used by the directory, or '
+              '"%s".' % DEFAULT_HASH)
+@click.option('--checkpoint-files', default=CHECKPOINT_FILES,
+              type=click.IntRange(min=1),
+              help='The number of files each worker generates between '
+              'checkpoints.')
+@click.option('--resume', is_flag=True,
+              help='Continue the oldest interrupted run in the directory '
+              'from its checkpoints.')
+@click.option('--buffer-size', default='1MB', callback=convert_to_bytes,
+              help='The size of the buffer files are written with.')
+@click.option('--large-file-size', default=str(LARGE_FILE_SIZE),
+              callback=convert_to_positive_bytes,
+              help='Files of at least this size are preallocated and '
+              'written with aligned writes, with hashing on a separate '
+              'thread.')
+@throttle_options
+@stats_options
+def gen(directory, max_files, max_disk_usage, file_size, workers,
+        content_source, seed, durability, durability_batch_files,
+        durability_batch_ms, layout, storage, pack_size, hash_name,
+        checkpoint_files, resume, buffer_size, large_file_size,
+        max_bandwidth, max_iops, latency_target, ionice, nice, progress,
+        stats_json, prometheus_textfile, stats_interval):
     """Generate content addressable files.
 
     This command will generate a set of linked, content addressable files.
@@ -184,7 +453,149 @@ def gen(directory, max_files, max_disk_usage, file_size):
 
         caf gen --file-size Type=lognormal,Mean=10MB,StdDev=1MB
 
+    To match the file sizes of a real workload, sizes can be drawn from a
+    histogram in a CSV file, with rows of "size,count", or of
+    "min_size,max_size,count" for sizes spread evenly over a range:
+
+        caf gen --file-size histogram=sizes.csv
+
+    File sizes are drawn in batches, using NumPy if it's installed.
+
+    Files can be generated in parallel by specifying the number of worker
+    processes.  Each worker generates its own chain of files, and the
+    stopping conditions apply to the total across all the workers:
+
+        \b
+        caf gen --workers 8 --max-disk-usage 10GB
+
+    By default the content of each file comes from os.urandom.  When
+    generating large amounts of data, the "fast" content source is a
+    cheaper, non-cryptographic source that is still incompressible.  The
+    "seeded" content source works the same way but is reproducible, with
+    the file sizes and content determined entirely by --seed:
+
+        \b
+        caf gen --content-source fast --max-disk-usage 1TB
+        caf gen --content-source seeded --seed 42 --max-files 1000
+
+    To see how a long running generation is doing, you can show a live
+    progress line, and periodically write the time spent in each phase
+    (rng, hash, write, mkdir, commit) to a JSON file or a Prometheus
+    textfile:
+
+        \b
+        caf gen --max-disk-usage 1TB --progress --stats-json stats.json
+
+    By default generated files are never synced, so a crash can leave a
+    tree that fails verification.  With "--durability file" every file is
+    synced before it's committed, which is slow.  The "batch" and "syncfs"
+    modes instead sync files in batches of --durability-batch-files files
+    or --durability-batch-ms milliseconds, whichever comes first, with one
+    fdatasync per file or a single syncfs of the whole filesystem:
+
+        \b
+        caf gen --max-disk-usage 10GB --durability syncfs
+
+    With any durability mode, the roots are only written once all the files
+    have been synced, so a tree with roots is always crash consistent.
+
+    Each file is stored under directories named after the start of its
+    hex digest.  By default there are 2 levels of directories, each named
+    with 2 hex characters (e.g. "ab/cd/ef0123...").  For trees with a huge
+    number of files, more levels keep each directory small:
+
+        \b
+        caf gen --layout depth=3,width=2 --max-files 1000000000
+
+    The layout is recorded in the directory, and can't be changed once
+    files have been generated with it.
+
+    When generating lots of small files, the cost of creating each file
+    can be the bottleneck.  With "--storage pack", files are instead
+    appended as objects to large pack files, each with an index, so
+    generating and verifying them is limited by sequential I/O:
+
+        \b
+        caf gen --storage pack --file-size 4KB --max-disk-usage 1TB
+
+    The I/O of generating files can be limited with the same
+    --max-bandwidth, --max-iops, --latency-target, --ionice and --nice
+    options as "caf verify".
+
+    Files are named after their sha1 digest by default.  When hashing is
+    the bottleneck, blake2b (with a 32 byte digest) or sha256 may be
+    faster, depending on the CPU ("caf bench --hash" compares them):
+
+        \b
+        caf gen --hash blake2b --max-disk-usage 10GB
+
+    Like the layout, the hash algorithm is recorded in the directory and
+    can't be changed once files have been generated with it.
+
+    Files of at least --large-file-size bytes (64MB by default) have their
+    space allocated up front, and are written with --buffer-size writes
+    (rounded up to a multiple of 4KB) that are aligned in the file, while
+    a separate thread hashes them.  For multi-GB files, a bigger buffer
+    gets closer to the sequential bandwidth of the storage:
+
+        \b
+        caf gen --file-size 4GB --max-files 10 --buffer-size 8MB
+
+    Every worker checkpoints its chain as it goes.  If a run is
+    interrupted, run the same command again with --resume to continue it
+    from where it stopped.  The files it already generated count towards
+    the stopping conditions, and it uses the same number of workers as
+    before:
+
+        \b
+        caf gen --max-disk-usage 500TB --workers 16
+        caf gen --max-disk-usage 500TB --workers 16 --resume
+
     """
+    if content_source == 'seeded' and seed is None:
+        raise click.UsageError('--seed is required when using '
+                               '--content-source seeded')
+    elif content_source != 'seeded' and seed is not None:
+        raise click.UsageError('--seed can only be used with '
+                               '--content-source seeded')
+    if resume and not interrupted_runs(directory):
+        raise click.UsageError('There is no interrupted run to resume in '
+                               '%s' % directory)
+    has_files = has_roots(directory) or bool(interrupted_runs(directory))
+    existing_storage = None
+    if has_files:
+        existing_storage = read_storage(directory)
+    if storage is None:
+        storage = existing_storage or 'files'
+    elif existing_storage is not None and storage != existing_storage:
+        raise click.UsageError(
+            'The directory already uses "%s" storage, which can\'t be '
+            'changed to "%s".' % (existing_storage, storage))
+    try:
+        existing_hash = read_hash(directory)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if hash_name is None:
+        hash_algorithm = existing_hash
+    else:
+        hash_algorithm = get_hash(hash_name)
+        if has_files and hash_algorithm != existing_hash:
+            raise click.UsageError(
+                'The directory already uses the "%s" hash, which can\'t '
+                'be changed to "%s".' % (existing_hash.name, hash_name))
+    if storage == 'pack' and layout is not None:
+        raise click.UsageError('--layout can not be used with '
+                               '--storage pack')
+    existing_layout = read_layout(directory)
+    if existing_layout is None and has_files:
+        # Generated before layouts were recorded.
+        existing_layout = DEFAULT_LAYOUT
+    if layout is None:
+        layout = existing_layout or DEFAULT_LAYOUT
+    elif existing_layout is not None and layout != existing_layout:
+        raise click.UsageError(
+            'The directory already uses the layout "%s", which can\'t '
+            'be changed to "%s".' % (existing_layout, layout))
     if max_files is None and max_disk_usage is not None:
         max_files = float('inf')
     elif max_files is not None and max_disk_usage is None:
@@ -194,25 +605,493 @@ def gen(directory, max_files, max_disk_usage, file_size):
         # 100 files.
         max_files = 100
         max_disk_usage = float('inf')
-    # "file_size" is actually a no-arg function created by
+    # "file_size" is actually a caf.sizes.SizeDistribution created by
     # FileSizeType.  Is there a way in click to specify the destination?
     file_size_chooser = file_size
+    throttle = create_throttle(max_bandwidth, max_iops, latency_target,
+                               ionice, nice)
+    stats, reporter = start_stats_reporter(
+        'gen', progress, stats_json, prometheus_textfile, stats_interval)
     generator = FileGenerator(directory, max_files, max_disk_usage,
-                              file_size_chooser)
-    generator.generate_files()
+                              file_size_chooser, workers=workers,
+                              content_source=content_source, seed=seed,
+                              stats=stats, durability=durability,
+                              durability_batch_files=durability_batch_files,
+                              durability_interval=durability_batch_ms / 1000.0,
+                              layout=layout, storage=storage,
+                              pack_size=pack_size,
+                              hash_algorithm=hash_algorithm,
+                              checkpoint_files=checkpoint_files,
+                              resume=resume, throttle=throttle,
+                              buffer_write_size=buffer_size,
+                              large_file_size=large_file_size)
+    try:
+        generator.generate_files()
+    finally:
+        if reporter is not None:
+            reporter.stop()
 
 
 @main.command()
 @click.argument('rootdir', default='.')
-def verify(rootdir):
+@click.option('--jobs', default=1, type=click.IntRange(min=1),
+              help='The number of worker processes used to verify '
+              'files.')
+@click.option('--max-memory', callback=convert_to_bytes,
+              help='The approximate amount of memory to use for tracking '
+              'file references.  Once exceeded, sorted runs of digests '
+              'are spilled to disk.')
+@click.option('--spill-dir',
+              help='The directory where digests are spilled when '
+              '--max-memory is exceeded.  Defaults to the system temp '
+              'directory.')
+@click.option('--manifest', is_flag=True,
+              help='Verify the files listed in the manifest written by '
+              '"caf gen" instead of walking the tree.')
+@click.option('--incremental', is_flag=True,
+              help='Only hash files that have changed since the last '
+              'successful incremental verification.')
+@click.option('--full-every', type=click.IntRange(min=1),
+              help='With --incremental, hash every file on every Nth run.')
+@click.option('--sample', callback=convert_to_fraction,
+              help='Only verify a random sample of the files, given as a '
+              'fraction or a percentage, e.g. "0.5%".')
+@click.option('--sample-count', type=click.IntRange(min=1),
+              help='Only verify this many randomly chosen files.')
+@click.option('--confidence', default=str(DEFAULT_CONFIDENCE),
+              callback=convert_to_fraction,
+              help='The confidence of the corruption rate reported when '
+              'sampling.')
+@click.option('--structure-only', is_flag=True,
+              help='Only read the header of each file to check the '
+              'chains of files, without hashing the files.')
+@click.option('--shard', callback=convert_to_shard,
+              help='Only verify shard "i/N" of the tree, where i is from '
+              '1 to N, and write the result for "caf verify-merge".')
+@click.option('--shard-result',
+              help='The file the result of --shard is written to.  '
+              'Defaults to "caf-shard-i-of-N.result".')
+@click.option('--buffer-size', default='1MB', callback=convert_to_bytes,
+              help='The size of the buffer files are read with.')
+@click.option('--direct-io', is_flag=True,
+              help='Read files with O_DIRECT, bypassing the page cache.')
+@click.option('--drop-page-cache/--keep-page-cache', default=True,
+              help='Whether to drop files from the page cache once '
+              'they have been read.  Dropping them (the default) avoids '
+              'evicting the page cache of other processes.')
+@click.option('--walk-threads', default=WALK_THREADS,
+              type=click.IntRange(min=1),
+              help='The number of threads each worker lists directories '
+              'with.')
+@report_options
+@throttle_options
+@stats_options
+def verify(rootdir, jobs, max_memory, spill_dir, manifest, incremental,
+           full_every, sample, sample_count, confidence, structure_only,
+           shard, shard_result, buffer_size, direct_io, drop_page_cache,
+           walk_threads, report_format, report_file, fail_fast, max_errors,
+           max_bandwidth, max_iops, latency_target, ionice, nice, progress,
+           stats_json, prometheus_textfile, stats_interval):
+    """Verify content addressable files.
+
+    This command verifies the checksum of every file generated by
+    "caf gen", and verifies that the chains of files are complete.
+
+    The files can be verified in parallel.  The work is split up by the
+    top level prefix directories, so up to 256 processes can be used:
+
+        \b
+        caf verify --jobs 8 /tmp/files
+
+    The amount of memory needed to track references between files grows
+    with the number of files.  For very large trees, you can cap the
+    memory used and have the references spilled to disk instead:
+
+        \b
+        caf verify --max-memory 1GB /tmp/files
+
+    "caf gen" records every file it generates in a manifest.  With
+    --manifest, the chains of files are checked from the manifest alone,
+    and then the files are hashed in digest order.  Files that exist but
+    are missing from the manifest are still reported:
+
+        \b
+        caf verify --manifest /tmp/files
+
+    With --incremental, a cache of verified files is kept in the
+    .metadata directory.  Files whose inode, size, mtime and ctime haven't
+    changed since the last successful verification are not hashed again,
+    although they're still included in the checks of the file chains.
+    To hash every file on a regular basis, use --full-every.  For example,
+    if this command runs nightly, every file is hashed once a week:
+
+        \b
+        caf verify --incremental --full-every 7 /tmp/files
+
+    The --progress, --stats-json and --prometheus-textfile options report
+    on a running verification the same way they do for "caf gen".
+
+    For a quick check of a huge tree, a random sample of the files can be
+    verified instead, either a fraction of the files or a fixed number of
+    them.  Along with any corrupted files, an upper bound on the
+    corruption rate of the whole tree is reported:
+
+        \b
+        caf verify --sample 0.5% /tmp/files
+        caf verify --sample-count 10000 --confidence 99% /tmp/files
+
+    With --structure-only, only the header of each file is read, which
+    checks that the chains of files are complete without hashing any of
+    them.  This can be combined with --sample.
+
+    A tree on shared storage can be verified from many hosts at once by
+    splitting it into shards.  Each host verifies one shard and writes its
+    result to a file, and then "caf verify-merge" checks the references
+    between files across all the shards:
+
+        \b
+        host1$ caf verify --shard 1/2 --shard-result 1.result /mnt/files
+        host2$ caf verify --shard 2/2 --shard-result 2.result /mnt/files
+        host1$ caf verify-merge /mnt/files 1.result 2.result
+
+    Files are read into a single reusable buffer of --buffer-size bytes.
+    So that verifying a tree doesn't push everything else out of the page
+    cache, files are dropped from the page cache as soon as they've been
+    read.  With --direct-io, files are read with O_DIRECT and never go
+    through the page cache at all:
+
+        \b
+        caf verify --direct-io --buffer-size 4MB /tmp/files
+
+    The directories of the tree are listed by --walk-threads threads in
+    each worker, so on network filesystems, where each directory listing
+    is a round trip to the server, more threads list the tree faster:
+
+        \b
+        caf verify --jobs 8 --walk-threads 32 /mnt/nfs/files
+
+    Corruption is reported on stderr as it's found.  For alerting, it can
+    be reported as JSON lines instead, each with the kind of corruption
+    and the path it was found in, followed by a summary line.  With
+    --fail-fast or --max-errors, the verification stops as soon as that
+    much corruption has been found, instead of carrying on through the
+    rest of the tree:
+
+        \b
+        caf verify --report jsonl --report-file report.jsonl /tmp/files
+        caf verify --max-errors 100 /tmp/files
+
+    To verify storage that's also serving live traffic without hurting
+    it, the I/O of all the workers can be limited to a bandwidth and a
+    number of reads per second, and with --latency-target the rate backs
+    off whenever reads get slower than the target.  --ionice and --nice
+    lower the priority of the verification too:
+
+        \b
+        caf verify --jobs 4 --max-bandwidth 200MB/s --latency-target 20 \\
+            --ionice idle --nice 10 /mnt/files
+
+    Files generated with "--storage pack" are verified one pack at a time.
+    Each pack is read sequentially, checking the digest of every object
+    and the checksum of the pack, and its index is checked against the
+    objects in the pack.
+
+    """
+    if full_every is not None and not incremental:
+        raise click.UsageError('--full-every can only be used with '
+                               '--incremental')
+    if manifest and incremental:
+        raise click.UsageError('--manifest and --incremental can not be '
+                               'used together')
+    sampling = sample is not None or sample_count is not None
+    if sample is not None and sample_count is not None:
+        raise click.UsageError('--sample and --sample-count can not be '
+                               'used together')
+    if (sampling or structure_only) and (manifest or incremental):
+        raise click.UsageError('--manifest and --incremental can not be '
+                               'used with --sample, --sample-count or '
+                               '--structure-only')
+    if shard is None and shard_result is not None:
+        raise click.UsageError('--shard-result can only be used with '
+                               '--shard')
+    if shard is not None and (manifest or incremental or sampling):
+        raise click.UsageError('--manifest, --incremental, --sample and '
+                               '--sample-count can not be used with '
+                               '--shard')
+    if read_storage(rootdir) == 'pack' and (
+            manifest or incremental or sampling or structure_only):
+        raise click.UsageError('--manifest, --incremental, --sample, '
+                               '--sample-count and --structure-only can '
+                               'not be used with pack storage')
+    try:
+        read_hash(rootdir)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    corruption_reporter = create_corruption_reporter(
+        report_format, report_file, fail_fast, max_errors)
+    throttle = create_throttle(max_bandwidth, max_iops, latency_target,
+                               ionice, nice)
     click.echo("Verifying file contents in: %s" % rootdir)
-    verifier = FileVerifier(rootdir)
-    verification_success = verifier.verify_files()
+    success_message = "All files successfully verified."
+    stats, reporter = start_stats_reporter(
+        'verify', progress, stats_json, prometheus_textfile, stats_interval)
+    verifier = FileVerifier(rootdir, jobs=jobs, max_memory=max_memory,
+                            spill_dir=spill_dir, incremental=incremental,
+                            full_every=full_every, stats=stats,
+                            structure_only=structure_only,
+                            buffer_size=buffer_size, direct_io=direct_io,
+                            drop_cache=drop_page_cache,
+                            walk_threads=walk_threads,
+                            reporter=corruption_reporter,
+                            throttle=throttle)
+    aborted = False
+    try:
+        if manifest:
+            verification_success = verifier.verify_manifest()
+        elif shard is not None:
+            if shard_result is None:
+                shard_result = 'caf-shard-%s-of-%s.result' % (
+                    shard[0] + 1, shard[1])
+            verification_success = verifier.verify_shard(
+                shard[0], shard[1], shard_result)
+            click.echo("Shard result written to: %s" % shard_result)
+            success_message = ("All files in shard successfully verified, "
+                               "run \"caf verify-merge\" to finish.")
+        elif sampling:
+            result = verifier.verify_sample(
+                fraction=sample, count=sample_count, confidence=confidence)
+            click.echo(result.summary())
+            verification_success = result.succeeded
+        else:
+            verification_success = verifier.verify_files()
+    except VerificationAborted as e:
+        # Stopped by --fail-fast or --max-errors.
+        click.echo(str(e), err=True)
+        verification_success = False
+        aborted = True
+    finally:
+        if reporter is not None:
+            reporter.stop()
+    corruption_reporter.finish(verification_success, aborted)
+    if verification_success:
+        click.echo(success_message)
+    else:
+        raise click.ClickException("Verification failed.")
+
+
+@main.command('verify-merge')
+@click.argument('rootdir')
+@click.argument('results', nargs=-1, required=True)
+@report_options
+def verify_merge(rootdir, results, report_format, report_file, fail_fast,
+                 max_errors):
+    """Finish a sharded verification.
+
+    Given the results written by "caf verify --shard" for every shard of
+    the tree, this command checks that every referenced parent exists,
+    that every file is referenced, and that the roots are all there:
+
+        \b
+        caf verify-merge /mnt/files *.result
+
+    Any corruption found by the shards is reported again, with the same
+    reporting options as "caf verify".
+
+    """
+    corruption_reporter = create_corruption_reporter(
+        report_format, report_file, fail_fast, max_errors)
+    click.echo("Merging shard results for: %s" % rootdir)
+    aborted = False
+    try:
+        verifier = FileVerifier(rootdir, reporter=corruption_reporter)
+        verification_success = verifier.verify_shard_results(results)
+    except VerificationAborted as e:
+        click.echo(str(e), err=True)
+        verification_success = False
+        aborted = True
+    except (IOError, OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    corruption_reporter.finish(verification_success, aborted)
     if verification_success:
         click.echo("All files successfully verified.")
     else:
         raise click.ClickException("Verification failed.")
 
 
+@main.command()
+@click.option('--directory',
+              help='The directory to churn.',
+              callback=current_directory)
+@click.option('--target-fill', required=True, callback=convert_to_fill,
+              help='How full to keep the directory, either as a size of '
+              'generated files (e.g. "10GB") or as a percentage of the '
+              'filesystem (e.g. "80%").')
+@click.option('--mix', default=DEFAULT_MIX, callback=convert_to_mix,
+              help='The relative weight of each operation, e.g. '
+              '"gen=50,verify=25,delete=25".')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='The number of operations that run at once, each in a '
+              'worker process.')
+@click.option('--chain-files', default=CHAIN_FILES,
+              type=click.IntRange(min=1),
+              help='The number of files in each generated chain.')
+@click.option('--file-size', default=4096, type=FileSizeType(),
+              help='The size of the files that are generated, in the same '
+              'format as "caf gen --file-size".')
+@click.option('--content-source', default='urandom',
+              type=click.Choice([source for source in CONTENT_SOURCES
+                                 if source != 'seeded']),
+              help='Where the random content of each file comes from.')
+@click.option('--durability', default='none',
+              type=click.Choice(DURABILITY_MODES),
+              help='How generated files are synced to disk.')
+@click.option('--duration', callback=convert_to_duration,
+              help='How long to churn for, in seconds or suffixed with '
+              's, m, h or d (e.g. "12h").  Defaults to until interrupted.')
+@click.option('--max-operations', type=click.IntRange(min=1),
+              help='The number of operations to run.')
+@click.option('--report-interval', default='60',
+              callback=convert_to_duration,
+              help='How often the throughput of each operation is '
+              'reported.')
+@click.option('--throughput-json', type=click.File('w'),
+              help='Also write each throughput report to this file, as a '
+              'JSON object per line.')
+@report_options
+@throttle_options
+def churn(directory, target_fill, mix, workers, chain_files, file_size,
+          content_source, durability, duration, max_operations,
+          report_interval, throughput_json, report_format, report_file,
+          fail_fast, max_errors, max_bandwidth, max_iops, latency_target,
+          ionice, nice):
+    """Age a directory by generating, verifying and deleting files.
+
+    A mix of operations runs against the directory, each on a whole
+    chain of files at a time.  "gen" generates a new chain of
+    --chain-files files, "verify" verifies a random chain, and "delete"
+    deletes a random chain.  Once the directory is as full as
+    --target-fill, generating is replaced by deleting, so the directory
+    stays around that fill level while files keep being replaced:
+
+        \b
+        caf churn --directory /mnt/files --target-fill 80% \\
+            --workers 8 --duration 24h
+
+    The throughput of each operation is reported every --report-interval,
+    so a long run shows how performance changes as the filesystem ages:
+
+        \b
+        caf churn --target-fill 100GB --mix gen=40,verify=40,delete=20 \\
+            --report-interval 5m --throughput-json churn.jsonl
+
+    The roots are kept up to date as chains are generated and deleted,
+    and deleted files are removed from the manifest, so "caf verify"
+    (with or without --manifest) still succeeds once churn has stopped.
+    Interrupting churn (e.g. with Ctrl-C) lets the running operations
+    finish first.  Deletes that didn't finish are completed the next
+    time churn runs.
+
+    Corruption found by the "verify" operations is reported with the same
+    options as "caf verify", and the I/O can be limited with the same
+    --max-bandwidth, --max-iops, --latency-target, --ionice and --nice
+    options.  Churn isn't supported with "--storage pack".
+
+    """
+    if read_storage(directory) == 'pack':
+        raise click.UsageError('caf churn can not be used with pack '
+                               'storage')
+    if duration is None and max_operations is None:
+        click.echo("Churning until interrupted.", err=True)
+    target_usage, target_fraction = target_fill
+    corruption_reporter = create_corruption_reporter(
+        report_format, report_file, fail_fast, max_errors)
+    throttle = create_throttle(max_bandwidth, max_iops, latency_target,
+                               ionice, nice)
+    try:
+        runner = ChurnRunner(
+            directory, mix, file_size, target_usage=target_usage,
+            target_fraction=target_fraction, workers=workers,
+            chain_files=chain_files, duration=duration,
+            max_operations=max_operations, report_interval=report_interval,
+            content_source=content_source, durability=durability,
+            throttle=throttle, reporter=corruption_reporter,
+            throughput_reporter=ThroughputReporter(
+                json_stream=throughput_json))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    aborted = False
+    try:
+        summary = runner.run()
+        succeeded = summary['corruptions'] == 0
+    except VerificationAborted as e:
+        click.echo(str(e), err=True)
+        succeeded = False
+        aborted = True
+    corruption_reporter.finish(succeeded, aborted)
+    if not succeeded:
+        raise click.ClickException("Corruption found while churning.")
+
+
+@main.command()
+@click.option('--directory',
+              help='The directory where the benchmark files are generated.  '
+              'Each case uses (and then removes) a new sub directory.',
+              callback=current_directory)
+@click.option('--file-size', multiple=True, default=['4kb', '1mb'],
+              help='A file size to benchmark, in the same format as '
+              '"caf gen --file-size".  Can be specified multiple times.')
+@click.option('--buffer-size', multiple=True, default=['1mb'],
+              help='A read/write buffer size to benchmark.  Can be '
+              'specified multiple times.')
+@click.option('--workers', multiple=True, default=[1],
+              type=click.IntRange(min=1),
+              help='A number of workers to benchmark.  Can be specified '
+              'multiple times.')
+@click.option('--content-source', multiple=True, default=['urandom'],
+              type=click.Choice(CONTENT_SOURCES),
+              help='A content source to benchmark.  Can be specified '
+              'multiple times.')
+@click.option('--hash', 'hashes', multiple=True, default=[DEFAULT_HASH],
+              type=click.Choice(HASH_ALGORITHMS),
+              help='A hash algorithm to benchmark.  Can be specified '
+              'multiple times.')
+@click.option('--max-disk-usage', default='64MB', callback=convert_to_bytes,
+              help='The amount of data generated for each case.')
+@click.option('--output', default='-', type=click.File('w'),
+              help='Where to write the JSON results.  Defaults to stdout.')
+def bench(directory, file_size, buffer_size, workers, content_source,
+          hashes, max_disk_usage, output):
+    """Benchmark generating and verifying files.
+
+    A tree of files is generated and then verified for every combination
+    of the file sizes, buffer sizes, worker counts, content sources and
+    hash algorithms given.  For example, to compare small and large files
+    generated with one and four workers:
+
+        \b
+        caf bench --file-size 4kb --file-size 10mb --workers 1 --workers 4
+
+    The results are written as JSON.  For each case, they include files/s,
+    MB/s and the CPU time per GB spent in each phase of generating
+    (rng, hash, write, commit) and verifying (read, hash) the files.
+
+    To compare the hash algorithms, both end to end and on their own (the
+    "hash_mb_per_second" of the report):
+
+        \b
+        caf bench --hash sha1 --hash blake2b --hash sha256
+
+    """
+    file_size_type = FileSizeType()
+    file_sizes = [(spec, file_size_type.convert(spec, None, None))
+                  for spec in file_size]
+    buffer_sizes = [convert_to_bytes(None, None, value)
+                    for value in buffer_size]
+    report = run_benchmarks(directory, file_sizes, buffer_sizes, workers,
+                            content_source, max_disk_usage, hashes)
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,168 @@
+"""Benchmark generating and verifying files.
+
+Each benchmark case generates a tree of files with ``FileGenerator`` in a
+new directory, verifies it with ``FileVerifier``, and then removes it.  The
+cases are every combination of the file sizes, buffer sizes, worker counts,
+content sources and hash algorithms being benchmarked.
+
+For each case, the results include the files/s and MB/s of both generating
+and verifying the files, along with the CPU time per GB spent in each
+phase (see ``caf.stats``).  The results are plain dicts so they can be
+dumped as JSON and compared across releases or storage backends.  The
+report also has the in memory throughput of each hash algorithm on its
+own, which is the most the hash phase can go at.
+
+"""
+import os
+import time
+import shutil
+import platform
+import tempfile
+import itertools
+
+from caf.generator import FileGenerator
+from caf.hashes import DEFAULT_HASH, get_hash
+from caf.verifier import FileVerifier
+from caf.stats import Stats, thread_cpu_clock
+
+
+GEN_PHASES = ['rng', 'hash', 'write', 'commit']
+VERIFY_PHASES = ['read', 'hash']
+BYTES_PER_MB = 1024.0 ** 2
+BYTES_PER_GB = 1024.0 ** 3
+HASH_BENCH_BYTES = 256 * 1024 ** 2
+HASH_BENCH_CHUNK = 1024 ** 2
+
+
+def run_benchmarks(directory, file_sizes, buffer_sizes, workers,
+                   content_sources, max_disk_usage,
+                   hashes=(DEFAULT_HASH,)):
+    """Run every combination of the given settings.
+
+    :param file_sizes: A list of ``(spec, file_size_chooser)`` tuples,
+        where ``spec`` is the string used to describe the file size in
+        the results.
+    :return: A dict of information about the environment, with a list
+        of the results of each case under the "results" key.
+
+    """
+    from caf import __version__
+    results = []
+    for (spec, chooser), buffer_size, num_workers, content_source, \
+            hash_name in itertools.product(file_sizes, buffer_sizes,
+                                           workers, content_sources,
+                                           hashes):
+        settings = {
+            'file_size': spec,
+            'buffer_size': buffer_size,
+            'workers': num_workers,
+            'content_source': content_source,
+            'hash': hash_name,
+        }
+        results.extend(run_case(directory, chooser, max_disk_usage,
+                                settings))
+    return {
+        'caf_version': __version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'directory': os.path.abspath(directory),
+        'max_disk_usage': max_disk_usage,
+        'hash_mb_per_second': dict(
+            (hash_name, hash_throughput(hash_name)) for hash_name in hashes),
+        'results': results,
+    }
+
+
+def hash_throughput(hash_name, total_bytes=HASH_BENCH_BYTES):
+    """Return the MB/s of hashing ``total_bytes`` in memory."""
+    chunk = os.urandom(HASH_BENCH_CHUNK)
+    digest = get_hash(hash_name).new()
+    start = time.time()
+    for _ in range(total_bytes // len(chunk)):
+        digest.update(chunk)
+    digest.digest()
+    return _ratio(total_bytes / BYTES_PER_MB, time.time() - start)
+
+
+def run_case(directory, file_size_chooser, max_disk_usage, settings):
+    """Generate and then verify a single tree of files.
+
+    Returns a list of two results, one for "gen" and one for "verify".
+    """
+    rootdir = tempfile.mkdtemp(prefix='caf-bench-', dir=directory)
+    try:
+        # Each phase is timed on the thread that does the work, so the
+        # hashing thread of caf.writer.LargeFileWriter records its own
+        # CPU time for "hash", which overlaps with "rng" and "write" on
+        # the generating thread.  A process wide clock would count
+        # every overlapping phase's CPU time in each of them.
+        gen_stats = Stats(clock=thread_cpu_clock())
+        seed = None
+        if settings['content_source'] == 'seeded':
+            seed = 0
+        generator = FileGenerator(
+            rootdir, None, max_disk_usage, file_size_chooser,
+            buffer_write_size=settings['buffer_size'],
+            workers=settings['workers'],
+            content_source=settings['content_source'], seed=seed,
+            hash_algorithm=get_hash(settings['hash']), stats=gen_stats)
+        wall_seconds, cpu_seconds, _ = _measure(generator.generate_files)
+        files = gen_stats.phases.get('commit', [0])[0]
+        total_bytes = gen_stats.phases.get('write', [0, 0])[1]
+        gen_result = _result('gen', settings, files, total_bytes,
+                             wall_seconds, cpu_seconds, gen_stats,
+                             GEN_PHASES)
+
+        verify_stats = Stats(clock=thread_cpu_clock())
+        verifier = FileVerifier(rootdir, jobs=settings['workers'],
+                                buffer_size=settings['buffer_size'],
+                                stats=verify_stats)
+        wall_seconds, cpu_seconds, succeeded = _measure(
+            verifier.verify_files)
+        verify_result = _result('verify', settings, files,
+                                verify_stats.phases.get('read', [0, 0])[1],
+                                wall_seconds, cpu_seconds, verify_stats,
+                                VERIFY_PHASES)
+        verify_result['succeeded'] = succeeded
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+    return [gen_result, verify_result]
+
+
+def _measure(func):
+    # The CPU time includes any worker processes, which have
+    # all been reaped by the time ``func`` returns.
+    before = os.times()
+    start = time.time()
+    value = func()
+    wall_seconds = time.time() - start
+    after = os.times()
+    cpu_seconds = sum(after[:4]) - sum(before[:4])
+    return wall_seconds, cpu_seconds, value
+
+
+def _result(operation, settings, files, total_bytes, wall_seconds,
+            cpu_seconds, stats, phases):
+    result = {'operation': operation}
+    result.update(settings)
+    gigabytes = total_bytes / BYTES_PER_GB
+    cpu_seconds_per_gb = {'total': _ratio(cpu_seconds, gigabytes)}
+    for phase in phases:
+        phase_seconds = stats.phases.get(phase, [0, 0, 0.0])[2]
+        cpu_seconds_per_gb[phase] = _ratio(phase_seconds, gigabytes)
+    result.update({
+        'files': files,
+        'bytes': total_bytes,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds,
+        'files_per_second': _ratio(files, wall_seconds),
+        'mb_per_second': _ratio(total_bytes / BYTES_PER_MB, wall_seconds),
+        'cpu_seconds_per_gb': cpu_seconds_per_gb,
+    })
+    return result
+
+
+def _ratio(numerator, denominator):
+    if not denominator:
+        return None
+    return numerator / float(denominator)
@@ -0,0 +1,155 @@
+"""A persistent cache of verified files.
+
+``caf verify --incremental`` keeps a cache in ``.metadata/verify-cache`` of
+every file that was verified by the last successful verification.  Each
+record is keyed by the file's digest and holds the file's parent digest
+along with the ``(inode, size, mtime_ns, ctime_ns)`` the file had when it
+was hashed.  If a file's stat still matches its record, the file doesn't
+need to be hashed again, and its parent digest comes from the cache
+instead of the file's header.
+
+The cache file is a fixed size header followed by fixed width records
+sorted by digest, so the records for any digest prefix can be found with a
+binary search instead of loading the whole cache.
+
+"""
+import os
+import mmap
+import struct
+import time
+
+
+CACHE_FILE = os.path.join('.metadata', 'verify-cache')
+MAGIC = b'CAFVC001'
+# magic, number of incremental runs since the last full run,
+# time of the last successful verification.
+HEADER = struct.Struct('>8sQd')
+
+
+def record_struct(digest_size=20):
+    return struct.Struct('>%ss%ssQQqq' % (digest_size, digest_size))
+
+
+def stat_key(stat_result):
+    """Return the ``(inode, size, mtime_ns, ctime_ns)`` for a stat."""
+    mtime_ns = getattr(stat_result, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat_result.st_mtime * 1e9)
+    ctime_ns = getattr(stat_result, 'st_ctime_ns', None)
+    if ctime_ns is None:
+        ctime_ns = int(stat_result.st_ctime * 1e9)
+    return (stat_result.st_ino, stat_result.st_size, mtime_ns, ctime_ns)
+
+
+class VerifyCache(object):
+    def __init__(self, filename, digest_size=20):
+        self._filename = filename
+        self._digest_size = digest_size
+        self._record = record_struct(digest_size)
+
+    def read_header(self):
+        """Return ``(runs_since_full, verified_at)``.
+
+        ``None`` is returned if there's no usable cache.
+        """
+        try:
+            with open(self._filename, 'rb') as f:
+                header = f.read(HEADER.size)
+        except (IOError, OSError):
+            return None
+        if len(header) != HEADER.size:
+            return None
+        magic, runs_since_full, verified_at = HEADER.unpack(header)
+        if magic != MAGIC:
+            return None
+        return runs_since_full, verified_at
+
+    def lookup_prefix(self, hex_prefix):
+        """Return the cached files whose hex digest starts with a prefix.
+
+        The return value is a dict of binary digest to a tuple of
+        ``(binary parent digest, stat key)``.
+        """
+        lower, upper = self._prefix_bounds(hex_prefix)
+        if lower is None:
+            return {}
+        cached = {}
+        try:
+            f = open(self._filename, 'rb')
+        except (IOError, OSError):
+            return cached
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= HEADER.size:
+                return cached
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                count = (size - HEADER.size) // self._record.size
+                index = self._bisect(data, count, lower)
+                while index < count:
+                    record = self._record.unpack_from(
+                        data, HEADER.size + index * self._record.size)
+                    if record[0] >= upper:
+                        break
+                    cached[record[0]] = (record[1], tuple(record[2:]))
+                    index += 1
+            finally:
+                data.close()
+        return cached
+
+    def _prefix_bounds(self, hex_prefix):
+        bits = len(hex_prefix) * 4
+        try:
+            # An empty prefix matches every digest.
+            value = int(hex_prefix or '0', 16)
+        except ValueError:
+            return None, None
+        total_bits = self._digest_size * 8
+        if bits > total_bits:
+            return None, None
+        lower = _int_to_bytes(value << (total_bits - bits), self._digest_size)
+        upper_value = (value + 1) << (total_bits - bits)
+        if upper_value >= 1 << total_bits:
+            # Larger than any digest.
+            upper = b'\xff' * (self._digest_size + 1)
+        else:
+            upper = _int_to_bytes(upper_value, self._digest_size)
+        return lower, upper
+
+    def _bisect(self, data, count, digest):
+        low, high = 0, count
+        digest_size = self._digest_size
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * self._record.size
+            if data[offset:offset + digest_size] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def write(self, sorted_records, runs_since_full):
+        """Replace the cache with new records.
+
+        ``sorted_records`` is an iterable of packed records, sorted by
+        digest.  The cache is written to a temp file and renamed into
+        place so a failed write never leaves a partial cache behind.
+        """
+        temp_filename = '%s.%s.tmp' % (self._filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, runs_since_full, time.time()))
+            for record in sorted_records:
+                f.write(record)
+        os.rename(temp_filename, self._filename)
+
+    def pack(self, digest, parent, key):
+        return self._record.pack(digest, parent, *key)
+
+    @property
+    def record_size(self):
+        return self._record.size
+
+
+def _int_to_bytes(value, size):
+    hex_value = '%0*x' % (size * 2, value)
+    return bytes(bytearray.fromhex(hex_value))
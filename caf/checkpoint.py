@@ -0,0 +1,251 @@
+"""Checkpoint generation runs so they can be resumed.
+
+Every ``caf gen`` run has a directory in ``.metadata/checkpoints``, named
+after when it started, with a ``run.json`` that records how many chains
+the run has, and two files for each of its chains::
+
+    <chain>.json     The chain's tip (its last file), the number of files
+                     and bytes it's generated, and the state of its file
+                     size sampler, as of the last checkpoint.
+    <chain>.journal  The digest and size of every file generated since
+                     the last checkpoint, as fixed width records.
+
+A file is added to the journal before it's committed, so if a run is
+interrupted, the files committed since the last checkpoint are exactly
+the journaled files, up to the first one that doesn't exist.  With pack
+storage, the chain is only checkpointed once each pack is in place, and
+the journal holds the objects of the pack being written, which are only
+kept if that pack made it into place.
+
+A run's directory (and its staging directory, ``.metadata/tmp/<run>``)
+is removed once the run completes and its roots have been recorded, so
+any run directory left behind belongs to an interrupted run, which
+``caf gen --resume`` continues.  A live run holds an ``flock`` on its
+``run.json`` for as long as it's running, so a run directory whose
+``run.json`` is locked isn't interrupted, and isn't resumed.
+
+"""
+import os
+import json
+import fcntl
+import time
+import shutil
+import struct
+from binascii import hexlify, unhexlify
+
+from caf.hashes import SHA1
+from caf.pack import pack_checksum
+
+
+CHECKPOINTS_DIR = os.path.join('.metadata', 'checkpoints')
+RUN_FILE = 'run.json'
+CHECKPOINT_FILES = 10000
+READ_BLOCK_RECORDS = 4096
+
+
+def journal_record_struct(digest_size=SHA1.digest_size):
+    return struct.Struct('>%ssQ' % digest_size)
+
+
+def new_run_id():
+    # Run ids sort in the order the runs started.
+    return '%s-%s' % (time.strftime('%Y%m%dT%H%M%S'),
+                      hexlify(os.urandom(4)).decode('ascii'))
+
+
+def interrupted_runs(rootdir):
+    """Return the ids of a tree's interrupted runs, oldest first.
+
+    Runs that are still live are skipped.
+    """
+    checkpoints_dir = os.path.join(rootdir, CHECKPOINTS_DIR)
+    if not os.path.isdir(checkpoints_dir):
+        return []
+    runs = []
+    for run_id in sorted(os.listdir(checkpoints_dir)):
+        fd = lock_run(rootdir, run_id)
+        if fd is not None:
+            os.close(fd)
+            runs.append(run_id)
+    return runs
+
+
+def lock_run(rootdir, run_id):
+    """Lock a run's ``run.json`` on behalf of the process running it.
+
+    Returns the locked file descriptor, which holds the lock until it's
+    closed, or None if the run is live in another process (or hasn't
+    finished being written).
+    """
+    filename = os.path.join(run_directory(rootdir, run_id), RUN_FILE)
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+    return fd
+
+
+def run_directory(rootdir, run_id):
+    return os.path.join(rootdir, CHECKPOINTS_DIR, run_id)
+
+
+def remove_run(rootdir, run_id):
+    shutil.rmtree(run_directory(rootdir, run_id), ignore_errors=True)
+
+
+def write_run(rootdir, run_id, chains):
+    """Record a new run, and return the file descriptor of its lock.
+
+    The run is locked (see ``lock_run``) before its ``run.json`` is
+    moved into place, so it's never mistaken for an interrupted run.
+    """
+    run_dir = run_directory(rootdir, run_id)
+    os.makedirs(run_dir)
+    filename = os.path.join(run_dir, RUN_FILE)
+    temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, json.dumps({'chains': chains}).encode('ascii'))
+        os.rename(temp_filename, filename)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def read_run(rootdir, run_id):
+    """Return the number of chains in a run."""
+    with open(os.path.join(run_directory(rootdir, run_id), RUN_FILE)) as f:
+        return json.load(f)['chains']
+
+
+class ChainState(object):
+    """Where a chain got to, as of a checkpoint and its journal."""
+    def __init__(self, tip, files=0, disk_usage=0, sampler_state=None):
+        self.tip = tip
+        self.files = files
+        self.disk_usage = disk_usage
+        self.sampler_state = sampler_state
+        # (digest, parent, size) of each file committed since the
+        # checkpoint.
+        self.replayed = []
+
+
+class Checkpointer(object):
+    """Journal and checkpoint the progress of a single chain."""
+    def __init__(self, rootdir, run_id, chain,
+                 checkpoint_files=CHECKPOINT_FILES, algorithm=SHA1):
+        run_dir = run_directory(rootdir, run_id)
+        self.checkpoint_filename = os.path.join(run_dir, '%s.json' % chain)
+        self.journal_filename = os.path.join(run_dir, '%s.journal' % chain)
+        self._checkpoint_files = checkpoint_files
+        self._algorithm = algorithm
+        self._record = journal_record_struct(algorithm.digest_size)
+        self._journal_fd = None
+        self._since_checkpoint = 0
+
+    def record(self, digest, size):
+        """Journal a file before it's committed."""
+        if self._journal_fd is None:
+            self._journal_fd = os.open(
+                self.journal_filename,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._journal_fd, self._record.pack(digest, size))
+        self._since_checkpoint += 1
+
+    def checkpoint_due(self):
+        return self._since_checkpoint >= self._checkpoint_files
+
+    def checkpoint(self, state, durability):
+        """Write a checkpoint and then empty the journal.
+
+        The checkpoint is made durable (according to ``durability``)
+        before the journal is emptied, so the files in the journal are
+        accounted for at every point.
+        """
+        temp_filename = '%s.%s.tmp' % (self.checkpoint_filename,
+                                       os.getpid())
+        with open(temp_filename, 'w') as f:
+            json.dump({
+                'tip': hexlify(state.tip).decode('ascii'),
+                'files': state.files,
+                'disk_usage': state.disk_usage,
+                'sampler': state.sampler_state,
+            }, f)
+        os.rename(temp_filename, self.checkpoint_filename)
+        durability.sync_metadata(
+            [self.checkpoint_filename],
+            [os.path.dirname(self.checkpoint_filename)])
+        if self._journal_fd is not None:
+            os.ftruncate(self._journal_fd, 0)
+        self._since_checkpoint = 0
+
+    def close(self):
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+
+    def journal_filenames(self):
+        # The files to sync along with each durability barrier.
+        if self._journal_fd is None:
+            return []
+        return [self.journal_filename]
+
+    def load(self, initial_tip, committed=None, pack_committed=None):
+        """Return the ``ChainState`` of an interrupted chain.
+
+        Journaled files are replayed while ``committed(digest)`` says
+        they exist.  With pack storage, ``pack_committed(checksum)`` says
+        whether the pack with the checksum of every journaled object
+        exists instead.
+        """
+        if os.path.exists(self.checkpoint_filename):
+            with open(self.checkpoint_filename) as f:
+                checkpoint = json.load(f)
+            tip = unhexlify(checkpoint['tip'].encode('ascii'))
+            state = ChainState(tip, checkpoint['files'],
+                               checkpoint['disk_usage'],
+                               checkpoint['sampler'])
+        else:
+            # Interrupted before its first checkpoint.
+            tip = initial_tip
+            state = ChainState(tip)
+        records = list(self._read_journal())
+        # The journal may not have been emptied after the checkpoint
+        # was written, in which case it starts with files up to and
+        # including the tip.
+        digests = [digest for digest, _ in records]
+        if tip != initial_tip and tip in digests:
+            records = records[digests.index(tip) + 1:]
+        if pack_committed is not None:
+            if not records or not pack_committed(
+                    pack_checksum(records, self._algorithm)):
+                return state
+        for digest, size in records:
+            if committed is not None and not committed(digest):
+                break
+            state.replayed.append((digest, state.tip, size))
+            state.tip = digest
+            state.files += 1
+            state.disk_usage += size
+        return state
+
+    def _read_journal(self):
+        if not os.path.exists(self.journal_filename):
+            return
+        record = self._record
+        block_size = record.size * READ_BLOCK_RECORDS
+        with open(self.journal_filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                # A partial record at the end is from an interrupted
+                # write, and that file was never committed.
+                usable = len(block) - (len(block) % record.size)
+                for offset in range(0, usable, record.size):
+                    yield record.unpack_from(block, offset)
@@ -0,0 +1,561 @@
+"""Age a tree with a steady mix of generating, verifying and deleting.
+
+``caf gen`` only ever adds files and ``caf verify`` only ever reads them,
+but real storage ages through deletes and the fragmentation they leave
+behind.  A ``ChurnRunner`` keeps a pool of worker processes busy with
+operations on whole chains of files:
+
+    gen     Generate a new chain of ``chain_files`` files with a
+            ``caf.generator.FileGenerator``, which records its root.
+    verify  Verify every file of a random chain, following it from its
+            root (see ``caf.verifier.FileVerifier.check_chain``).
+    delete  Delete every file of a random chain, and then tombstone its
+            root in the roots log (see ``caf.roots``).
+
+Each operation is picked at random, weighted by the mix, except that once
+the tree has reached its target fill level (either a number of bytes, or
+a fraction of the filesystem) generating is replaced by deleting.  The
+parent process hands out the chains, so a chain is only ever used by one
+operation at a time, and since chains never share files, every chain
+that isn't in the middle of an operation is complete.
+
+Before a chain is deleted, the digests of its files are written to an
+intent file, ``.metadata/churn/<root>.delete``.  The records of deleted
+files are removed from the manifest in batches (see
+``caf.manifest.compact_manifest``), and each intent file is only removed
+once the records of its files are gone.  Any intent files left behind by
+an interrupted run are finished off when churn starts again.
+
+Every ``report_interval`` seconds the throughput of each operation over
+the interval is reported, so a long run shows how the performance of the
+storage changes as it ages.
+
+"""
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import random
+import traceback
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from caf.generator import FileGenerator
+from caf.hashes import read_hash
+from caf.layout import load_layout
+from caf.manifest import compact_manifest, MANIFEST_FILE
+from caf.pack import read_storage
+from caf.report import TextReporter, VerificationAborted
+from caf.roots import RootsLog, has_roots
+from caf.stats import Stats, BYTES_PER_MB
+from caf.utils import fork_context
+from caf.verifier import FileVerifier
+from caf.walker import TreeWalker
+
+
+OPERATIONS = ['gen', 'verify', 'delete']
+DEFAULT_MIX = 'gen=50,verify=25,delete=25'
+CHAIN_FILES = 100
+REPORT_INTERVAL = 60
+# Deleted files are removed from the manifest once there are this many.
+COMPACT_FILES = 100000
+CHURN_DIR = os.path.join('.metadata', 'churn')
+INTENT_SUFFIX = '.delete'
+
+
+OperationResult = namedtuple(
+    'OperationResult',
+    ['operation', 'root', 'files', 'bytes', 'seconds', 'corruptions'])
+
+
+def parse_mix(spec):
+    """Parse a mix of operations such as "gen=50,verify=25,delete=25".
+
+    Returns a dict of the weight of each operation.  Operations that
+    aren't given have a weight of 0.
+    """
+    mix = dict((operation, 0) for operation in OPERATIONS)
+    for item in spec.split(','):
+        operation, _, weight = item.partition('=')
+        operation = operation.strip()
+        if operation not in mix:
+            raise ValueError('Unknown operation "%s", must be one of: %s' %
+                             (operation, ','.join(OPERATIONS)))
+        try:
+            mix[operation] = int(weight)
+        except ValueError:
+            raise ValueError('Invalid weight for %s: %s' % (operation,
+                                                            weight))
+        if mix[operation] < 0:
+            raise ValueError('Weights can not be negative.')
+    if not sum(mix.values()):
+        raise ValueError('At least one operation needs a weight.')
+    return mix
+
+
+def intent_filename(rootdir, root):
+    return os.path.join(rootdir, CHURN_DIR, '%s%s' % (
+        hexlify(root).decode('ascii'), INTENT_SUFFIX))
+
+
+def write_intent(filename, digests):
+    temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        f.write(b''.join(digests))
+    os.rename(temp_filename, filename)
+
+
+def read_intent(filename, digest_size):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return [data[offset:offset + digest_size]
+            for offset in range(0, len(data) - digest_size + 1,
+                                digest_size)]
+
+
+class ChainDeleter(object):
+    """Delete whole chains of files, and tombstone their roots."""
+    def __init__(self, rootdir, layout, algorithm):
+        self._rootdir = rootdir
+        self._layout = layout
+        self._algorithm = algorithm
+        self._roots_log = RootsLog(rootdir, algorithm)
+
+    def delete(self, root):
+        """Delete a chain, returning the number of files and bytes."""
+        digests = self.list_chain(root)
+        write_intent(intent_filename(self._rootdir, root), digests)
+        deleted = self.remove_files(digests)
+        self.remove_root(root)
+        return deleted
+
+    def list_chain(self, root):
+        # Follow the headers from the root for as long as the files
+        # exist.
+        digest_size = self._algorithm.digest_size
+        root_hash = self._algorithm.root_hash
+        digests = []
+        digest = root
+        while digest != root_hash:
+            try:
+                with open(self._path(digest), 'rb') as f:
+                    parent = f.read(digest_size)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                break
+            digests.append(digest)
+            if len(parent) != digest_size:
+                break
+            digest = parent
+        return digests
+
+    def remove_files(self, digests):
+        """Remove the files of a chain, if they still exist.
+
+        Returns the number of files and bytes removed.
+        """
+        files = nbytes = 0
+        for digest in digests:
+            path = self._path(digest)
+            try:
+                size = os.lstat(path).st_size
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            files += 1
+            nbytes += size
+        return files, nbytes
+
+    def remove_root(self, root):
+        self._roots_log.append([], [root])
+
+    def _path(self, digest):
+        return os.path.join(self._rootdir, self._layout.hash_to_file_path(
+            hexlify(digest).decode('ascii')))
+
+
+def _churn_worker(runner, tasks, results):
+    # ^C stops the parent from handing out operations, and the ones
+    # already running are finished so every chain is left complete.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Each forked worker starts with a copy of the parent's random
+    # state, so reseed or every worker will pick the same file sizes.
+    random.seed()
+    try:
+        for operation, root in iter(tasks.get, None):
+            results.put(('ok', runner._run_operation(operation, root)))
+    except BaseException:
+        results.put(('error', traceback.format_exc()))
+        sys.exit(1)
+
+
+class ChurnRunner(object):
+    """Run a mix of generating, verifying and deleting chains of files.
+
+    ``mix`` is a dict of the weight of each of ``OPERATIONS`` (see
+    ``parse_mix``), and ``workers`` operations run at once.  The tree is
+    filled up to ``target_usage`` bytes of files, or until
+    ``target_fraction`` of its filesystem is used.
+
+    Churn stops after ``duration`` seconds or ``max_operations``
+    operations, whichever comes first, or when interrupted.  Either way
+    the operations that are running are finished first.
+
+    Each new chain has ``chain_files`` files with sizes from
+    ``file_size_chooser``, written with ``content_source`` and
+    ``durability`` (see ``caf.generator.FileGenerator``).  Every read
+    and write is limited by ``throttle``.
+
+    The throughput of each interval, and of the whole run once it's
+    done, is given to ``throughput_reporter`` (a
+    ``ThroughputReporter``).  Corruption found by verifying chains is
+    given to ``reporter`` (see ``caf.report``), and the chain is then
+    left alone.
+    """
+    def __init__(self, rootdir, mix, file_size_chooser, target_usage=None,
+                 target_fraction=None, workers=1, chain_files=CHAIN_FILES,
+                 duration=None, max_operations=None,
+                 report_interval=REPORT_INTERVAL, content_source='urandom',
+                 durability='none', throttle=None, reporter=None,
+                 throughput_reporter=None):
+        if target_usage is None and target_fraction is None:
+            raise ValueError('Either a target usage or a target fraction '
+                             'of the filesystem is required.')
+        if read_storage(rootdir) == 'pack':
+            raise ValueError('Churn is not supported with pack storage.')
+        self._rootdir = os.path.abspath(rootdir)
+        self._mix = mix
+        self._target_usage = target_usage
+        self._target_fraction = target_fraction
+        self._workers = workers
+        self._duration = duration
+        self._max_operations = max_operations
+        self._report_interval = report_interval
+        if throughput_reporter is None:
+            throughput_reporter = ThroughputReporter()
+        self._throughput_reporter = throughput_reporter
+        self._layout = load_layout(self._rootdir)
+        self._hash = read_hash(self._rootdir)
+        # Each worker's operations are measured with its own copy.
+        self._stats = Stats()
+        self._generator = FileGenerator(
+            self._rootdir, chain_files, None, file_size_chooser,
+            content_source=content_source, stats=self._stats,
+            durability=durability, layout=self._layout,
+            hash_algorithm=self._hash, throttle=throttle)
+        if reporter is None:
+            reporter = TextReporter()
+        self._reporter = reporter
+        self._verifier = FileVerifier(self._rootdir, stats=self._stats,
+                                      reporter=reporter, throttle=throttle)
+        self._deleter = ChainDeleter(self._rootdir, self._layout,
+                                     self._hash)
+        # The roots of the chains that aren't in use by an operation.
+        self._chains = []
+        self._chain_count = 0
+        # The roots of deleted chains whose intent files are still
+        # around, and the number of files they had.
+        self._deleted = []
+        self._deleted_files = 0
+        self._usage = 0
+        self._dispatched = 0
+        self._stopping = False
+        self._start_time = None
+
+    def run(self):
+        """Churn the tree, and return the summary of the whole run.
+
+        ``caf.report.VerificationAborted`` is raised, once the running
+        operations have finished, if the reporter's ``max_errors`` is
+        reached.
+        """
+        self._load_chains()
+        self._start_time = time.time()
+        self._totals = self._new_totals()
+        self._interval = self._new_totals()
+        self._interval_start = self._start_time
+        aborted = None
+        context = fork_context()
+        tasks = context.Queue()
+        results = context.Queue()
+        workers = [
+            context.Process(target=_churn_worker,
+                            args=(self, tasks, results))
+            for _ in range(self._workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            running = 0
+            for _ in workers:
+                running += self._dispatch(tasks)
+            while running:
+                next_report = self._interval_start + self._report_interval
+                try:
+                    status, value = results.get(
+                        timeout=min(1, max(0.01, next_report - time.time())))
+                except Empty:
+                    if not any(worker.is_alive() for worker in workers) \
+                            and results.empty():
+                        raise RuntimeError(
+                            'Churn worker exited without a result.')
+                    self._report_interval_if_due()
+                    continue
+                except KeyboardInterrupt:
+                    self._stopping = True
+                    continue
+                running -= 1
+                if status == 'error':
+                    raise RuntimeError('Churn operation failed:\n%s' % value)
+                try:
+                    self._finish_operation(value)
+                except VerificationAborted as e:
+                    aborted = e
+                    self._stopping = True
+                self._report_interval_if_due()
+                running += self._dispatch(tasks)
+        finally:
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+        self._compact_manifest()
+        summary = self._summary('summary', self._totals, self._start_time)
+        self._throughput_reporter.report(summary)
+        if aborted is not None:
+            raise aborted
+        return summary
+
+    def _load_chains(self):
+        roots, error = RootsLog(self._rootdir, self._hash).read()
+        if error is not None and has_roots(self._rootdir):
+            raise ValueError('The roots can not be trusted: %s' % error)
+        churn_dir = os.path.join(self._rootdir, CHURN_DIR)
+        if not os.path.isdir(churn_dir):
+            os.makedirs(churn_dir)
+        # Finish deleting the chains of an interrupted run.
+        for name in sorted(os.listdir(churn_dir)):
+            filename = os.path.join(churn_dir, name)
+            if not name.endswith(INTENT_SUFFIX):
+                os.remove(filename)
+                continue
+            root = unhexlify(name[:-len(INTENT_SUFFIX)].encode('ascii'))
+            digests = read_intent(filename, self._hash.digest_size)
+            self._deleter.remove_files(digests)
+            if root in roots:
+                self._deleter.remove_root(root)
+                roots.discard(root)
+            self._deleted.append(root)
+        self._compact_manifest()
+        self._chains = list(roots)
+        self._chain_count = len(self._chains)
+        if self._target_usage is not None:
+            walker = TreeWalker(self._rootdir, self._layout)
+            try:
+                for digest, entry in walker.iter_files():
+                    if digest is not None:
+                        self._usage += entry.stat().st_size
+            finally:
+                walker.close()
+
+    def _dispatch(self, tasks):
+        # Hands out the next operation, and returns how many were
+        # handed out (0 once churn is stopping).
+        if self._stopping or (
+                self._max_operations is not None and
+                self._dispatched >= self._max_operations) or (
+                self._duration is not None and
+                time.time() - self._start_time >= self._duration):
+            self._stopping = True
+            return 0
+        tasks.put(self._choose_operation())
+        self._dispatched += 1
+        return 1
+
+    def _choose_operation(self):
+        operation = self._pick_weighted()
+        if operation == 'gen' and self._is_full():
+            operation = 'delete'
+        if operation != 'gen' and not self._chains:
+            # Every chain is in use, or there aren't any yet.
+            operation = 'gen'
+        root = None
+        if operation != 'gen':
+            chains = self._chains
+            index = random.randrange(len(chains))
+            chains[index], chains[-1] = chains[-1], chains[index]
+            root = chains.pop()
+        return operation, root
+
+    def _pick_weighted(self):
+        choice = random.uniform(0, sum(self._mix.values()))
+        for operation in OPERATIONS:
+            choice -= self._mix[operation]
+            if choice < 0:
+                break
+        return operation
+
+    def _fill(self):
+        # Returns the bytes used and the target, either of the tree or
+        # of its filesystem.
+        if self._target_usage is not None:
+            return self._usage, self._target_usage
+        # The same as the "Use%" of df, which leaves out the blocks
+        # reserved for root.
+        st = os.statvfs(self._rootdir)
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        capacity = used + st.f_bavail * st.f_frsize
+        return used, int(self._target_fraction * capacity)
+
+    def _is_full(self):
+        used, target = self._fill()
+        return used >= target
+
+    def _run_operation(self, operation, root):
+        # Runs in a worker process.
+        start = time.time()
+        corruptions = []
+        self._stats.reset()
+        if operation == 'gen':
+            roots = self._generator.generate_files()
+            root = None
+            if roots:
+                root = unhexlify(roots[0].encode('ascii'))
+            files, nbytes = self._stats.snapshot().get('file', [0, 0])[:2]
+        elif operation == 'verify':
+            corruptions = self._verifier.check_chain(root)
+            files, nbytes = self._stats.snapshot().get('file', [0, 0])[:2]
+        else:
+            files, nbytes = self._deleter.delete(root)
+        return OperationResult(operation, root, files, nbytes,
+                               time.time() - start, corruptions)
+
+    def _finish_operation(self, result):
+        for totals in (self._totals, self._interval):
+            counts = totals[result.operation]
+            counts[0] += 1
+            counts[1] += result.files
+            counts[2] += result.bytes
+            counts[3] += result.seconds
+        if result.operation == 'gen':
+            if result.root is not None:
+                self._chains.append(result.root)
+                self._chain_count += 1
+            self._usage += result.bytes
+        elif result.operation == 'delete':
+            self._chain_count -= 1
+            self._usage -= result.bytes
+            self._deleted.append(result.root)
+            self._deleted_files += result.files
+            if self._deleted_files >= COMPACT_FILES:
+                self._compact_manifest()
+        elif not result.corruptions:
+            self._chains.append(result.root)
+        else:
+            self._totals['corruptions'] += len(result.corruptions)
+            self._interval['corruptions'] += len(result.corruptions)
+            for corruption in result.corruptions:
+                self._reporter.report(corruption)
+
+    def _compact_manifest(self):
+        if not self._deleted:
+            return
+        filenames = [intent_filename(self._rootdir, root)
+                     for root in self._deleted]
+        removed = set()
+        for filename in filenames:
+            removed.update(read_intent(filename, self._hash.digest_size))
+        manifest_filename = os.path.join(self._rootdir, MANIFEST_FILE)
+        if os.path.exists(manifest_filename):
+            compact_manifest(manifest_filename, removed,
+                             self._hash.digest_size)
+        for filename in filenames:
+            os.remove(filename)
+        self._deleted = []
+        self._deleted_files = 0
+
+    def _report_interval_if_due(self):
+        now = time.time()
+        if now - self._interval_start < self._report_interval:
+            return
+        self._throughput_reporter.report(
+            self._summary('interval', self._interval, self._interval_start))
+        self._interval = self._new_totals()
+        self._interval_start = now
+
+    def _new_totals(self):
+        # operation -> [count, files, bytes, seconds]
+        totals = dict((operation, [0, 0, 0, 0.0])
+                      for operation in OPERATIONS)
+        totals['corruptions'] = 0
+        return totals
+
+    def _summary(self, record_type, totals, since):
+        now = time.time()
+        seconds = max(now - since, 1e-9)
+        operations = {}
+        for operation in OPERATIONS:
+            count, files, nbytes, busy_seconds = totals[operation]
+            operations[operation] = {
+                'count': count,
+                'files': files,
+                'bytes': nbytes,
+                'busy_seconds': busy_seconds,
+                'files_per_second': files / seconds,
+                'mb_per_second': nbytes / BYTES_PER_MB / seconds,
+            }
+        used, target = self._fill()
+        return {
+            'type': record_type,
+            'timestamp': now,
+            'elapsed_seconds': now - self._start_time,
+            'seconds': seconds,
+            'operations': operations,
+            'chains': self._chain_count,
+            'used_bytes': used,
+            'target_bytes': target,
+            'corruptions': totals['corruptions'],
+        }
+
+
+class ThroughputReporter(object):
+    """Write a line of text for each churn report.
+
+    Each report is also written as a JSON object on a line of its own to
+    ``json_stream``, if one is given.
+    """
+    def __init__(self, stream=None, json_stream=None):
+        if stream is None:
+            stream = sys.stdout
+        self._stream = stream
+        self._json_stream = json_stream
+
+    def report(self, record):
+        operations = record['operations']
+        self._stream.write(
+            'churn %s: %ds elapsed, gen %.1f MB/s (%.1f files/s), '
+            'verify %.1f MB/s (%.1f files/s), delete %.1f files/s, '
+            '%.1f of %.1f MB used, %d chains\n' % (
+                record['type'], record['elapsed_seconds'],
+                operations['gen']['mb_per_second'],
+                operations['gen']['files_per_second'],
+                operations['verify']['mb_per_second'],
+                operations['verify']['files_per_second'],
+                operations['delete']['files_per_second'],
+                record['used_bytes'] / BYTES_PER_MB,
+                record['target_bytes'] / BYTES_PER_MB,
+                record['chains']))
+        self._stream.flush()
+        if self._json_stream is not None:
+            self._json_stream.write(json.dumps(record, sort_keys=True) +
+                                    '\n')
+            self._json_stream.flush()
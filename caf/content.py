@@ -0,0 +1,114 @@
+"""Sources of random content for generated files.
+
+Each source has a ``read(size)`` method that returns ``size`` random bytes.
+
+* ``urandom`` - Every byte comes from ``os.urandom``.  This is the default.
+* ``fast`` - A non-cryptographic source that is much cheaper per byte.
+  A pool of random bytes is generated once, and the output is a stream of
+  "segments".  Each segment is the pool rotated by a random offset and
+  passed through a random byte permutation (``bytes.translate``), so no
+  segment repeats any other segment and the output stays incompressible.
+* ``seeded`` - The same as ``fast``, except that the pool, rotations and
+  permutations all come from ``--seed``, so the content is reproducible.
+
+You can see how fast each source is on your machine with::
+
+    python -m caf.content
+
+"""
+import os
+import sys
+import time
+import random
+
+
+POOL_SIZE = 1024 * 1024
+
+
+def _random_bytes(rng, size):
+    if hasattr(rng, 'randbytes'):
+        return rng.randbytes(size)
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+
+class UrandomSource(object):
+    def read(self, size):
+        return os.urandom(size)
+
+
+class FastSource(object):
+    def __init__(self, seed=None, pool_size=POOL_SIZE):
+        self._random = random.Random(seed)
+        if seed is None:
+            self._pool = os.urandom(pool_size)
+        else:
+            self._pool = _random_bytes(self._random, pool_size)
+        self._segment = b''
+        self._offset = 0
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            if self._offset >= len(self._segment):
+                self._new_segment()
+            part = self._segment[self._offset:self._offset + size]
+            self._offset += len(part)
+            size -= len(part)
+            parts.append(part)
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def _new_segment(self):
+        table = list(range(256))
+        self._random.shuffle(table)
+        rotation = self._random.randrange(len(self._pool))
+        pool = self._pool
+        self._segment = (pool[rotation:] + pool[:rotation]).translate(
+            bytes(bytearray(table)))
+        self._offset = 0
+
+
+CONTENT_SOURCES = ['urandom', 'fast', 'seeded']
+
+
+def create_content_source(name, seed=None, stream_id=0):
+    """Create a content source by name.
+
+    ``stream_id`` distinguishes multiple seeded sources created from the
+    same seed (e.g. one for each worker process) so they don't generate
+    the same content.
+    """
+    if name == 'urandom':
+        return UrandomSource()
+    elif name == 'fast':
+        return FastSource()
+    elif name == 'seeded':
+        if seed is None:
+            raise ValueError("The seeded content source requires a seed.")
+        return FastSource(seed='%s-%s' % (seed, stream_id))
+    raise ValueError("Unknown content source: %s" % name)
+
+
+def benchmark(names=CONTENT_SOURCES, total_bytes=256 * 1024 * 1024,
+              chunk_size=1024 * 1024):
+    """Return a dict of content source name to MB/s."""
+    results = {}
+    for name in names:
+        source = create_content_source(name, seed=0)
+        remaining = total_bytes
+        start = time.time()
+        while remaining > 0:
+            remaining -= len(source.read(min(chunk_size, remaining)))
+        elapsed = time.time() - start
+        results[name] = total_bytes / (1024.0 ** 2) / elapsed
+    return results
+
+
+def main():
+    for name, mb_per_second in sorted(benchmark().items()):
+        sys.stdout.write('%-10s %10.1f MB/s\n' % (name, mb_per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Compact storage for large sets of binary digests.
+
+Verifying a tree means keeping track of every digest that's been seen and
+every parent digest that's been referenced.  Storing these as Python
+strings in a ``set`` costs well over 100 bytes per file, which doesn't
+work for billions of files.
+
+A ``DigestSet`` instead stores digests as packed, fixed width records.
+Records are appended to a buffer, and once the buffer is full it's sorted
+into a "run".  Runs are either kept in memory or, if a memory budget is
+given, spilled to disk.  Iterating over a ``DigestSet`` merges all the runs
+so the digests come out sorted and unique, which means two sets can be
+compared with a merge join instead of hash lookups.
+
+"""
+import os
+import heapq
+import shutil
+import tempfile
+
+
+# The approximate cost of each record while a run is being sorted.  The
+# records have to be split into individual bytes objects to be sorted,
+# and each one costs about this much on top of the packed record.
+SORT_OVERHEAD = 80
+DEFAULT_RUN_RECORDS = 1024 * 1024
+READ_BLOCK_RECORDS = 4096
+
+
+class DigestSet(object):
+    """A set of fixed width binary digests.
+
+    :param digest_size: The size in bytes of each digest.
+    :param max_memory: The approximate number of bytes this set can use.
+        If this is ``None`` then all the runs are kept in memory.
+        Otherwise sorted runs are spilled to disk as needed.
+    :param spill_dir: The directory where runs are spilled.  Defaults to
+        the system temp directory.
+
+    """
+    def __init__(self, digest_size=20, max_memory=None, spill_dir=None):
+        self._digest_size = digest_size
+        self._max_memory = max_memory
+        self._spill_dir = spill_dir
+        self._run_dir = None
+        if max_memory is None:
+            self._run_records = DEFAULT_RUN_RECORDS
+        else:
+            self._run_records = max(
+                1, max_memory // (digest_size + SORT_OVERHEAD))
+        self._buffer = bytearray()
+        # Sorted runs that are kept in memory, and the filenames
+        # of sorted runs that have been spilled to disk.
+        self._runs = []
+        self._run_files = []
+
+    def add(self, digest):
+        self._buffer.extend(digest)
+        if len(self._buffer) >= self._run_records * self._digest_size:
+            self._flush_buffer()
+
+    def update(self, packed_digests):
+        """Add a packed sequence of digests."""
+        run_size = self._run_records * self._digest_size
+        for i in range(0, len(packed_digests), run_size):
+            self._buffer.extend(packed_digests[i:i + run_size])
+            if len(self._buffer) >= run_size:
+                self._flush_buffer()
+
+    def __iter__(self):
+        self._flush_buffer()
+        iterators = [self._iter_run(run) for run in self._runs]
+        iterators.extend(self._iter_run_file(filename)
+                         for filename in self._run_files)
+        return merge_sorted(iterators)
+
+    def close(self):
+        self._buffer = bytearray()
+        self._runs = []
+        self._run_files = []
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _flush_buffer(self):
+        if not self._buffer:
+            return
+        size = self._digest_size
+        buf = self._buffer
+        records = sorted(
+            bytes(buf[i:i + size]) for i in range(0, len(buf), size))
+        self._buffer = bytearray()
+        run = b''.join(records)
+        del records
+        if self._max_memory is None:
+            self._runs.append(run)
+        else:
+            self._spill(run)
+
+    def _spill(self, run):
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix='caf-digests-',
+                                             dir=self._spill_dir)
+        filename = os.path.join(self._run_dir,
+                                'run-%d' % len(self._run_files))
+        with open(filename, 'wb') as f:
+            f.write(run)
+        self._run_files.append(filename)
+
+    def _iter_run(self, run):
+        size = self._digest_size
+        for i in range(0, len(run), size):
+            yield run[i:i + size]
+
+    def _iter_run_file(self, filename):
+        size = self._digest_size
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(size * READ_BLOCK_RECORDS),
+                              b''):
+                for i in range(0, len(block), size):
+                    yield block[i:i + size]
+
+
+def merge_sorted(iterables):
+    """Merge sorted iterables of digests, dropping any duplicates."""
+    last = None
+    for digest in heapq.merge(*iterables):
+        if digest != last:
+            yield digest
+            last = digest
+
+
+def merge_join(left, right):
+    """Join two sorted, unique iterables of digests.
+
+    Yields a tuple of ``(digest, in_left, in_right)`` for every digest
+    in either iterable, in sorted order.
+    """
+    left = iter(left)
+    right = iter(right)
+    left_digest = next(left, None)
+    right_digest = next(right, None)
+    while left_digest is not None or right_digest is not None:
+        if right_digest is None or (left_digest is not None and
+                                    left_digest < right_digest):
+            yield left_digest, True, False
+            left_digest = next(left, None)
+        elif left_digest is None or right_digest < left_digest:
+            yield right_digest, False, True
+            right_digest = next(right, None)
+        else:
+            yield left_digest, True, True
+            left_digest = next(left, None)
+            right_digest = next(right, None)
@@ -0,0 +1,176 @@
+"""Make generated files durable.
+
+By default nothing is synced, so a crash can leave files that were
+committed to their final location but whose contents never made it to
+disk.  Verifying such a tree fails for reasons that have nothing to do
+with the storage being tested.
+
+Syncing every file makes generation much slower, so files can instead be
+synced in batches.  The durability modes are:
+
+* ``none`` - Never sync anything.
+* ``file`` - ``fdatasync()`` each file before it's committed, and
+  ``fsync()`` its directory after.
+* ``batch`` - After every batch of files (or interval of time), issue a
+  single barrier that ``fdatasync()``s each file in the batch and then
+  ``fsync()``s the directories they were committed to.
+* ``syncfs`` - Like ``batch``, except the barrier is a single ``syncfs()``
+  of the filesystem the files are on.
+
+With any mode other than ``none``, the roots of each chain and the
+``.metadata/all`` roots hash are only written once every file has made it
+through a barrier, so a tree that has a roots hash is crash consistent.
+
+"""
+import os
+import time
+import ctypes
+
+from caf.stats import NULL_STATS
+
+
+DURABILITY_MODES = ['none', 'file', 'batch', 'syncfs']
+BATCH_FILES = 1000
+BATCH_INTERVAL = 1.0
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+_libc = None
+
+
+def sync_file(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        _fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncfs(path):
+    """Sync the filesystem that ``path`` is on.
+
+    ``syncfs()`` is Linux specific, so elsewhere every filesystem is
+    synced instead.
+    """
+    global _libc
+    if _libc is None:
+        # The symbols of the running process include libc's.
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(_libc, 'syncfs'):
+        _libc.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
+
+
+class DurabilityPolicy(object):
+    """Decide when, and how, generated files are synced.
+
+    The generator tells the policy about each file as it's written
+    (``file_written``) and committed (``file_committed``), and issues a
+    barrier whenever ``barrier_due`` says one is needed.  A final barrier
+    must be issued once generation is done.
+
+    :param mode: One of ``DURABILITY_MODES``.
+    :param batch_files: The max number of files in a batch.
+    :param batch_interval: The max number of seconds a batch stays open.
+
+    """
+    def __init__(self, mode='none', batch_files=BATCH_FILES,
+                 batch_interval=BATCH_INTERVAL, stats=None):
+        if mode not in DURABILITY_MODES:
+            raise ValueError('Unknown durability mode: %s' % mode)
+        self.mode = mode
+        self._batch_files = batch_files
+        self._batch_interval = batch_interval
+        if stats is None:
+            stats = NULL_STATS
+        self._stats = stats
+        self._pending_files = []
+        self._pending_directories = set()
+        self._batch_started = None
+
+    def file_written(self, fileobj):
+        """Called with a file's object once all its content is written."""
+        if self.mode != 'file':
+            return
+        start = self._stats.start()
+        fileobj.flush()
+        _fdatasync(fileobj.fileno())
+        self._stats.stop('sync', start)
+
+    def file_committed(self, filename, new_directories=()):
+        """Called once a file has been committed to its final location.
+
+        ``new_directories`` are any directories that had to be created
+        for the file, each of which also needs its own parent synced.
+        """
+        if self.mode == 'none':
+            return
+        directories = set([os.path.dirname(filename)])
+        for directory in new_directories:
+            directories.add(directory)
+            directories.add(os.path.dirname(directory))
+        if self.mode == 'file':
+            start = self._stats.start()
+            for directory in directories:
+                sync_directory(directory)
+            self._stats.stop('sync', start)
+            return
+        if self._batch_started is None:
+            self._batch_started = time.time()
+        self._pending_files.append(filename)
+        self._pending_directories.update(directories)
+
+    def barrier_due(self):
+        if self._batch_started is None:
+            return False
+        return len(self._pending_files) >= self._batch_files or \
+            time.time() - self._batch_started >= self._batch_interval
+
+    def barrier(self, extra_files=()):
+        """Make every committed file durable.
+
+        ``extra_files`` are also synced, which is how the manifest is
+        kept in step with the files it lists.
+        """
+        if self.mode == 'none':
+            return
+        start = self._stats.start()
+        if self.mode == 'syncfs':
+            paths = list(self._pending_files) + list(extra_files)
+            if paths:
+                syncfs(paths[0])
+        else:
+            if self.mode == 'batch':
+                for filename in self._pending_files:
+                    sync_file(filename)
+            for filename in extra_files:
+                sync_file(filename)
+            for directory in self._pending_directories:
+                sync_directory(directory)
+        self._stats.stop('sync', start, len(self._pending_files))
+        self._pending_files = []
+        self._pending_directories = set()
+        self._batch_started = None
+
+    def sync_metadata(self, filenames, directories):
+        """Sync metadata files, e.g. the roots, as soon as they're written."""
+        if self.mode == 'none':
+            return
+        for filename in filenames:
+            sync_file(filename)
+        for directory in directories:
+            sync_directory(directory)
@@ -1,31 +1,155 @@
 """Generate content addressable files.
 
-The path to each file is the hex digest of the sha1 of the file's contents.
+The path to each file is the hex digest of the file's contents, using the
+tree's hash algorithm (sha1 by default, see ``caf.hashes``).
 
-Given the hex digest, the path is split into 4 sub directories consisting of 1
-byte each, and the remaining 16 bytes are used for the file name.
+Given the hex digest, the path is split into sub directories according to
+the tree's layout (see ``caf.layout``), and the rest of the digest is used
+for the file name.  With the default layout of 2 sub directories consisting
+of 1 byte each, a file with a digest of "abcdefabcdefabcd" would have a
+path of "ab/cd/efabcdefabcd".
 
-For example, a file with a sha1 of "abcdefabcdefabcd" would have a path of
-"ab/cd/ef/ab/cdefabcd".
+As for the contents of the file, each file has the digest of the parent
+file as its header (the first 20 bytes with sha1), followed by randomly
+generated content.
 
-As for the contents of the file, each file has the sha1 of the parent file
-as the first 20 bytes, followed by randomly generated content.
+A record of each file's digest, parent digest and size is also appended to
+the binary manifest in ``.metadata/manifest`` (see ``caf.manifest``).
+
+Files are written to ``.metadata/tmp`` on the same filesystem as the final
+location, and committed with a single link or rename (see ``caf.staging``).
+
+Files are optionally synced, either one at a time or in batches (see
+``caf.durability``).
+
+Instead of a file for each digest, files can also be stored as objects in
+pack files (see ``caf.pack``).
+
+Each chain is checkpointed as it's generated, so an interrupted run can be
+resumed (see ``caf.checkpoint``).
+
+Large files are preallocated and written with aligned writes, with hashing
+on a separate thread (see ``caf.writer``).
 
 
 """
 import os
+import sys
+import time
+import ctypes
+import random
 import shutil
-from binascii import hexlify
-from random import randint
+import traceback
+from binascii import hexlify, unhexlify
 import tempfile
-import hashlib
 
-from caf.utils import cd
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from caf.checkpoint import Checkpointer, ChainState, CHECKPOINT_FILES, \
+    new_run_id, interrupted_runs, lock_run, write_run, read_run, \
+    remove_run
+from caf.content import create_content_source, UrandomSource
+from caf.durability import DurabilityPolicy
+from caf.hashes import SHA1, write_hash
+from caf.layout import DEFAULT_LAYOUT
+from caf.manifest import ManifestWriter, MANIFEST_FILE
+from caf.pack import PackWriter, PACKS_DIR, PACK_SIZE, write_storage, \
+    pack_checksum, pack_filename, index_filename
+from caf.roots import RootsLog
+from caf.sizes import SizeSampler
+from caf.staging import Stager, STAGING_DIR
+from caf.stats import NULL_STATS
+from caf.throttle import NULL_THROTTLE
+from caf.utils import cd, fork_context
+from caf.writer import LargeFileWriter, LARGE_FILE_SIZE
 
 
 BUFFER_WRITE_SIZE = 1024 * 1024
 BUFFER_READ_SIZE = 1024 * 1024
 TEMP_DIR = tempfile.gettempdir()
+# How often worker processes send their stats to the parent process.
+STATS_SEND_INTERVAL = 1
+
+
+class GenerationBudget(object):
+    """Track the stopping conditions for a generation run.
+
+    Every file must be reserved before it's written.  Once either the
+    max files or the max disk usage is reached, no more files can be
+    reserved.
+    """
+    def __init__(self, max_files, max_disk_usage, files_created=0,
+                 disk_space_bytes_used=0):
+        self._max_files = max_files
+        self._max_disk_usage = max_disk_usage
+        self.files_created = files_created
+        self.disk_space_bytes_used = disk_space_bytes_used
+
+    def reserve(self, file_size):
+        if self.files_created >= self._max_files or \
+                self.disk_space_bytes_used >= self._max_disk_usage:
+            return False
+        self.files_created += 1
+        self.disk_space_bytes_used += file_size
+        return True
+
+
+class SharedGenerationBudget(GenerationBudget):
+    """A generation budget that can be shared across processes.
+
+    The counters live in shared memory and are guarded by a single
+    lock so that the stopping conditions are exact no matter how many
+    workers are drawing from the budget.
+    """
+    def __init__(self, max_files, max_disk_usage, files_created=0,
+                 disk_space_bytes_used=0):
+        self._max_files = max_files
+        self._max_disk_usage = max_disk_usage
+        context = fork_context()
+        self._lock = context.Lock()
+        self._files_created = context.Value(
+            ctypes.c_ulonglong, files_created, lock=False)
+        self._disk_space_bytes_used = context.Value(
+            ctypes.c_ulonglong, disk_space_bytes_used, lock=False)
+
+    @property
+    def files_created(self):
+        return self._files_created.value
+
+    @property
+    def disk_space_bytes_used(self):
+        return self._disk_space_bytes_used.value
+
+    def reserve(self, file_size):
+        with self._lock:
+            if self._files_created.value >= self._max_files or \
+                    self._disk_space_bytes_used.value >= \
+                    self._max_disk_usage:
+                return False
+            self._files_created.value += 1
+            self._disk_space_bytes_used.value += file_size
+            return True
+
+
+def _generate_worker(generator, budget, results, worker_index):
+    # Each forked worker starts with a copy of the parent's random
+    # state, so reseed or every worker will pick the same file sizes
+    # and temp file names.
+    random.seed()
+
+    def send_stats(snapshot):
+        results.put(('stats', snapshot))
+
+    try:
+        root = generator._generate_chain(budget, worker_index,
+                                         send_stats=send_stats)
+        results.put(('ok', (root, generator._stats.snapshot())))
+    except BaseException:
+        results.put(('error', traceback.format_exc()))
+        sys.exit(1)
 
 
 class FileGenerator(object):
@@ -36,111 +160,505 @@ class FileGenerator(object):
 
     This is handled because the files are randomly generated, so the
     chance of collision is extremely small.
-    """
 
-    ROOT_HASH = b'\x00' * 20
-    BUFFER_WRITE_SIZE = 1024 * 1024
-    ROOTS_DIR = os.path.join('.metadata', 'roots')
+    ``file_size_chooser`` is a ``caf.sizes.SizeDistribution``, or any
+    no-arg callable that returns a file size.
+
+    If ``workers`` is greater than 1, then ``generate_files`` will fork
+    that many processes, each building its own chain of files.  The
+    max files/max disk usage budget is shared across all the workers.
+
+    The random content of each file comes from ``content_source``, one of
+    the names in ``caf.content.CONTENT_SOURCES``.  If ``seed`` is given,
+    the file sizes are seeded from it as well so that a single worker run
+    with the ``seeded`` content source is reproducible.
+
+    The time spent in each phase of generating a file ("rng", "hash",
+    "write", "mkdir" and "commit", along with "file" for the whole file) is
+    recorded in ``stats`` (see ``caf.stats``).
+
+    ``durability`` is one of ``caf.durability.DURABILITY_MODES``.  The
+    roots are only written after every worker's final barrier.
 
+    Files are placed according to ``layout`` (a ``caf.layout.Layout``),
+    which is recorded in the rootdir.  If ``storage`` is "pack", files
+    are instead appended as objects to pack files of up to ``pack_size``
+    bytes, one pack at a time for each worker.
+
+    Each chain is checkpointed every ``checkpoint_files`` files (or after
+    each pack).  With ``resume``, the oldest interrupted run in the
+    rootdir is continued from its checkpoints instead of starting new
+    chains, with one worker for each of its chains, and counting the
+    files it already generated towards ``max_files`` and
+    ``max_disk_usage``.
+
+    Every write is limited by ``throttle`` (a ``caf.throttle.Throttle``),
+    which is shared by all the workers.
+
+    Files are written ``buffer_write_size`` bytes at a time.  Files of at
+    least ``large_file_size`` bytes are written by a
+    ``caf.writer.LargeFileWriter`` instead, which preallocates them and
+    rounds the buffer size up to a multiple of
+    ``caf.writer.WRITE_ALIGNMENT``.  With pack
+    storage, every object is written the same way as a small file.
+    """
     def __init__(self, rootdir, max_files, max_disk_usage,
                  file_size_chooser, buffer_write_size=BUFFER_WRITE_SIZE,
-                 temp_dir=None):
+                 temp_dir=None, workers=1, content_source='urandom',
+                 seed=None, stats=None, durability='none',
+                 durability_batch_files=None, durability_interval=None,
+                 layout=DEFAULT_LAYOUT, storage='files',
+                 pack_size=PACK_SIZE, checkpoint_files=CHECKPOINT_FILES,
+                 resume=False, hash_algorithm=SHA1, throttle=None,
+                 large_file_size=LARGE_FILE_SIZE):
         if max_files is None:
             max_files = float('inf')
         if max_disk_usage is None:
             max_disk_usage = float('inf')
-        self._rootdir = rootdir
+        # Generation runs from within the rootdir, so make sure
+        # the paths we build from it don't depend on the cwd.
+        self._rootdir = os.path.abspath(rootdir)
         self._max_files = max_files
         self._max_disk_usage = max_disk_usage
         self._file_size_chooser = file_size_chooser
         self._buffer_write_size = buffer_write_size
         self._temp_dir = temp_dir
+        self._workers = workers
+        self._content_source = content_source
+        self._seed = seed
+        if stats is None:
+            stats = NULL_STATS
+        self._stats = stats
+        if throttle is None:
+            throttle = NULL_THROTTLE
+        self._throttle = throttle
+        self._large_file_size = large_file_size
+        self._large_file_writer = LargeFileWriter(hash_algorithm, stats,
+                                                  throttle)
+        batch_options = {}
+        if durability_batch_files is not None:
+            batch_options['batch_files'] = durability_batch_files
+        if durability_interval is not None:
+            batch_options['batch_interval'] = durability_interval
+        self._durability = DurabilityPolicy(durability, stats=stats,
+                                            **batch_options)
+        self._layout = layout
+        self._storage = storage
+        self._pack_size = pack_size
+        self._checkpoint_files = checkpoint_files
+        self._hash = hash_algorithm
+        self._root_hash = hash_algorithm.root_hash
+        self._resume = resume
+        self._run_id = None
+        self._staging_dir = None
+        # The resumed state of each chain, if any.
+        self._chains = None
+        # The leaf directories that are known to exist, so we only
+        # have to check for them the first time they're used.
+        self._existing_directories = set()
 
     def generate_files(self):
-        temp_dir = self._temp_dir
-        if temp_dir is None:
-            # Use the current woroking directory as the
-            # temp dir.
-            temp_dir = os.getcwd()
+        """Generate the files, and return the hex digests of the roots."""
+        # The run stays locked until it's finished, so another
+        # --resume can't take it over while it's live.
+        if self._resume:
+            run_lock = None
+            for run_id in interrupted_runs(self._rootdir):
+                run_lock = lock_run(self._rootdir, run_id)
+                if run_lock is not None:
+                    break
+            if run_lock is None:
+                raise ValueError('There is no interrupted run to resume.')
+            self._run_id = run_id
+        else:
+            self._run_id = new_run_id()
+            run_lock = write_run(self._rootdir, self._run_id, self._workers)
+        try:
+            return self._generate_run()
+        finally:
+            os.close(run_lock)
+
+    def _generate_run(self):
+        if self._resume:
+            self._chains = self._load_chains(read_run(self._rootdir,
+                                                      self._run_id))
+            self._workers = len(self._chains)
+        else:
+            self._chains = [None] * self._workers
+        # Each run stages files in a directory of its own, so the stray
+        # files of an interrupted run can be cleaned up.
+        self._staging_dir = os.path.join(self._rootdir, STAGING_DIR,
+                                         self._run_id)
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+        self._ensure_directory_exists(self._staging_dir)
+        layout_filename = self._layout.write(self._rootdir)
+        storage_filename = write_storage(self._rootdir, self._storage)
+        hash_filename = write_hash(self._rootdir, self._hash)
+        if self._storage == 'pack':
+            self._ensure_directory_exists(
+                os.path.join(self._rootdir, PACKS_DIR))
+        self._durability.sync_metadata(
+            [layout_filename, storage_filename, hash_filename], [])
         with cd(self._rootdir):
-            files_created = 0
-            file_size_chooser = self._file_size_chooser
-            disk_space_bytes_used = 0
-            sha1_hash = self.ROOT_HASH
-            while files_created < self._max_files and \
-                    disk_space_bytes_used < self._max_disk_usage:
+            if self._workers > 1:
+                roots = self._generate_chains_in_parallel()
+            else:
+                budget = GenerationBudget(self._max_files,
+                                          self._max_disk_usage,
+                                          *self._resumed_totals())
+                roots = [self._generate_chain(budget)]
+            roots = [root for root in roots if root is not None]
+            # Record the roots so we know when we validate
+            # that these files are not suppose to have
+            # anything referring to them.
+            self._write_root_shas(roots)
+        remove_run(self._rootdir, self._run_id)
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+        return roots
+
+    def _load_chains(self, num_chains):
+        chains = []
+        for chain in range(num_chains):
+            checkpointer = Checkpointer(self._rootdir, self._run_id, chain,
+                                        algorithm=self._hash)
+            if self._storage == 'pack':
+                state = checkpointer.load(
+                    self._root_hash, pack_committed=self._pack_committed)
+            else:
+                state = checkpointer.load(
+                    self._root_hash,
+                    committed=lambda digest: os.path.exists(os.path.join(
+                        self._rootdir, self._layout.hash_to_file_path(
+                            hexlify(digest).decode('ascii')))))
+            chains.append(state)
+        return chains
+
+    def _pack_committed(self, checksum):
+        filename = pack_filename(os.path.join(self._rootdir, PACKS_DIR),
+                                 checksum)
+        if os.path.exists(filename):
+            return True
+        # The index is moved into place first, so the run may have been
+        # interrupted in between.
+        try:
+            os.remove(index_filename(filename))
+        except OSError:
+            pass
+        return False
+
+    def _resumed_totals(self):
+        files = disk_usage = 0
+        for state in self._chains:
+            if state is not None:
+                files += state.files
+                disk_usage += state.disk_usage
+        return files, disk_usage
+
+    def _generate_chains_in_parallel(self):
+        budget = SharedGenerationBudget(self._max_files,
+                                        self._max_disk_usage,
+                                        *self._resumed_totals())
+        context = fork_context()
+        results = context.Queue()
+        workers = [
+            context.Process(target=_generate_worker,
+                            args=(self, budget, results, i))
+            for i in range(self._workers)]
+        for worker in workers:
+            worker.start()
+        roots = []
+        errors = []
+        while len(roots) + len(errors) < len(workers):
+            try:
+                status, value = results.get(timeout=1)
+            except Empty:
+                if not any(worker.is_alive() for worker in workers) and \
+                        results.empty():
+                    errors.append('Worker exited without a result.')
+                continue
+            if status == 'stats':
+                self._stats.merge(value)
+            elif status == 'ok':
+                root, stats_snapshot = value
+                roots.append(root)
+                self._stats.merge(stats_snapshot)
+            else:
+                errors.append(value)
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise RuntimeError(
+                'File generation failed in %s worker(s):\n%s' % (
+                    len(errors), '\n'.join(errors)))
+        return roots
+
+    def _generate_chain(self, budget, worker_index=0, send_stats=None):
+        """Generate a single chain of files.
+
+        Files are generated until ``budget`` refuses a reservation.
+        The hex digest of the last file in the chain is returned, or
+        ``None`` if no files were generated.
+
+        If ``send_stats`` is given, it's periodically called with a
+        snapshot of the stats recorded since it was last called.
+
+        """
+        if self._temp_dir is None:
+            # Stage files on the same filesystem as the rootdir so
+            # committing a file never has to copy it.
+            stager = Stager(self._staging_dir)
+        else:
+            stager = Stager(self._temp_dir, use_tmpfile=False)
+        if self._seed is not None:
+            random.seed('%s-%s' % (self._seed, worker_index))
+        content_source = create_content_source(
+            self._content_source, self._seed, worker_index)
+        packer = None
+        if self._storage == 'pack':
+            packer = PackWriter(os.path.join(self._rootdir, PACKS_DIR),
+                                self._staging_dir, self._pack_size,
+                                self._hash)
+        chain = self._chains[worker_index]
+        if chain is None:
+            chain = ChainState(self._root_hash)
+        # Created after seeding, so the sizes are seeded too.
+        file_size_chooser = SizeSampler(self._file_size_chooser,
+                                        state=chain.sampler_state)
+        checkpointer = Checkpointer(self._rootdir, self._run_id,
+                                    worker_index, self._checkpoint_files,
+                                    self._hash)
+        manifest_filename = os.path.join(self._rootdir, MANIFEST_FILE)
+        manifest = ManifestWriter(manifest_filename, self._hash.digest_size)
+        self._replay_chain(chain, file_size_chooser, manifest)
+        durability = self._durability
+        stats = self._stats
+        last_sent_stats = time.time()
+        file_hash = chain.tip
+        ascii_hex_basename = None
+        if file_hash != self._root_hash:
+            ascii_hex_basename = hexlify(file_hash).decode('ascii')
+        try:
+            while True:
                 file_size = file_size_chooser()
-                temp_filename, sha1_hash = self.generate_single_file_link(
-                    sha1_hash, file_size=file_size,
-                    buffer_size=self.BUFFER_WRITE_SIZE,
-                    temp_dir=temp_dir)
-                ascii_hex_basename = hexlify(sha1_hash).decode('ascii')
-                self._move_to_final_location(
-                    temp_filename, ascii_hex_basename)
-                files_created += 1
-                disk_space_bytes_used += file_size
-            # Write out the root file in the special
-            # metadata/roots/ directory so we know when
-            # we validate that this file is not suppose
-            # to have anything referring to it.
-            self._write_root_sha(ascii_hex_basename)
-
-    def _write_root_sha(self, filename):
-        directory_name = os.path.join(self._rootdir, self.ROOTS_DIR)
+                parent_hash = file_hash
+                # Files smaller than the header are stored as just the
+                # header, so that's what counts towards the budget.
+                stored_size = max(file_size, len(parent_hash))
+                if not budget.reserve(stored_size):
+                    break
+                file_start = stats.start()
+                if packer is None:
+                    staged_file, file_hash = self.generate_single_file_link(
+                        parent_hash, file_size=file_size,
+                        buffer_size=self._buffer_write_size,
+                        stager=stager, content_source=content_source)
+                    ascii_hex_basename = hexlify(file_hash).decode('ascii')
+                    checkpointer.record(file_hash, stored_size)
+                    self._move_to_final_location(
+                        staged_file, ascii_hex_basename)
+                else:
+                    file_hash = self.generate_single_pack_object(
+                        parent_hash, file_size=file_size,
+                        buffer_size=self._buffer_write_size,
+                        packer=packer, content_source=content_source,
+                        checkpointer=checkpointer)
+                    ascii_hex_basename = hexlify(file_hash).decode('ascii')
+                manifest.add(file_hash, parent_hash, stored_size)
+                stats.stop('file', file_start, stored_size)
+                chain.tip = file_hash
+                chain.files += 1
+                chain.disk_usage += stored_size
+                if packer is None:
+                    checkpoint_due = checkpointer.checkpoint_due()
+                else:
+                    # Objects are only committed once their pack is.
+                    checkpoint_due = not packer.pack_in_progress
+                if checkpoint_due:
+                    manifest.flush()
+                    # Every file up to the checkpoint has to be durable
+                    # before the checkpoint is.
+                    durability.barrier(
+                        [manifest_filename] +
+                        checkpointer.journal_filenames())
+                    chain.sampler_state = file_size_chooser.state()
+                    checkpointer.checkpoint(chain, durability)
+                elif durability.barrier_due():
+                    manifest.flush()
+                    durability.barrier(
+                        [manifest_filename] +
+                        checkpointer.journal_filenames())
+                if send_stats is not None and \
+                        time.time() - last_sent_stats >= STATS_SEND_INTERVAL:
+                    send_stats(stats.snapshot())
+                    stats.reset()
+                    last_sent_stats = time.time()
+            if packer is not None:
+                self._finish_pack(packer)
+        except BaseException:
+            if packer is not None:
+                packer.abort()
+            raise
+        finally:
+            manifest.close()
+            checkpointer.close()
+        # The root of this chain can't be written until every file
+        # in the chain is durable.
+        if os.path.exists(manifest_filename):
+            durability.barrier([manifest_filename])
+        else:
+            durability.barrier()
+        return ascii_hex_basename
+
+    def _replay_chain(self, chain, file_size_chooser, manifest):
+        # The files a resumed chain committed after its last checkpoint
+        # may not have made it into the manifest, or be durable yet.
+        # They each used a file size from the sampler too.
+        packs_dir = os.path.join(self._rootdir, PACKS_DIR)
+        for digest, parent, size in chain.replayed:
+            file_size_chooser()
+            manifest.add(digest, parent, size)
+            if self._storage != 'pack':
+                self._durability.file_committed(os.path.join(
+                    self._rootdir, self._layout.hash_to_file_path(
+                        hexlify(digest).decode('ascii'))))
+        if chain.replayed and self._storage == 'pack':
+            filename = pack_filename(packs_dir, pack_checksum(
+                [(digest, size) for digest, _, size in chain.replayed],
+                self._hash))
+            self._durability.file_committed(filename)
+            self._durability.file_committed(index_filename(filename))
+
+    def _ensure_directory_exists(self, directory_name):
         if not os.path.isdir(directory_name):
             try:
                 os.makedirs(directory_name)
             except OSError:
                 pass
         assert os.path.isdir(directory_name)
-        with open(os.path.join(directory_name, filename), 'w') as f:
-            pass
-        # This is the only part we have to lock.  If we have multiple roots
-        # being written out, the only way we can validate that an entire
-        # chain from root->start hasn't been completely removed (even though
-        # it's extremely unlikely) is to have a file that can be used
-        # to validate that all the root file are accounted for.
-        # TODO: Actually lock the file.
-        roots_hash = hashlib.sha1()
-        for filename in os.listdir(directory_name):
-            roots_hash.update(filename.encode('ascii'))
-        final_roots_hash = roots_hash.hexdigest()
-        with open(os.path.join(self._rootdir, '.metadata', 'all'), 'wb') as f:
-            f.write(final_roots_hash.encode('ascii'))
-
-    def _move_to_final_location(self, temp_filename, ascii_hex_basename):
-        # This is not exposed as a config option (yet),
-        # given a full sha1 hash, this translates to:
+
+    def _write_root_shas(self, filenames):
+        # Other gen runs may be adding roots to the same rootdir,
+        # so the roots log is appended to under a lock (see caf.roots).
+        roots_log = RootsLog(self._rootdir, self._hash)
+        roots_log.append([unhexlify(filename.encode('ascii'))
+                          for filename in filenames])
+        self._durability.sync_metadata(
+            [roots_log.filename, roots_log.all_filename],
+            [os.path.dirname(roots_log.all_filename)])
+
+    def _move_to_final_location(self, staged_file, ascii_hex_basename):
+        start = self._stats.start()
+        # Given a full hex digest and the default layout,
+        # this translates to:
         #
         #   ab/cd/<remaining hash>
+        layout = self._layout
         directory_part = os.path.join(
-            self._rootdir, ascii_hex_basename[:2],
-            ascii_hex_basename[2:4])
-        basename = ascii_hex_basename[4:]
-        if not os.path.isdir(directory_part):
-            try:
-                os.makedirs(directory_part)
-            except OSError:
-                pass
-        assert os.path.isdir(directory_part)
+            self._rootdir, *layout.directory_parts(ascii_hex_basename))
+        basename = ascii_hex_basename[layout.depth * layout.width:]
+        new_directories = ()
+        if directory_part not in self._existing_directories:
+            mkdir_start = self._stats.start()
+            self._ensure_directory_exists(directory_part)
+            self._existing_directories.add(directory_part)
+            # We don't know whether this worker (or another one)
+            # created them, so they all need to be synced.
+            new_directories = []
+            directory = directory_part
+            while directory != self._rootdir:
+                new_directories.append(directory)
+                directory = os.path.dirname(directory)
+            self._stats.stop('mkdir', mkdir_start)
         final_filename = os.path.join(directory_part, basename)
-        shutil.move(temp_filename, final_filename)
+        staged_file.commit(final_filename)
+        self._stats.stop('commit', start)
+        self._durability.file_committed(final_filename, new_directories)
+
+    def _finish_pack(self, packer):
+        start = self._stats.start()
+        filenames = packer.finish_pack()
+        self._stats.stop('pack', start)
+        if filenames is not None:
+            for filename in filenames:
+                self._durability.file_committed(filename)
+
+    def generate_single_pack_object(self, parent_hash, file_size,
+                                    buffer_size, packer,
+                                    content_source=None, checkpointer=None):
+        """Append a single object whose header is ``parent_hash`` to a pack.
+
+        Returns the object's digest.  If ``checkpointer`` is given,
+        the object is journaled before it can be committed.
+
+        """
+        f = packer.begin_object(max(file_size, len(parent_hash)))
+        digest = self._write_contents(f, parent_hash, file_size,
+                                      buffer_size, content_source)
+        self._durability.file_written(f)
+        if checkpointer is not None:
+            checkpointer.record(digest, max(file_size, len(parent_hash)))
+        start = self._stats.start()
+        filenames = packer.end_object(digest)
+        self._stats.stop('commit', start)
+        if filenames is not None:
+            # That object filled up the pack.
+            for filename in filenames:
+                self._durability.file_committed(filename)
+        return digest
 
     def generate_single_file_link(self, parent_hash, file_size,
-                                  buffer_size, temp_dir):
-        sha1 = hashlib.sha1(parent_hash)
+                                  buffer_size, stager,
+                                  content_source=None):
+        """Write a single file whose header is ``parent_hash``.
+
+        Returns a tuple of the staged file, which still needs to be
+        committed to its final location, and the file's digest.
+
+        """
+        staged_file = stager.new_file()
+        try:
+            f = staged_file.fileobj
+            if file_size >= self._large_file_size:
+                if content_source is None:
+                    content_source = UrandomSource()
+                digest = self._large_file_writer.write(
+                    f.fileno(), parent_hash, file_size, buffer_size,
+                    content_source)
+            else:
+                digest = self._write_contents(f, parent_hash, file_size,
+                                              buffer_size, content_source)
+            self._durability.file_written(f)
+        except BaseException:
+            staged_file.discard()
+            raise
+        return staged_file, digest
+
+    def _write_contents(self, f, parent_hash, file_size, buffer_size,
+                        content_source=None):
+        # Write the parent hash followed by random content, and
+        # return the digest of everything that was written.
+        if content_source is None:
+            content_source = UrandomSource()
+        stats = self._stats
+        throttle = self._throttle
+        content_hash = self._hash.new(parent_hash)
         amount_remaining = file_size
-        temp_filename = os.path.join(
-            temp_dir,
-            hexlify(parent_hash[:8]).decode('ascii') + str(randint(1, 100000)))
-
-        with open(temp_filename, 'wb') as f:
-            f.write(parent_hash)
-            amount_remaining -= len(parent_hash)
-            while amount_remaining > 0:
-                chunk_size = min(buffer_size, amount_remaining)
-                random_data = os.urandom(chunk_size)
-                f.write(random_data)
-                sha1.update(random_data)
-                amount_remaining -= chunk_size
-        return temp_filename, sha1.digest()
+        start = stats.start()
+        f.write(parent_hash)
+        stats.stop('write', start, len(parent_hash))
+        amount_remaining -= len(parent_hash)
+        while amount_remaining > 0:
+            chunk_size = min(buffer_size, amount_remaining)
+            start = stats.start()
+            random_data = content_source.read(chunk_size)
+            stats.stop('rng', start, chunk_size)
+            start = stats.start()
+            io_start = throttle.start()
+            f.write(random_data)
+            stats.stop('write', start, chunk_size)
+            throttle.stop(io_start, chunk_size)
+            start = stats.start()
+            content_hash.update(random_data)
+            stats.stop('hash', start, chunk_size)
+            amount_remaining -= chunk_size
+        return content_hash.digest()
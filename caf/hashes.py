@@ -0,0 +1,90 @@
+"""The hash algorithm that names generated files.
+
+``caf gen --hash`` picks the algorithm, which is recorded along with its
+digest size in ``.metadata/hash`` as ``<name> <digest size>``.  Trees
+generated before the hash was recorded use sha1.
+
+The digest size sets the size of each file's header (its parent's
+digest), the length of the hex digest each file is named after, and the
+size of every digest in the manifest, packs, roots log and the other
+metadata files.  blake2b is used with a 32 byte digest (BLAKE2b-256).
+Which algorithm is fastest depends on the CPU: blake2b is usually the
+fastest in software, while sha256 wins on CPUs with the SHA extensions.
+``caf bench --hash`` measures each of them.
+
+"""
+import os
+import hashlib
+import functools
+
+
+HASH_FILE = os.path.join('.metadata', 'hash')
+DEFAULT_HASH = 'sha1'
+BLAKE2B_DIGEST_SIZE = 32
+
+
+class HashAlgorithm(object):
+    def __init__(self, name, digest_size, constructor):
+        self.name = name
+        self.digest_size = digest_size
+        # Called with the initial data to create a hash object.
+        self.new = constructor
+        # The parent of the first file in a chain.
+        self.root_hash = b'\x00' * digest_size
+
+    def __str__(self):
+        return '%s %s' % (self.name, self.digest_size)
+
+    def __eq__(self, other):
+        return isinstance(other, HashAlgorithm) and \
+            (self.name, self.digest_size) == (other.name, other.digest_size)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+HASHES = {
+    'sha1': HashAlgorithm('sha1', 20, hashlib.sha1),
+    'sha256': HashAlgorithm('sha256', 32, hashlib.sha256),
+}
+if hasattr(hashlib, 'blake2b'):
+    HASHES['blake2b'] = HashAlgorithm(
+        'blake2b', BLAKE2B_DIGEST_SIZE,
+        functools.partial(hashlib.blake2b, digest_size=BLAKE2B_DIGEST_SIZE))
+HASH_ALGORITHMS = sorted(HASHES)
+SHA1 = HASHES[DEFAULT_HASH]
+
+
+def get_hash(name):
+    try:
+        return HASHES[name]
+    except KeyError:
+        raise ValueError('Unknown hash algorithm: %s' % name)
+
+
+def read_hash(rootdir):
+    """Return the ``HashAlgorithm`` of a tree, which is sha1 if not recorded.
+
+    ``ValueError`` is raised if the recorded algorithm isn't supported.
+    """
+    try:
+        with open(os.path.join(rootdir, HASH_FILE)) as f:
+            contents = f.read().split()
+    except (IOError, OSError):
+        return SHA1
+    if len(contents) != 2:
+        raise ValueError('Invalid hash file: %s' % ' '.join(contents))
+    algorithm = get_hash(contents[0])
+    if str(algorithm.digest_size) != contents[1]:
+        raise ValueError('Unsupported digest size for %s: %s' % (
+            contents[0], contents[1]))
+    return algorithm
+
+
+def write_hash(rootdir, algorithm):
+    filename = os.path.join(rootdir, HASH_FILE)
+    temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        f.write(str(algorithm) + '\n')
+    os.rename(temp_filename, filename)
+    return filename
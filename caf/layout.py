@@ -0,0 +1,108 @@
+"""The directory layout of a tree of generated files.
+
+A file's path is its hex digest split into ``depth`` directories of
+``width`` hex characters each, with the rest of the digest as the file
+name.  The default layout has a depth of 2 and a width of 2, e.g. the file
+with a digest of "abcdef0123..." is at "ab/cd/ef0123...", which gives
+65,536 leaf directories.
+
+Trees with billions of files need more (or wider) levels to keep each leaf
+directory small, so the layout can be chosen when the tree is first
+generated with ``caf gen --layout depth=N,width=K``.  The layout is
+recorded in ``.metadata/layout`` so the verifier can find each file.  A
+tree without a recorded layout uses the default layout.
+
+"""
+import os
+
+
+LAYOUT_FILE = os.path.join('.metadata', 'layout')
+# The shortest hex digest of any hash algorithm (sha1).
+HEX_DIGEST_SIZE = 40
+
+
+class Layout(object):
+    def __init__(self, depth=2, width=2):
+        if depth < 0 or width < 1:
+            raise ValueError('The layout depth must be at least 0 and '
+                             'the width at least 1.')
+        if depth * width >= HEX_DIGEST_SIZE:
+            raise ValueError('The layout must leave part of the digest '
+                             'for the file name.')
+        self.depth = depth
+        self.width = width
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse a layout spec such as "depth=3,width=2"."""
+        values = {}
+        for part in spec.split(','):
+            key, sep, value = part.partition('=')
+            key = key.strip().lower()
+            if not sep or key not in ('depth', 'width'):
+                raise ValueError('Invalid layout: %s' % spec)
+            try:
+                values[key] = int(value)
+            except ValueError:
+                raise ValueError('Invalid layout: %s' % spec)
+        return cls(**values)
+
+    def __str__(self):
+        return 'depth=%s,width=%s' % (self.depth, self.width)
+
+    def __repr__(self):
+        return 'Layout(depth=%r, width=%r)' % (self.depth, self.width)
+
+    def __eq__(self, other):
+        return isinstance(other, Layout) and \
+            (self.depth, self.width) == (other.depth, other.width)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def directory_parts(self, hex_hash):
+        """Return the directory names of a hex digest's path."""
+        width = self.width
+        return [hex_hash[i * width:(i + 1) * width]
+                for i in range(self.depth)]
+
+    def hash_to_file_path(self, hex_hash):
+        parts = self.directory_parts(hex_hash)
+        parts.append(hex_hash[self.depth * self.width:])
+        return os.path.join(*parts)
+
+    def file_path_to_hash(self, filename):
+        # Only the last depth + 1 parts of the path are the digest, so
+        # the filename can be relative to any directory.
+        return ''.join(filename.split(os.sep)[-(self.depth + 1):])
+
+    def write(self, rootdir):
+        filename = os.path.join(rootdir, LAYOUT_FILE)
+        # Replaced atomically, since concurrent runs (e.g. the workers of
+        # caf churn) rewrite it while others read it.
+        temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        with open(temp_filename, 'w') as f:
+            f.write(str(self) + '\n')
+        os.rename(temp_filename, filename)
+        return filename
+
+
+DEFAULT_LAYOUT = Layout()
+
+
+def read_layout(rootdir):
+    """Return the layout recorded for a tree, or ``None`` if there isn't one.
+    """
+    try:
+        with open(os.path.join(rootdir, LAYOUT_FILE)) as f:
+            return Layout.parse(f.read().strip())
+    except (IOError, OSError):
+        return None
+
+
+def load_layout(rootdir):
+    """Return the layout of a tree, which is the default if not recorded."""
+    layout = read_layout(rootdir)
+    if layout is None:
+        return DEFAULT_LAYOUT
+    return layout
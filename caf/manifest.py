@@ -0,0 +1,129 @@
+"""A binary manifest of generated files.
+
+The manifest lives in ``.metadata/manifest`` and is a sequence of fixed
+width records, one for each generated file::
+
+    <digest><parent digest><size as a big endian uint64>
+
+``caf gen`` appends records as files are generated.  Records are buffered
+and each batch is written with a single ``write()`` to a file opened with
+``O_APPEND`` while holding an exclusive ``flock()``, so any number of
+concurrent writers can share the same manifest.
+
+``caf churn`` deletes chains of files, and ``compact_manifest`` removes
+their records by writing a new manifest and renaming it over the old one
+while holding the same lock.  So once a writer has the lock, it checks
+that the file it opened is still the manifest, and opens it again if
+it's been replaced.
+
+"""
+import os
+import fcntl
+import struct
+
+
+MANIFEST_FILE = os.path.join('.metadata', 'manifest')
+FLUSH_RECORDS = 1024
+READ_BLOCK_RECORDS = 4096
+
+
+def record_struct(digest_size=20):
+    return struct.Struct('>%ss%ssQ' % (digest_size, digest_size))
+
+
+class ManifestWriter(object):
+    def __init__(self, filename, digest_size=20,
+                 flush_records=FLUSH_RECORDS):
+        self._filename = filename
+        self._record = record_struct(digest_size)
+        self._flush_records = flush_records
+        self._pending = []
+
+    def add(self, digest, parent, size):
+        self._pending.append(self._record.pack(digest, parent, size))
+        if len(self._pending) >= self._flush_records:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        data = b''.join(self._pending)
+        self._pending = []
+        fd = _open_locked(self._filename,
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def close(self):
+        self.flush()
+
+
+def _open_locked(filename, flags):
+    # Returns an fd of the manifest with an exclusive lock held, making
+    # sure it wasn't replaced while waiting for the lock.
+    while True:
+        fd = os.open(filename, flags, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            current = os.stat(filename)
+        except OSError:
+            current = None
+        opened = os.fstat(fd)
+        if current is not None and \
+                (current.st_dev, current.st_ino) == \
+                (opened.st_dev, opened.st_ino):
+            return fd
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def compact_manifest(filename, removed, digest_size=20):
+    """Remove the records of the ``removed`` digests from a manifest.
+
+    Returns the number of records that were removed.
+    """
+    fd = _open_locked(filename, os.O_RDWR | os.O_CREAT)
+    try:
+        temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        record = record_struct(digest_size)
+        count = 0
+        with open(temp_filename, 'wb') as out:
+            kept = []
+            for fields in read_manifest(filename, digest_size):
+                if fields[0] in removed:
+                    count += 1
+                    continue
+                kept.append(record.pack(*fields))
+                if len(kept) >= READ_BLOCK_RECORDS:
+                    out.write(b''.join(kept))
+                    kept = []
+            out.write(b''.join(kept))
+            # The old manifest is gone once it's replaced, so the new
+            # one has to be on disk first.
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(temp_filename, filename)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    return count
+
+
+def read_manifest(filename, digest_size=20):
+    """Yield ``(digest, parent, size)`` tuples from a manifest.
+
+    A partial record at the end of the manifest (e.g. from a writer
+    that was interrupted) is ignored.
+    """
+    record = record_struct(digest_size)
+    block_size = record.size * READ_BLOCK_RECORDS
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            usable = len(block) - (len(block) % record.size)
+            for offset in range(0, usable, record.size):
+                yield record.unpack_from(block, offset)
@@ -0,0 +1,225 @@
+"""Store generated files as objects in pack files.
+
+With ``caf gen --storage pack``, instead of creating a file for each
+generated object, objects are appended to large pack files in the
+``packs`` directory, similar to git packs.  Generating and verifying
+small objects is then limited by sequential I/O instead of the cost of
+creating and looking up files.
+
+A pack file is::
+
+    <PACK_MAGIC>
+    <length as a big endian uint64><object contents><digest of contents>
+    ...
+    <END_OF_PACK><number of objects as a big endian uint64><checksum>
+
+The object contents are exactly what the file would contain in the normal
+storage mode, i.e. the parent's digest followed by random content.  The
+pack checksum is the digest (with the tree's hash algorithm, see
+``caf.hashes``) of every object's length and digest, in order.
+Each digest already covers its object's contents, so this covers the
+entire pack without hashing the contents twice.
+
+Each pack has an index next to it, with the same name but a ``.idx``
+extension::
+
+    <INDEX_MAGIC><number of objects as a big endian uint64>
+    <digest><offset of contents><length>
+    ...
+    <pack checksum>
+
+The index records are sorted by digest, so the objects in a pack can be
+compared with its index (or with other sorted digests) in a single pass.
+
+Packs are written to the staging directory and only moved to the packs
+directory once they're complete, after their index.  A pack's name is its
+checksum.
+
+"""
+import os
+import struct
+from binascii import hexlify
+
+from caf.hashes import SHA1
+
+
+STORAGE_FILE = os.path.join('.metadata', 'storage')
+STORAGE_TYPES = ['files', 'pack']
+PACKS_DIR = 'packs'
+PACK_SUFFIX = '.pack'
+INDEX_SUFFIX = '.idx'
+PACK_SIZE = 1024 ** 3
+
+PACK_MAGIC = b'CAFPACK1'
+INDEX_MAGIC = b'CAFIDX01'
+LENGTH = struct.Struct('>Q')
+END_OF_PACK = 2 ** 64 - 1
+COUNT = struct.Struct('>Q')
+
+
+def index_record_struct(digest_size=20):
+    # digest, offset of the object's contents, length.
+    return struct.Struct('>%ssQQ' % digest_size)
+
+
+def read_storage(rootdir):
+    """Return the storage type of a tree, which is "files" if not recorded.
+    """
+    try:
+        with open(os.path.join(rootdir, STORAGE_FILE)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return 'files'
+
+
+def write_storage(rootdir, storage):
+    filename = os.path.join(rootdir, STORAGE_FILE)
+    temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        f.write(storage + '\n')
+    os.rename(temp_filename, filename)
+    return filename
+
+
+def pack_checksum(objects, algorithm=SHA1):
+    """Return the checksum of a pack of ``(digest, length)`` objects."""
+    checksum = algorithm.new()
+    for digest, length in objects:
+        checksum.update(LENGTH.pack(length) + digest)
+    return checksum.digest()
+
+
+def pack_filename(packs_dir, checksum):
+    return os.path.join(
+        packs_dir, 'pack-' + hexlify(checksum).decode('ascii') + PACK_SUFFIX)
+
+
+def index_filename(pack_filename):
+    return pack_filename[:-len(PACK_SUFFIX)] + INDEX_SUFFIX
+
+
+class PackWriter(object):
+    """Append objects to pack files.
+
+    Each object is written with ``begin_object``, which returns the file
+    to write the object's contents to, followed by ``end_object``.  Once
+    a pack reaches ``max_pack_size`` it's finished and a new pack is
+    started with the next object.
+
+    :param packs_dir: The directory completed packs are moved to.
+    :param staging_dir: The directory packs are written to.
+
+    """
+    def __init__(self, packs_dir, staging_dir, max_pack_size=PACK_SIZE,
+                 algorithm=SHA1):
+        self._packs_dir = packs_dir
+        self._staging_dir = staging_dir
+        self._max_pack_size = max_pack_size
+        self._algorithm = algorithm
+        self._index_record = index_record_struct(algorithm.digest_size)
+        self._file = None
+        self._staged_filename = None
+        self._offset = 0
+        self._object_length = None
+        self._entries = []
+        self._checksum = None
+
+    @property
+    def pack_in_progress(self):
+        return self._file is not None
+
+    def begin_object(self, length):
+        if self._file is None:
+            self._open_pack()
+        header = LENGTH.pack(length)
+        self._file.write(header)
+        self._offset += len(header)
+        self._object_length = length
+        return self._file
+
+    def end_object(self, digest):
+        """Finish the current object.
+
+        If this finishes the pack, the filenames of the pack and its
+        index are returned.
+        """
+        length = self._object_length
+        self._file.write(digest)
+        self._entries.append(
+            self._index_record.pack(digest, self._offset, length))
+        self._checksum.update(LENGTH.pack(length) + digest)
+        self._offset += length + len(digest)
+        self._object_length = None
+        if self._offset >= self._max_pack_size:
+            return self.finish_pack()
+        return None
+
+    def finish_pack(self):
+        """Write the pack's trailer and index and move it into place.
+
+        Returns the filenames of the pack and its index, or ``None`` if
+        there's no pack being written.
+        """
+        if self._file is None:
+            return None
+        checksum = self._checksum.digest()
+        self._file.write(LENGTH.pack(END_OF_PACK) +
+                         COUNT.pack(len(self._entries)) + checksum)
+        self._file.close()
+        self._file = None
+        final_filename = pack_filename(self._packs_dir, checksum)
+        idx_filename = index_filename(final_filename)
+        staged_idx_filename = self._staged_filename + INDEX_SUFFIX
+        with open(staged_idx_filename, 'wb') as f:
+            f.write(INDEX_MAGIC + COUNT.pack(len(self._entries)))
+            self._entries.sort()
+            f.write(b''.join(self._entries))
+            f.write(checksum)
+        # The index is in place first, so any pack in the packs
+        # directory always has an index.
+        os.rename(staged_idx_filename, idx_filename)
+        os.rename(self._staged_filename, final_filename)
+        self._entries = []
+        return final_filename, idx_filename
+
+    def abort(self):
+        """Throw away the pack being written."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._staged_filename)
+
+    def _open_pack(self):
+        self._staged_filename = os.path.join(
+            self._staging_dir,
+            'tmp-pack-' + hexlify(os.urandom(8)).decode('ascii'))
+        self._file = open(self._staged_filename, 'wb')
+        self._file.write(PACK_MAGIC)
+        self._offset = len(PACK_MAGIC)
+        self._entries = []
+        self._checksum = self._algorithm.new()
+
+
+class PackIndex(object):
+    def __init__(self, filename, digest_size=20):
+        self._filename = filename
+        self._record = index_record_struct(digest_size)
+        self._digest_size = digest_size
+
+    def read(self):
+        """Return ``(packed sorted records, pack checksum)``.
+
+        ``ValueError`` is raised if the index is malformed.
+        """
+        with open(self._filename, 'rb') as f:
+            contents = f.read()
+        header_size = len(INDEX_MAGIC) + COUNT.size
+        if contents[:len(INDEX_MAGIC)] != INDEX_MAGIC or \
+                len(contents) < header_size:
+            raise ValueError('Not a pack index')
+        count, = COUNT.unpack_from(contents, len(INDEX_MAGIC))
+        records_end = header_size + count * self._record.size
+        if len(contents) != records_end + self._digest_size:
+            raise ValueError('Pack index has the wrong size')
+        return contents[header_size:records_end], contents[records_end:]
@@ -0,0 +1,97 @@
+"""Read files for verification without churning memory or the page cache.
+
+Every read goes into a single reusable buffer, so verifying a file
+allocates nothing per chunk.  The chunks are memoryviews of the buffer
+and are only valid until the next read.
+
+Unless ``drop_cache`` is False, the kernel is told that each file is read
+sequentially, and once a file has been read its pages are dropped from
+the page cache, so verifying a tree doesn't evict the page cache of
+everything else running on the host.
+
+With ``direct_io``, files are opened with ``O_DIRECT`` and read into a
+page aligned buffer, bypassing the page cache entirely.  Filesystems that
+don't support ``O_DIRECT`` (e.g. tmpfs) are read normally instead.
+
+"""
+import io
+import os
+import mmap
+import errno
+
+
+BUFFER_READ_SIZE = 1024 * 1024
+DIRECT_IO_ALIGNMENT = 4096
+
+_can_fadvise = hasattr(os, 'posix_fadvise')
+
+
+class FileReader(object):
+    def __init__(self, buffer_size=BUFFER_READ_SIZE, direct_io=False,
+                 drop_cache=True):
+        if direct_io:
+            # O_DIRECT reads have to be a multiple of the block size.
+            buffer_size = -(-buffer_size // DIRECT_IO_ALIGNMENT) * \
+                DIRECT_IO_ALIGNMENT
+        self.buffer_size = buffer_size
+        self._direct_io = direct_io and hasattr(os, 'O_DIRECT')
+        self._drop_cache = drop_cache and _can_fadvise
+        self._buffer = None
+        self._buffer_pid = None
+
+    def iter_chunks(self, filename):
+        """Yield the contents of a file as memoryviews of the buffer."""
+        view = self._get_buffer()
+        f = self._open_raw(filename, self._direct_io)
+        try:
+            while True:
+                count = f.readinto(view)
+                if not count:
+                    break
+                yield view[:count]
+        finally:
+            self.close(f)
+
+    def open(self, filename):
+        """Open a file for reading with ``read_chunk``."""
+        return io.BufferedReader(self._open_raw(filename, direct_io=False))
+
+    def read_chunk(self, f, size):
+        """Read up to ``size`` bytes from ``f`` into the buffer."""
+        view = self._get_buffer()[:min(size, self.buffer_size)]
+        count = f.readinto(view)
+        return view[:count]
+
+    def close(self, f):
+        if self._drop_cache:
+            # Reading never dirties any pages, so they can all be
+            # dropped right away.
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        f.close()
+
+    def _open_raw(self, filename, direct_io):
+        fd = None
+        if direct_io:
+            try:
+                fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        if fd is None:
+            fd = os.open(filename, os.O_RDONLY)
+        if self._drop_cache:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return io.FileIO(fd, 'r', closefd=True)
+
+    def _get_buffer(self):
+        # Forked workers each need a buffer of their own.
+        if self._buffer is None or self._buffer_pid != os.getpid():
+            if self._direct_io:
+                # Anonymous maps are page aligned, as O_DIRECT needs.
+                self._buffer = memoryview(mmap.mmap(
+                    -1, self.buffer_size,
+                    flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS))
+            else:
+                self._buffer = memoryview(bytearray(self.buffer_size))
+            self._buffer_pid = os.getpid()
+        return self._buffer
@@ -0,0 +1,116 @@
+"""Report the corruption found by ``caf verify``.
+
+Every problem the verifier finds is a ``Corruption``, with a ``kind``
+saying what's wrong, the ``path`` of the file (or pack, or the hex digest
+of an object in a pack) it was found in, and a human readable
+``message``.  The kinds are:
+
+    checksum        A file's digest doesn't match its name.
+    header          A file is too short to have a header.
+    missing_parent  A file's parent doesn't exist.
+    unreferenced    A file isn't a root, and no file refers to it.
+    roots           The roots log doesn't match .metadata/all.
+    unexpected      Something is in the tree that caf didn't put there.
+    unreadable      A file couldn't be read.
+    manifest        The manifest doesn't match the tree.
+    pack            A pack or its index is malformed.
+
+Corruption is reported by a reporter as soon as the verifier has it.  The
+``text`` reporter writes a ``CORRUPTION: <message>`` line for each, and
+the ``jsonl`` reporter writes each as a JSON object on a line of its
+own::
+
+    {"type": "corruption", "kind": "checksum", "path": "...",
+     "message": "...", "time": 1700000000.0}
+
+followed by a summary once the verification has finished::
+
+    {"type": "summary", "succeeded": false, "corruptions": 1,
+     "aborted": false}
+
+If a reporter has ``max_errors``, reporting that many corruptions raises
+``VerificationAborted`` so the verification stops right away.
+
+"""
+import sys
+import json
+import time
+from collections import namedtuple
+
+
+CHECKSUM = 'checksum'
+HEADER = 'header'
+MISSING_PARENT = 'missing_parent'
+UNREFERENCED = 'unreferenced'
+ROOTS = 'roots'
+UNEXPECTED = 'unexpected'
+UNREADABLE = 'unreadable'
+MANIFEST = 'manifest'
+PACK = 'pack'
+
+
+Corruption = namedtuple('Corruption', ['kind', 'path', 'message'])
+
+
+class VerificationAborted(Exception):
+    def __init__(self, count):
+        super(VerificationAborted, self).__init__(
+            'Verification stopped after reaching the maximum of %s '
+            'errors.' % count)
+        self.count = count
+
+
+class TextReporter(object):
+    def __init__(self, stream=None, max_errors=None):
+        if stream is None:
+            stream = sys.stderr
+        self._stream = stream
+        self.max_errors = max_errors
+        self.count = 0
+
+    def report(self, corruption):
+        self.count += 1
+        self._write(corruption)
+        if self.max_errors is not None and self.count >= self.max_errors:
+            raise VerificationAborted(self.count)
+
+    def finish(self, succeeded, aborted=False):
+        pass
+
+    def _write(self, corruption):
+        self._stream.write("CORRUPTION: %s\n" % corruption.message)
+
+
+class JsonlReporter(TextReporter):
+    def finish(self, succeeded, aborted=False):
+        self._write_record({
+            'type': 'summary',
+            'succeeded': succeeded,
+            'corruptions': self.count,
+            'aborted': aborted,
+        })
+
+    def _write(self, corruption):
+        self._write_record({
+            'type': 'corruption',
+            'kind': corruption.kind,
+            'path': corruption.path,
+            'message': corruption.message,
+            'time': time.time(),
+        })
+
+    def _write_record(self, record):
+        # Flushed right away, so whatever is reading the report sees
+        # each corruption as soon as it's found.
+        self._stream.write(json.dumps(record, sort_keys=True) + '\n')
+        self._stream.flush()
+
+
+REPORT_FORMATS = {
+    'text': TextReporter,
+    'jsonl': JsonlReporter,
+}
+
+
+def create_reporter(report_format='text', stream=None, max_errors=None):
+    return REPORT_FORMATS[report_format](stream, max_errors)
@@ -0,0 +1,178 @@
+"""The registry of the roots of every chain of files.
+
+The root of a chain is its last file, which no other file refers to.
+Roots are recorded in an append-only log, ``.metadata/roots.log``, of
+fixed width records::
+
+    <op><root digest><running digest>
+
+where ``op`` is ``+`` when a root is added and ``-`` when it's removed
+(a tombstone), and the running digest is the digest (with the tree's
+hash algorithm, see ``caf.hashes``) of the previous record's running
+digest (all zeros for the first record), the op and the root digest.
+``.metadata/all`` holds the hex running digest of the last record, so a
+log that's been truncated, or had records removed or changed anywhere, no
+longer matches it.
+
+Appending takes an exclusive ``flock()`` on the log, reads just the last
+record, appends the new records with a single write and then replaces
+``.metadata/all``.  So adding roots costs the same no matter how many
+roots there already are, and any number of ``caf gen`` runs can add
+roots at once.
+
+Trees generated before the log existed have a ``.metadata/roots``
+directory with an empty file for each root, and ``.metadata/all`` holds
+the sha1 of the names of the files in the order they're listed.  Those
+roots are copied into the log the first time roots are added to such a
+tree, and the directory is no longer used after that.
+
+"""
+import os
+import fcntl
+import struct
+import hashlib
+from binascii import hexlify, unhexlify
+
+from caf.hashes import SHA1
+
+
+ROOTS_LOG = os.path.join('.metadata', 'roots.log')
+LEGACY_ROOTS_DIR = os.path.join('.metadata', 'roots')
+ALL_FILE = os.path.join('.metadata', 'all')
+ADD = b'+'
+REMOVE = b'-'
+READ_BLOCK_RECORDS = 4096
+
+
+def record_struct(digest_size=SHA1.digest_size):
+    return struct.Struct('>c%ss%ss' % (digest_size, digest_size))
+
+
+def has_roots(rootdir):
+    """Return whether any roots have been recorded for a tree."""
+    return os.path.exists(os.path.join(rootdir, ROOTS_LOG)) or \
+        os.path.isdir(os.path.join(rootdir, LEGACY_ROOTS_DIR))
+
+
+class RootsLog(object):
+    def __init__(self, rootdir, algorithm=SHA1):
+        self._rootdir = rootdir
+        self._algorithm = algorithm
+        self._digest_size = algorithm.digest_size
+        self._record = record_struct(self._digest_size)
+        self.filename = os.path.join(rootdir, ROOTS_LOG)
+        self.all_filename = os.path.join(rootdir, ALL_FILE)
+
+    def append(self, added, removed=()):
+        """Record roots being added and removed.
+
+        ``added`` and ``removed`` are binary digests.
+        """
+        fd = os.open(self.filename, os.O_RDWR | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(fd).st_size
+                if size % self._record.size:
+                    # A writer was interrupted part way through a
+                    # record, which can't be part of the chain.
+                    size -= size % self._record.size
+                    os.ftruncate(fd, size)
+                batches = [(REMOVE, removed), (ADD, added)]
+                if size == 0:
+                    running, legacy = self._legacy_records()
+                    batches.insert(0, (ADD, legacy))
+                else:
+                    running = self._last_running_digest(fd, size)
+                records = []
+                for op, digests in batches:
+                    for digest in digests:
+                        running = self._chain(running, op, digest)
+                        records.append(self._record.pack(op, digest,
+                                                         running))
+                data = b''.join(records)
+                while data:
+                    written = os.write(fd, data)
+                    data = data[written:]
+                self._write_all(running)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """Return ``(roots, error)`` for a tree.
+
+        ``roots`` is a set of binary digests, and ``error`` describes
+        why the roots can't be trusted (or is ``None``).
+        """
+        if not os.path.exists(self.filename):
+            return self._read_legacy()
+        roots = set()
+        running = b'\x00' * self._digest_size
+        error = None
+        record = self._record
+        block_size = record.size * READ_BLOCK_RECORDS
+        with open(self.filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                if len(block) % record.size:
+                    error = "Roots log is truncated."
+                for offset in range(0, len(block) - record.size + 1,
+                                    record.size):
+                    op, digest, expected = record.unpack_from(block, offset)
+                    running = self._chain(running, op, digest)
+                    if running != expected and error is None:
+                        error = "Roots log has been modified."
+                    if op == ADD:
+                        roots.add(digest)
+                    else:
+                        roots.discard(digest)
+        if error is None and \
+                self._read_all() != hexlify(running).decode('ascii'):
+            error = "Root hash is not valid, roots are missing."
+        return roots, error
+
+    def _chain(self, running, op, digest):
+        return self._algorithm.new(running + op + digest).digest()
+
+    def _last_running_digest(self, fd, size):
+        os.lseek(fd, size - self._record.size, os.SEEK_SET)
+        data = os.read(fd, self._record.size)
+        return self._record.unpack(data)[2]
+
+    def _write_all(self, running):
+        temp_filename = '%s.%s.tmp' % (self.all_filename, os.getpid())
+        with open(temp_filename, 'w') as f:
+            f.write(hexlify(running).decode('ascii'))
+        os.rename(temp_filename, self.all_filename)
+
+    def _read_all(self):
+        try:
+            with open(self.all_filename) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def _legacy_records(self):
+        # The roots of a tree from before the log existed, which are
+        # the first records in its log.
+        legacy_dir = os.path.join(self._rootdir, LEGACY_ROOTS_DIR)
+        names = []
+        if os.path.isdir(legacy_dir):
+            names = sorted(os.listdir(legacy_dir))
+        return (b'\x00' * self._digest_size,
+                [unhexlify(name.encode('ascii')) for name in names])
+
+    def _read_legacy(self):
+        legacy_dir = os.path.join(self._rootdir, LEGACY_ROOTS_DIR)
+        if not os.path.isdir(legacy_dir):
+            return set(), "No roots have been recorded."
+        names = os.listdir(legacy_dir)
+        roots_hash = hashlib.sha1()
+        for name in names:
+            roots_hash.update(name.encode('ascii'))
+        error = None
+        if roots_hash.hexdigest() != self._read_all():
+            error = "Root hash is not valid, roots are missing."
+        return set(unhexlify(name.encode('ascii')) for name in names), error
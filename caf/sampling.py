@@ -0,0 +1,108 @@
+"""Verify a random sample of files.
+
+A full verification of a huge tree can take days, so ``caf verify
+--sample`` verifies a random sample of the files instead and reports an
+upper bound on the corruption rate of the whole tree.
+
+Digests are uniformly distributed, so the files in any leaf directory of
+the tree's layout (see ``caf.layout``) are a random sample of all the
+files.  A sample is picked by choosing leaf directory prefixes uniformly
+at random (without replacement), without walking the tree.  Each leaf
+directory is either included completely, or (for the last one needed to
+reach a sample count) a random subset of its files is.
+
+The upper bound on the corruption rate is one sided.  With no corrupted
+files in the sample it's the exact (Clopper-Pearson) bound, otherwise
+it's the Wilson score bound.
+
+"""
+import math
+import random
+
+
+DEFAULT_CONFIDENCE = 0.95
+
+
+def normal_quantile(probability):
+    """Return the z score whose standard normal CDF is ``probability``."""
+    low, high = -40.0, 40.0
+    # Bisect the CDF, which is plenty fast for a single value.
+    for _ in range(200):
+        middle = (low + high) / 2
+        if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def corruption_rate_upper_bound(corrupted, sampled,
+                                confidence=DEFAULT_CONFIDENCE):
+    """Return an upper bound on the corruption rate of the population.
+
+    The true rate is at most the returned rate with the given
+    confidence.
+    """
+    if sampled == 0:
+        return 1.0
+    if corrupted == 0:
+        return 1 - (1 - confidence) ** (1.0 / sampled)
+    z = normal_quantile(confidence)
+    rate = corrupted / float(sampled)
+    denominator = 1 + z * z / sampled
+    center = rate + z * z / (2 * sampled)
+    margin = z * math.sqrt(rate * (1 - rate) / sampled +
+                           z * z / (4 * sampled * sampled))
+    return min(1.0, (center + margin) / denominator)
+
+
+def leaf_prefix_count(layout):
+    return 16 ** (layout.depth * layout.width)
+
+
+def random_leaf_prefixes(layout, rng=None):
+    """Yield every leaf directory prefix of a layout in a random order.
+
+    The prefixes are drawn lazily without replacement, with a
+    Fisher-Yates shuffle that only stores the positions it has swapped,
+    so only as many as are needed are ever generated, and each one
+    takes constant time however many have already been drawn.
+    """
+    if rng is None:
+        rng = random.SystemRandom()
+    total = leaf_prefix_count(layout)
+    num_chars = layout.depth * layout.width
+    # Position -> value of the positions that have been swapped,
+    # everything else still holds its own index.
+    swapped = {}
+    i = 0
+    while i < total:
+        j = rng.randrange(i, total)
+        value = swapped.pop(j, j)
+        if j != i:
+            swapped[j] = swapped.pop(i, i)
+        if num_chars == 0:
+            yield ''
+        else:
+            yield '%0*x' % (num_chars, value)
+        i += 1
+
+
+class SampleResult(object):
+    def __init__(self, sampled, corrupted, confidence, succeeded):
+        self.sampled = sampled
+        self.corrupted = corrupted
+        self.confidence = confidence
+        self.succeeded = succeeded
+
+    @property
+    def upper_bound(self):
+        return corruption_rate_upper_bound(self.corrupted, self.sampled,
+                                           self.confidence)
+
+    def summary(self):
+        return (
+            'Sampled %d files, %d corrupted.  With %g%% confidence, at '
+            'most %.4g%% of all files are corrupted.' % (
+                self.sampled, self.corrupted, self.confidence * 100,
+                self.upper_bound * 100))
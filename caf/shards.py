@@ -0,0 +1,185 @@
+"""Partial results of sharded verification.
+
+``caf verify --shard i/N`` verifies only the units of work (top level
+prefix directories, or packs) assigned to shard ``i`` of ``N``, so a tree
+on shared storage can be verified from many hosts at once.  Each shard
+writes a result file with everything needed to finish the verification:
+the digests of the files it saw, the parent digests those files
+reference, and any corruption it found.
+
+``caf verify-merge`` reads the results of every shard and runs the checks
+that need the whole tree, i.e. that every referenced parent exists, that
+every file other than the roots is referenced, and that the roots are
+all there.  The digests in each result are sorted, so the results are
+merged in a single streaming pass.
+
+A result file is::
+
+    <MAGIC><HEADER>
+    <seen digests, sorted>
+    <referenced digests, sorted>
+    <corruption length as a big endian uint32><utf-8 JSON corruption>
+    ...
+
+where each corruption is a JSON list of its kind, path and message (see
+``caf.report``).
+
+"""
+import os
+import json
+import struct
+import hashlib
+
+from caf.report import Corruption
+
+
+MAGIC = b'CAFSHRD2'
+# shard, shard count, digest size, number of seen digests,
+# number of referenced digests, number of corruptions.
+HEADER = struct.Struct('>IIIQQQ')
+MESSAGE_LENGTH = struct.Struct('>I')
+READ_BLOCK_DIGESTS = 4096
+
+
+def parse_shard(spec):
+    """Parse a shard spec of "i/N" into a 0 based ``(index, count)``.
+
+    Shards are numbered from 1 to N on the command line.
+    """
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard: %s' % spec)
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('Invalid shard: %s' % spec)
+    return index - 1, count
+
+
+def unit_shard(name, shard_count):
+    """Return the 0 based shard that a unit of work belongs to.
+
+    Units named with a hex prefix are assigned by prefix, anything else
+    by the hash of its name.
+    """
+    try:
+        value = int(name, 16)
+    except ValueError:
+        value = int(hashlib.sha1(name.encode('utf-8')).hexdigest()[:8], 16)
+    return value % shard_count
+
+
+def write_shard_result(filename, shard, shard_count, digest_size, seen,
+                       referenced, corruptions):
+    """Write a shard's result.
+
+    ``seen`` and ``referenced`` are sorted iterables of digests.  The
+    result is written to a temp file and renamed into place so a partial
+    result is never left behind.
+    """
+    temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        # The counts aren't known until the digests have been
+        # written, so the header is filled in at the end.
+        f.write(MAGIC + HEADER.pack(0, 0, 0, 0, 0, 0))
+        seen_count = _write_digests(f, seen)
+        referenced_count = _write_digests(f, referenced)
+        for corruption in corruptions:
+            encoded = json.dumps(list(corruption)).encode('utf-8')
+            f.write(MESSAGE_LENGTH.pack(len(encoded)) + encoded)
+        f.seek(len(MAGIC))
+        f.write(HEADER.pack(shard, shard_count, digest_size, seen_count,
+                            referenced_count, len(corruptions)))
+    os.rename(temp_filename, filename)
+
+
+def _write_digests(f, digests):
+    count = 0
+    for digest in digests:
+        f.write(digest)
+        count += 1
+    return count
+
+
+class ShardResult(object):
+    """A shard's result, as written by ``write_shard_result``.
+
+    The digests are read lazily, so any number of results can be merged
+    without holding their digests in memory.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = f.read(len(MAGIC) + HEADER.size)
+        if len(header) != len(MAGIC) + HEADER.size or \
+                header[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a shard result: %s' % filename)
+        (self.shard, self.shard_count, self.digest_size, self._seen_count,
+         self._referenced_count, self._corruptions_count) = \
+            HEADER.unpack_from(header, len(MAGIC))
+        self._seen_offset = len(header)
+        self._referenced_offset = \
+            self._seen_offset + self._seen_count * self.digest_size
+        self._corruptions_offset = \
+            self._referenced_offset + \
+            self._referenced_count * self.digest_size
+
+    def iter_seen(self):
+        return self._iter_digests(self._seen_offset, self._seen_count)
+
+    def iter_referenced(self):
+        return self._iter_digests(self._referenced_offset,
+                                  self._referenced_count)
+
+    def corruptions(self):
+        corruptions = []
+        with open(self.filename, 'rb') as f:
+            f.seek(self._corruptions_offset)
+            for _ in range(self._corruptions_count):
+                length, = MESSAGE_LENGTH.unpack(
+                    f.read(MESSAGE_LENGTH.size))
+                corruptions.append(Corruption(
+                    *json.loads(f.read(length).decode('utf-8'))))
+        return corruptions
+
+    def _iter_digests(self, offset, count):
+        digest_size = self.digest_size
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            remaining = count
+            while remaining:
+                block_count = min(remaining, READ_BLOCK_DIGESTS)
+                block = f.read(block_count * digest_size)
+                if len(block) != block_count * digest_size:
+                    raise ValueError('Shard result is truncated: %s' %
+                                     self.filename)
+                for i in range(0, len(block), digest_size):
+                    yield block[i:i + digest_size]
+                remaining -= block_count
+
+
+def load_shard_results(filenames):
+    """Load the results of every shard of a verification.
+
+    ``ValueError`` is raised unless there's exactly one result for each
+    shard, all from the same sharding of the tree.
+    """
+    results = [ShardResult(filename) for filename in filenames]
+    if not results:
+        raise ValueError('No shard results given.')
+    shard_count = results[0].shard_count
+    digest_size = results[0].digest_size
+    shards = set()
+    for result in results:
+        if result.shard_count != shard_count or \
+                result.digest_size != digest_size:
+            raise ValueError('Shard results are from different '
+                             'verifications: %s' % result.filename)
+        if result.shard in shards:
+            raise ValueError('Duplicate result for shard %s/%s: %s' % (
+                result.shard + 1, shard_count, result.filename))
+        shards.add(result.shard)
+    missing = sorted(set(range(shard_count)) - shards)
+    if missing:
+        raise ValueError('Missing results for shard(s): %s' % ', '.join(
+            '%s/%s' % (shard + 1, shard_count) for shard in missing))
+    return results
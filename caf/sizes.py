@@ -0,0 +1,308 @@
+"""Choose the sizes of generated files.
+
+Each ``--file-size`` is parsed into a distribution, which draws file
+sizes in batches of ``BATCH_SIZE`` instead of one per file.  When NumPy
+is installed a batch is drawn with a single vectorized call, otherwise
+the same distributions are drawn with the ``random`` module.  Either way
+a sampler's sizes are determined by its own ``random.Random``, which is
+seeded from the ``random`` module, so seeding ``random`` seeds the sizes,
+and a sampler's state can be saved and restored.
+
+A distribution can also be an empirical histogram, read from a CSV file
+of measured sizes (e.g. from a production filesystem) with
+``--file-size histogram=sizes.csv``.  Each row of the file is one of::
+
+    <size>,<count>
+    <min size>,<max size>,<count>
+
+where sizes may have a size suffix (``4kb``), and the count is the
+relative weight of the row, so it doesn't have to be an integer.  Files
+are the exact size of a two column row, or uniformly distributed between
+the sizes of a three column row.  A header row and lines starting with
+``#`` are skipped.  Rows are picked with an alias table (Vose's method),
+so each size takes constant time to draw however many rows there are.
+
+"""
+import csv
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+SIZE_TYPES = {
+    'kb': 1024,
+    'mb': 1024 ** 2,
+    'gb': 1024 ** 3,
+    'tb': 1024 ** 4,
+}
+BATCH_SIZE = 4096
+
+
+def is_size_identifier(value):
+    return len(value) >= 2 and value[-2:].lower() in SIZE_TYPES
+
+
+def parse_size(value):
+    """Parse a size in bytes, optionally suffixed with kb, mb, etc."""
+    value = value.strip()
+    if is_size_identifier(value):
+        return int(value[:-2]) * SIZE_TYPES[value[-2:].lower()]
+    return int(value)
+
+
+class SizeDistribution(object):
+    """A distribution of file sizes.
+
+    Subclasses implement ``_sample_python(count, rng)`` and
+    ``_sample_numpy(count, rng)``.  Calling a distribution draws a single
+    size.
+    """
+    def sample(self, count, rng=None):
+        """Return a list of ``count`` sizes.
+
+        ``rng`` is a ``random.Random`` (by default the ``random`` module
+        itself).  With NumPy, it seeds the NumPy generator for the batch.
+        """
+        if rng is None:
+            rng = random
+        if numpy is None:
+            return self._sample_python(count, rng)
+        sizes = self._sample_numpy(
+            count, numpy.random.default_rng(rng.getrandbits(64)))
+        if not numpy.all(numpy.isfinite(sizes)):
+            raise OverflowError('File size is too large')
+        return numpy.abs(sizes).astype(numpy.int64).tolist()
+
+    def __call__(self):
+        return self.sample(1)[0]
+
+
+class FixedSize(SizeDistribution):
+    def __init__(self, size):
+        self.size = size
+
+    def sample(self, count, rng=None):
+        return [self.size] * count
+
+
+class UniformSize(SizeDistribution):
+    """Sizes between ``start`` and ``end``, inclusive."""
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def _sample_python(self, count, rng):
+        randint = rng.randint
+        return [randint(self.start, self.end) for _ in range(count)]
+
+    def _sample_numpy(self, count, rng):
+        return rng.integers(self.start, self.end + 1, count)
+
+
+class NormalSize(SizeDistribution):
+    def __init__(self, Mean, StdDev):
+        self.mean = Mean
+        self.stddev = StdDev
+
+    def _sample_python(self, count, rng):
+        gauss = rng.gauss
+        return [abs(int(gauss(self.mean, self.stddev)))
+                for _ in range(count)]
+
+    def _sample_numpy(self, count, rng):
+        return numpy.trunc(rng.normal(self.mean, self.stddev, count))
+
+
+class GammaSize(SizeDistribution):
+    def __init__(self, Alpha, Beta):
+        self.alpha = Alpha
+        self.beta = Beta
+
+    def _sample_python(self, count, rng):
+        gammavariate = rng.gammavariate
+        return [abs(int(gammavariate(self.alpha, self.beta)))
+                for _ in range(count)]
+
+    def _sample_numpy(self, count, rng):
+        return numpy.trunc(rng.gamma(self.alpha, self.beta, count))
+
+
+class LognormalSize(SizeDistribution):
+    def __init__(self, Mean, StdDev):
+        self.mean = Mean
+        self.stddev = StdDev
+
+    def _sample_python(self, count, rng):
+        lognormvariate = rng.lognormvariate
+        return [abs(int(lognormvariate(self.mean, self.stddev)))
+                for _ in range(count)]
+
+    def _sample_numpy(self, count, rng):
+        return numpy.trunc(rng.lognormal(self.mean, self.stddev, count))
+
+
+PARAMETRIC_SIZES = {
+    'normal': NormalSize,
+    'gamma': GammaSize,
+    'lognormal': LognormalSize,
+}
+
+
+class HistogramSize(SizeDistribution):
+    """Sizes drawn from the rows of a histogram.
+
+    ``rows`` is a list of ``(min size, max size, weight)`` tuples.
+    """
+    def __init__(self, rows):
+        if not rows:
+            raise ValueError('Histogram has no rows')
+        for low, high, weight in rows:
+            if low < 0 or high < low or weight < 0:
+                raise ValueError('Invalid histogram row: %s,%s,%s' % (
+                    low, high, weight))
+        total = float(sum(weight for _, _, weight in rows))
+        if total <= 0:
+            raise ValueError('Histogram has no weight')
+        self.lows = [low for low, _, _ in rows]
+        self.highs = [high for _, high, _ in rows]
+        self.probabilities, self.aliases = build_alias_table(
+            [weight / total for _, _, weight in rows])
+        self._arrays = None
+
+    @classmethod
+    def from_csv(cls, filename):
+        rows = []
+        with open(filename) as f:
+            for i, row in enumerate(csv.reader(f)):
+                row = [column.strip() for column in row]
+                if not row or not row[0] or row[0].startswith('#'):
+                    continue
+                try:
+                    if len(row) == 2:
+                        size = parse_size(row[0])
+                        rows.append((size, size, float(row[1])))
+                    elif len(row) == 3:
+                        rows.append((parse_size(row[0]),
+                                     parse_size(row[1]), float(row[2])))
+                    else:
+                        raise ValueError()
+                except ValueError:
+                    if i == 0:
+                        # A header row.
+                        continue
+                    raise ValueError('Invalid histogram row %s in %s: %s' %
+                                     (i + 1, filename, ','.join(row)))
+        return cls(rows)
+
+    def _sample_python(self, count, rng):
+        num_rows = len(self.lows)
+        probabilities = self.probabilities
+        aliases = self.aliases
+        lows = self.lows
+        highs = self.highs
+        sizes = []
+        for _ in range(count):
+            row = rng.randrange(num_rows)
+            if rng.random() >= probabilities[row]:
+                row = aliases[row]
+            if lows[row] == highs[row]:
+                sizes.append(lows[row])
+            else:
+                sizes.append(rng.randint(lows[row], highs[row]))
+        return sizes
+
+    def _sample_numpy(self, count, rng):
+        if self._arrays is None:
+            self._arrays = (numpy.array(self.probabilities),
+                            numpy.array(self.aliases),
+                            numpy.array(self.lows),
+                            numpy.array(self.highs))
+        probabilities, aliases, lows, highs = self._arrays
+        rows = rng.integers(0, len(lows), count)
+        rows = numpy.where(rng.random(count) < probabilities[rows],
+                           rows, aliases[rows])
+        return rng.integers(lows[rows], highs[rows] + 1)
+
+
+def build_alias_table(probabilities):
+    """Build the alias table for a discrete distribution.
+
+    Returns ``(probabilities, aliases)``: row ``i`` is drawn by picking a
+    uniformly random row, and keeping it with its probability or else
+    taking its alias.
+    """
+    num_rows = len(probabilities)
+    scaled = [p * num_rows for p in probabilities]
+    keep = [1.0] * num_rows
+    aliases = list(range(num_rows))
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        keep[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    # Anything left over has a probability of 1, give or take
+    # floating point error.
+    return keep, aliases
+
+
+class SizeSampler(object):
+    """Draw sizes from a distribution one at a time, a batch at a time.
+
+    Create a sampler after seeding ``random``.  Any no-arg callable can be
+    used instead of a ``SizeDistribution``, in which case it's called
+    for each size.
+
+    ``state()`` returns a JSON serializable snapshot of the sampler, and a
+    sampler created with that ``state`` draws the same sizes from then on.
+    """
+    def __init__(self, distribution, batch_size=BATCH_SIZE, state=None):
+        self._distribution = distribution
+        self._batch_size = batch_size
+        self._batched = isinstance(distribution, SizeDistribution)
+        self._rng = random.Random(random.getrandbits(64))
+        # The rng's state at the start of the current batch, and the
+        # number of sizes used from it.
+        self._batch_state = None
+        self._used = 0
+        self._sizes = []
+        if state is not None and state['batch'] is not None:
+            self._rng.setstate(_to_tuple(state['batch']))
+            self._refill()
+            self._used = state['used']
+            del self._sizes[len(self._sizes) - self._used:]
+
+    def __call__(self):
+        if not self._batched:
+            return self._distribution()
+        if not self._sizes:
+            self._refill()
+        self._used += 1
+        return self._sizes.pop()
+
+    def state(self):
+        return {'batch': self._batch_state, 'used': self._used}
+
+    def _refill(self):
+        self._batch_state = self._rng.getstate()
+        self._used = 0
+        self._sizes = self._distribution.sample(self._batch_size, self._rng)
+        # Sizes are popped from the end, so keep them in the order
+        # they were drawn.
+        self._sizes.reverse()
+
+
+def _to_tuple(value):
+    # JSON turns the tuples of a random.Random state into lists.
+    if isinstance(value, list):
+        return tuple(_to_tuple(item) for item in value)
+    return value
@@ -0,0 +1,133 @@
+"""Stage generated files before committing them to their final location.
+
+A generated file's final name is the hash of its contents, so it can only
+be named once it's been completely written.  Files are written to a
+staging directory and then committed with a single link or rename.
+
+Where possible, files are staged with ``O_TMPFILE`` so they have no name at
+all until they're committed with ``linkat()``.  An interrupted run can
+never leave a staged file behind this way.  Otherwise a uniquely named
+temp file is created in the staging directory and renamed into place.
+
+The staging directory should be on the same filesystem as the final
+location, otherwise committing a file means copying it.
+
+"""
+import os
+import errno
+import shutil
+from binascii import hexlify
+
+
+STAGING_DIR = os.path.join('.metadata', 'tmp')
+TEMP_PREFIX = 'tmp-'
+PROC_FD_DIR = '/proc/self/fd'
+
+# Errors that mean O_TMPFILE isn't supported by the OS or the filesystem.
+_TMPFILE_UNSUPPORTED = (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL)
+# Errors that mean a O_TMPFILE file can't be linked through /proc.
+_LINK_UNSUPPORTED = (errno.EXDEV, errno.ENOENT, errno.EPERM, errno.EACCES,
+                     errno.EOPNOTSUPP)
+
+
+class UnnamedStagedFile(object):
+    def __init__(self, fd):
+        self._fd = fd
+        self.fileobj = os.fdopen(fd, 'wb')
+
+    def commit(self, final_filename):
+        self.fileobj.flush()
+        try:
+            # os.link() follows the /proc symlink to the open file.
+            os.link(os.path.join(PROC_FD_DIR, str(self._fd)),
+                    final_filename)
+        except OSError as e:
+            # The final name is the hash of the contents, so if it
+            # already exists it's the same file.
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            self.fileobj.close()
+
+    def discard(self):
+        self.fileobj.close()
+
+
+class NamedStagedFile(object):
+    def __init__(self, fd, filename):
+        self.filename = filename
+        self.fileobj = os.fdopen(fd, 'wb')
+
+    def commit(self, final_filename):
+        self.fileobj.close()
+        try:
+            os.rename(self.filename, final_filename)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # The staging directory is on another filesystem.
+            shutil.move(self.filename, final_filename)
+
+    def discard(self):
+        self.fileobj.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class Stager(object):
+    """Create staged files in a directory.
+
+    :param directory: The staging directory.
+    :param use_tmpfile: Whether to try ``O_TMPFILE``.  This is only
+        possible when the staging directory is on the same filesystem as
+        the final location of the files.
+
+    """
+    def __init__(self, directory, use_tmpfile=True):
+        self._directory = directory
+        self._use_tmpfile = use_tmpfile and hasattr(os, 'O_TMPFILE')
+        self._tmpfile_probed = False
+
+    def new_file(self):
+        if self._use_tmpfile and not self._tmpfile_probed:
+            self._use_tmpfile = self._probe_tmpfile()
+            self._tmpfile_probed = True
+        if self._use_tmpfile:
+            return UnnamedStagedFile(self._open_tmpfile())
+        fd, filename = self._open_named_file()
+        return NamedStagedFile(fd, filename)
+
+    def _open_tmpfile(self):
+        return os.open(self._directory, os.O_TMPFILE | os.O_WRONLY, 0o666)
+
+    def _open_named_file(self):
+        filename = os.path.join(
+            self._directory,
+            TEMP_PREFIX + hexlify(os.urandom(8)).decode('ascii'))
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        return fd, filename
+
+    def _probe_tmpfile(self):
+        # Both the filesystem and /proc have to cooperate for O_TMPFILE
+        # to work, so find out up front by committing an empty file.
+        try:
+            fd = self._open_tmpfile()
+        except OSError as e:
+            if e.errno not in _TMPFILE_UNSUPPORTED:
+                raise
+            return False
+        probe_filename = os.path.join(
+            self._directory,
+            TEMP_PREFIX + 'probe-' + hexlify(os.urandom(8)).decode('ascii'))
+        try:
+            os.link(os.path.join(PROC_FD_DIR, str(fd)), probe_filename)
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED:
+                raise
+            return False
+        finally:
+            os.close(fd)
+        os.remove(probe_filename)
+        return True
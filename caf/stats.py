@@ -0,0 +1,266 @@
+"""Per-phase instrumentation for generating and verifying files.
+
+The generator and the verifier time each phase of their work (e.g. "rng",
+"hash", "write", "walk") with a pair of calls::
+
+    start = stats.start()
+    ...
+    stats.stop('hash', start, len(chunk))
+
+Each phase keeps a count, a number of bytes (or entries, for "walk"), the
+total seconds and a histogram of latencies.  The "file" phase covers each
+file from start to finish, and is what progress is measured with.
+
+By default the generator and verifier are given ``NULL_STATS``, whose
+methods do nothing, so the hooks cost next to nothing unless stats are
+being collected.
+
+A ``StatsReporter`` thread can periodically report a ``Stats`` as a live
+progress line, as JSON snapshots, and as a Prometheus textfile.
+
+"""
+import os
+import sys
+import json
+import time
+import threading
+
+
+# Latency histograms have power of 2 buckets in microseconds.  Bucket
+# ``i`` counts latencies below ``2 ** i`` microseconds, and the last
+# bucket also counts anything larger.
+HISTOGRAM_BUCKETS = 32
+BYTES_PER_MB = 1024.0 ** 2
+
+
+def thread_cpu_clock():
+    """Return a clock that measures the CPU time of the current thread."""
+    if hasattr(time, 'thread_time'):
+        return time.thread_time
+    elif hasattr(time, 'process_time'):
+        return time.process_time
+    return time.clock
+
+
+def wall_clock():
+    """Return a monotonic wall clock."""
+    if hasattr(time, 'perf_counter'):
+        return time.perf_counter
+    return time.time
+
+
+def bucket_upper_bounds():
+    """Return the upper bound in seconds of each histogram bucket."""
+    return [(2 ** i) / 1e6 for i in range(HISTOGRAM_BUCKETS)]
+
+
+class Stats(object):
+    """Accumulate the count, bytes, seconds and latencies of each phase.
+
+    Stats can be recorded from one thread while being reported from
+    another.
+    """
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = wall_clock()
+        self._clock = clock
+        self._lock = threading.Lock()
+        # phase name -> [count, bytes, seconds, histogram]
+        self.phases = {}
+
+    def start(self):
+        return self._clock()
+
+    def stop(self, phase, start, nbytes=0):
+        self.record(phase, self._clock() - start, nbytes)
+
+    def record(self, phase, seconds, nbytes=0):
+        bucket = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        with self._lock:
+            totals = self.phases.get(phase)
+            if totals is None:
+                totals = self.phases[phase] = _new_totals()
+            totals[0] += 1
+            totals[1] += nbytes
+            totals[2] += seconds
+            totals[3][bucket] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict((phase, _copy_totals(totals))
+                        for phase, totals in self.phases.items())
+
+    def merge(self, snapshot):
+        """Merge a snapshot from another ``Stats`` (e.g. a worker's)."""
+        with self._lock:
+            for phase, (count, nbytes, seconds, histogram) in \
+                    snapshot.items():
+                totals = self.phases.get(phase)
+                if totals is None:
+                    totals = self.phases[phase] = _new_totals()
+                totals[0] += count
+                totals[1] += nbytes
+                totals[2] += seconds
+                for i, bucket_count in enumerate(histogram):
+                    totals[3][i] += bucket_count
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+
+
+class NullStats(object):
+    def start(self):
+        return 0
+
+    def stop(self, phase, start, nbytes=0):
+        pass
+
+    def record(self, phase, seconds, nbytes=0):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def merge(self, snapshot):
+        pass
+
+    def reset(self):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+def _new_totals():
+    return [0, 0, 0.0, [0] * HISTOGRAM_BUCKETS]
+
+
+def _copy_totals(totals):
+    return [totals[0], totals[1], totals[2], list(totals[3])]
+
+
+class StatsReporter(threading.Thread):
+    """Periodically report stats while an operation is running.
+
+    :param stats: The ``Stats`` to report.
+    :param operation: The name of the operation, e.g. "gen" or "verify".
+    :param interval: The number of seconds between reports.
+    :param progress: Whether to write a live progress line to stderr.
+    :param stats_json: A filename to write JSON snapshots to.
+    :param prometheus_textfile: A filename to write Prometheus metrics to,
+        for use with the node exporter's textfile collector.
+
+    """
+    def __init__(self, stats, operation, interval=10, progress=False,
+                 stats_json=None, prometheus_textfile=None):
+        super(StatsReporter, self).__init__()
+        self.daemon = True
+        self._stats = stats
+        self._operation = operation
+        self._interval = interval
+        self._progress = progress
+        # The generator changes the cwd, so relative
+        # filenames have to be resolved now.
+        if stats_json is not None:
+            stats_json = os.path.abspath(stats_json)
+        if prometheus_textfile is not None:
+            prometheus_textfile = os.path.abspath(prometheus_textfile)
+        self._stats_json = stats_json
+        self._prometheus_textfile = prometheus_textfile
+        self._stopped = threading.Event()
+        self._start_time = time.time()
+        self._last_report = (self._start_time, 0, 0)
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.report()
+
+    def stop(self):
+        """Stop reporting, and write out one final report."""
+        self._stopped.set()
+        self.join()
+        self.report()
+        if self._progress:
+            sys.stderr.write('\n')
+
+    def report(self):
+        now = time.time()
+        snapshot = self._stats.snapshot()
+        if self._progress:
+            self._write_progress(now, snapshot)
+        if self._stats_json is not None:
+            _write_atomically(self._stats_json,
+                              json.dumps(self._json_snapshot(now, snapshot),
+                                         sort_keys=True) + '\n')
+        if self._prometheus_textfile is not None:
+            _write_atomically(self._prometheus_textfile,
+                              self._prometheus_text(snapshot))
+
+    def _write_progress(self, now, snapshot):
+        files, nbytes = snapshot.get('file', [0, 0])[:2]
+        last_time, last_files, last_bytes = self._last_report
+        elapsed = max(now - last_time, 1e-9)
+        self._last_report = (now, files, nbytes)
+        line = '%s: %d files, %.1f MB, %.1f files/s, %.1f MB/s, %ds elapsed' \
+            % (self._operation, files, nbytes / BYTES_PER_MB,
+               (files - last_files) / elapsed,
+               (nbytes - last_bytes) / BYTES_PER_MB / elapsed,
+               now - self._start_time)
+        sys.stderr.write('\r' + line.ljust(79))
+        sys.stderr.flush()
+
+    def _json_snapshot(self, now, snapshot):
+        phases = {}
+        for phase, (count, nbytes, seconds, histogram) in snapshot.items():
+            phases[phase] = {
+                'count': count,
+                'bytes': nbytes,
+                'seconds': seconds,
+                'histogram': histogram,
+            }
+        return {
+            'operation': self._operation,
+            'timestamp': now,
+            'elapsed_seconds': now - self._start_time,
+            'histogram_upper_bounds': bucket_upper_bounds(),
+            'phases': phases,
+        }
+
+    def _prometheus_text(self, snapshot):
+        lines = [
+            '# HELP caf_phase_seconds Time spent in each phase.',
+            '# TYPE caf_phase_seconds histogram',
+        ]
+        upper_bounds = bucket_upper_bounds()
+        for phase, (count, _, seconds, histogram) in sorted(
+                snapshot.items()):
+            labels = 'operation="%s",phase="%s"' % (self._operation, phase)
+            cumulative = 0
+            # The last bucket is open ended, so it's only part of +Inf.
+            for upper_bound, bucket_count in zip(upper_bounds[:-1],
+                                                 histogram[:-1]):
+                cumulative += bucket_count
+                lines.append('caf_phase_seconds_bucket{%s,le="%g"} %d' % (
+                    labels, upper_bound, cumulative))
+            lines.append('caf_phase_seconds_bucket{%s,le="+Inf"} %d' % (
+                labels, count))
+            lines.append('caf_phase_seconds_sum{%s} %r' % (labels, seconds))
+            lines.append('caf_phase_seconds_count{%s} %d' % (labels, count))
+        lines.extend([
+            '# HELP caf_phase_bytes_total Bytes processed by each phase.',
+            '# TYPE caf_phase_bytes_total counter',
+        ])
+        for phase, totals in sorted(snapshot.items()):
+            lines.append(
+                'caf_phase_bytes_total{operation="%s",phase="%s"} %d' % (
+                    self._operation, phase, totals[1]))
+        return '\n'.join(lines) + '\n'
+
+
+def _write_atomically(filename, contents):
+    # Readers (e.g. the node exporter) should never see a partial file.
+    temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        f.write(contents)
+    os.rename(temp_filename, filename)
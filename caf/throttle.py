@@ -0,0 +1,222 @@
+"""Limit the I/O of ``caf gen`` and ``caf verify``.
+
+Running flat out on storage that's also serving live traffic hurts the
+latency of everything else, so the rate of I/O can be limited with a
+token bucket for bytes (``--max-bandwidth``) and another for operations
+(``--max-iops``), where every read or write of a chunk is an operation.
+The buckets live in shared memory, so the limits apply to the total
+across all the worker processes.
+
+The generator and the verifier time each read or write with a pair of
+calls::
+
+    start = throttle.start()
+    ...
+    throttle.stop(start, len(chunk))
+
+and ``stop`` sleeps for as long as it takes the buckets to pay for the
+I/O.  Callers can go into debt, so a chunk bigger than a bucket still
+gets through, and each caller simply waits its turn.
+
+With ``latency_target`` the limits adapt to the storage.  The latency of
+each I/O is averaged, and every ``ADJUST_INTERVAL`` seconds the rates are
+cut (to ``BACKOFF`` of the rate actually achieved) while the average is
+above the target, or grown by ``INCREASE`` (up to the configured
+maximums, if any) while it's below it.
+
+``set_priority`` lowers the CPU (nice) and I/O (ioprio) priority of the
+process, which any workers inherit.  The I/O priority only has an effect
+with I/O schedulers that support it (e.g. BFQ).
+
+By default the generator and verifier are given ``NULL_THROTTLE``, whose
+methods do nothing.
+
+"""
+import os
+import time
+import ctypes
+import platform
+
+from caf.utils import fork_context
+
+
+ADJUST_INTERVAL = 0.5
+BURST_SECONDS = 0.1
+BACKOFF = 0.7
+INCREASE = 1.1
+LATENCY_SMOOTHING = 0.2
+MIN_BANDWIDTH = 1024 * 1024
+MIN_IOPS = 1
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# The ioprio_set syscall number for each architecture.
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+}
+
+# The indices of the shared state.
+(_BYTE_TOKENS, _OP_TOKENS, _LAST_REFILL, _BANDWIDTH, _IOPS, _LATENCY,
+ _LAST_ADJUSTED, _WINDOW_BYTES, _WINDOW_OPS) = range(9)
+_STATE_SIZE = 9
+
+_INF = float('inf')
+_libc = None
+
+
+class Throttle(object):
+    """Limit the bandwidth and IOPS of every process that shares it.
+
+    ``max_bandwidth`` is in bytes per second and ``latency_target`` in
+    seconds.  Any of them can be ``None``.
+    """
+    def __init__(self, max_bandwidth=None, max_iops=None,
+                 latency_target=None, clock=time.time, sleep=time.sleep):
+        self._max_bandwidth = _INF if max_bandwidth is None \
+            else float(max_bandwidth)
+        self._max_iops = _INF if max_iops is None else float(max_iops)
+        self._latency_target = latency_target
+        self._clock = clock
+        self._sleep = sleep
+        context = fork_context()
+        self._lock = context.Lock()
+        self._state = context.RawArray(ctypes.c_double, _STATE_SIZE)
+        now = clock()
+        self._state[_BANDWIDTH] = self._max_bandwidth
+        self._state[_IOPS] = self._max_iops
+        self._state[_BYTE_TOKENS] = _burst(self._max_bandwidth)
+        self._state[_OP_TOKENS] = _burst(self._max_iops)
+        self._state[_LAST_REFILL] = now
+        self._state[_LAST_ADJUSTED] = now
+
+    @property
+    def bandwidth(self):
+        return self._state[_BANDWIDTH]
+
+    @property
+    def iops(self):
+        return self._state[_IOPS]
+
+    def start(self):
+        return self._clock()
+
+    def stop(self, start, nbytes):
+        """Account for an I/O of ``nbytes`` that began at ``start``."""
+        now = self._clock()
+        state = self._state
+        with self._lock:
+            if self._latency_target is not None:
+                self._observe(now, now - start, nbytes)
+            elapsed = now - state[_LAST_REFILL]
+            state[_LAST_REFILL] = now
+            delay = max(
+                self._take(_BYTE_TOKENS, state[_BANDWIDTH], elapsed, nbytes),
+                self._take(_OP_TOKENS, state[_IOPS], elapsed, 1))
+        if delay > 0:
+            self._sleep(delay)
+
+    def _take(self, tokens, rate, elapsed, amount):
+        # Refill the bucket, take ``amount`` out of it, and return how
+        # long to wait until the bucket is out of debt.
+        if rate == _INF:
+            return 0
+        state = self._state
+        state[tokens] = min(state[tokens] + elapsed * rate,
+                            _burst(rate)) - amount
+        if state[tokens] >= 0:
+            return 0
+        return -state[tokens] / rate
+
+    def _observe(self, now, latency, nbytes):
+        state = self._state
+        if state[_LATENCY] == 0:
+            state[_LATENCY] = latency
+        else:
+            state[_LATENCY] += LATENCY_SMOOTHING * (latency - state[_LATENCY])
+        state[_WINDOW_BYTES] += nbytes
+        state[_WINDOW_OPS] += 1
+        interval = now - state[_LAST_ADJUSTED]
+        if interval < ADJUST_INTERVAL:
+            return
+        if state[_LATENCY] > self._latency_target:
+            # Back off from what was actually achieved, since the
+            # limit may be well above it.
+            state[_BANDWIDTH] = max(MIN_BANDWIDTH, BACKOFF * min(
+                state[_BANDWIDTH], state[_WINDOW_BYTES] / interval))
+            state[_IOPS] = max(MIN_IOPS, BACKOFF * min(
+                state[_IOPS], state[_WINDOW_OPS] / interval))
+        else:
+            state[_BANDWIDTH] = min(self._max_bandwidth,
+                                    state[_BANDWIDTH] * INCREASE)
+            state[_IOPS] = min(self._max_iops, state[_IOPS] * INCREASE)
+        state[_BYTE_TOKENS] = min(state[_BYTE_TOKENS],
+                                  _burst(state[_BANDWIDTH]))
+        state[_OP_TOKENS] = min(state[_OP_TOKENS], _burst(state[_IOPS]))
+        state[_LAST_ADJUSTED] = now
+        state[_WINDOW_BYTES] = 0
+        state[_WINDOW_OPS] = 0
+
+
+def _burst(rate):
+    return rate * BURST_SECONDS
+
+
+class NullThrottle(object):
+    def start(self):
+        return 0
+
+    def stop(self, start, nbytes):
+        pass
+
+
+NULL_THROTTLE = NullThrottle()
+
+
+def parse_ionice(spec):
+    """Parse an I/O priority such as "idle" or "best-effort:7".
+
+    Returns a tuple of the ioprio class and level.
+    """
+    name, _, level = spec.partition(':')
+    if name not in IOPRIO_CLASSES:
+        raise ValueError('Invalid I/O priority class: %s' % name)
+    if not level:
+        return IOPRIO_CLASSES[name], 0
+    try:
+        level = int(level)
+    except ValueError:
+        raise ValueError('Invalid I/O priority: %s' % spec)
+    if not 0 <= level <= 7:
+        raise ValueError('The I/O priority level must be from 0 to 7.')
+    return IOPRIO_CLASSES[name], level
+
+
+def set_priority(nice=None, ionice=None):
+    """Set the CPU and I/O priority of the current process.
+
+    ``ionice`` is a ``(class, level)`` tuple from ``parse_ionice``.
+    """
+    global _libc
+    if nice is not None:
+        os.nice(nice)
+    if ionice is not None:
+        syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if syscall is None or not platform.system() == 'Linux':
+            raise OSError('Setting the I/O priority is not supported on '
+                          'this platform.')
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        ioprio_class, level = ionice
+        if _libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0,
+                         (ioprio_class << IOPRIO_CLASS_SHIFT) | level) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
@@ -1,20 +1,38 @@
 """Shared utility functions."""
 import os
+import multiprocessing
 from contextlib import contextmanager
 
+from caf.layout import DEFAULT_LAYOUT
 
-def file_path_to_hash(filename):
-    """Convert a sha1 file name to the original sha1.
+
+def file_path_to_hash(filename, layout=None):
+    """Convert a file name to the original hex digest.
 
     Given a full filename such as "ab/cd/effffff...",
-    this function will convert it to the original sha1
-    string hash:  "abcdefffff"
+    this function will convert it to the original hex
+    digest:  "abcdefffff"
+
+    If ``layout`` is given (see ``caf.layout``), only the parts of the
+    filename that make up the digest in that layout are used, so the
+    filename doesn't have to be relative to the rootdir.
     """
+    if layout is not None:
+        return layout.file_path_to_hash(filename)
     # .strip('.') because a relative path may come in like
     # './ab/cd/efff'
     return ''.join(filename.split(os.sep)).strip('.')
 
 
+def hash_to_file_path(hex_hash, layout=DEFAULT_LAYOUT):
+    """Convert a hex digest to its relative file name.
+
+    This is the inverse of ``file_path_to_hash``, e.g.
+    "abcdefffff" becomes "ab/cd/efffff" with the default layout.
+    """
+    return layout.hash_to_file_path(hex_hash)
+
+
 @contextmanager
 def cd(directory):
     starting = os.getcwd()
@@ -23,3 +41,15 @@ def cd(directory):
         yield
     finally:
         os.chdir(starting)
+
+
+def fork_context():
+    """Return a multiprocessing context that forks its workers.
+
+    Workers inherit the parent's state (including the no-arg file size
+    functions, which can't be pickled), so always fork when the platform
+    allows us to choose.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
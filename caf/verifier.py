@@ -1,94 +1,922 @@
 """Verify files generated from the caf.generator module."""
 import os
-import sys
-from binascii import hexlify
-import hashlib
+import math
+import errno
+import random
+from multiprocessing import TimeoutError
+from binascii import hexlify, unhexlify
 
-from caf.utils import file_path_to_hash
+from caf.cache import VerifyCache, CACHE_FILE, stat_key
+from caf.digests import DigestSet, merge_join, merge_sorted
+from caf.hashes import read_hash
+from caf.layout import load_layout
+from caf.manifest import read_manifest, MANIFEST_FILE
+from caf.pack import PackIndex, read_storage, index_filename, \
+    index_record_struct, PACKS_DIR, PACK_SUFFIX, INDEX_SUFFIX, \
+    PACK_MAGIC, LENGTH, COUNT, END_OF_PACK
+from caf.reader import FileReader, BUFFER_READ_SIZE
+from caf.report import Corruption, TextReporter, CHECKSUM, HEADER, \
+    MISSING_PARENT, UNREFERENCED, ROOTS, UNEXPECTED, UNREADABLE, MANIFEST, \
+    PACK
+from caf.roots import RootsLog, ROOTS_LOG
+from caf.sampling import SampleResult, DEFAULT_CONFIDENCE, \
+    leaf_prefix_count, random_leaf_prefixes
+from caf.shards import write_shard_result, load_shard_results, unit_shard
+from caf.stats import NULL_STATS
+from caf.throttle import NULL_THROTTLE
+from caf.utils import file_path_to_hash, hash_to_file_path, fork_context
+from caf.walker import TreeWalker, WALK_THREADS
 
 
-BUFFER_READ_SIZE = 1024 * 1024
+MANIFEST_BATCH_RECORDS = 256
+SAMPLE_BATCH_FILES = 64
+# How often the parent reports the corruption found by workers while
+# it waits for their results.
+FOUND_POLL_SECONDS = 0.1
+
+# Set in each worker process by _init_worker.
+_worker_verifier = None
+
+
+def _init_worker(verifier, found_queue):
+    global _worker_verifier
+    _worker_verifier = verifier
+    _worker_verifier._found_queue = found_queue
+
+
+class _Corruptions(list):
+    """The corruption found by a unit of work.
+
+    Each corruption is passed to ``found`` as soon as it's added, so
+    it's reported without waiting for the rest of the unit.  It's
+    pickled as a plain list so it can be sent back from a worker.
+    """
+    def __init__(self, found):
+        super(_Corruptions, self).__init__()
+        self._found = found
+
+    def append(self, corruption):
+        super(_Corruptions, self).append(corruption)
+        self._found(corruption)
+
+    def extend(self, corruptions):
+        for corruption in corruptions:
+            self.append(corruption)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def _run_unit_in_worker(args):
+    # The worker's stats are sent back with each result
+    # so they can be merged into the parent's stats.
+    method_name, unit = args
+    _worker_verifier._stats.reset()
+    result = getattr(_worker_verifier, method_name)(unit)
+    return result, _worker_verifier._stats.snapshot()
 
 
 class FileVerifier(object):
-    ROOTS_DIR = os.path.join('.metadata', 'roots')
+    """Verify files generated by ``caf.generator.FileGenerator``.
 
-    def __init__(self, rootdir):
+    The tree is split into units of work, one for each top level
+    prefix directory of the tree's layout (see ``caf.layout``).  If
+    ``jobs`` is greater than 1, the units are verified in a pool of worker
+    processes and their results are merged as each unit completes.
+
+    ``verify_manifest`` is an alternative to ``verify_files`` that is
+    driven by the manifest written by ``caf gen`` instead of a walk of
+    the tree.
+
+    If the tree was generated with pack storage (see ``caf.pack``), each
+    pack is a unit of work.  Each pack is read sequentially, checking
+    every object's digest and the pack's checksum, and then the objects
+    are compared with the pack's index.
+
+    ``verify_sample`` only verifies a random sample of the files (see
+    ``caf.sampling``).  If ``structure_only`` is True, files aren't hashed
+    at all.  Only their headers are read, which is enough to check the
+    chains of files.
+
+    ``verify_shard`` verifies only part of the tree and writes the result
+    to a file, and ``verify_shard_results`` finishes the verification from
+    the results of every shard (see ``caf.shards``).
+
+    The files of each unit are listed with a ``caf.walker.TreeWalker``
+    using ``walk_threads`` threads, so listing the leaf directories is
+    overlapped with hashing the files already listed.
+
+    The time spent walking the tree ("walk"), and reading ("read") and
+    hashing ("hash") files, along with "file" for each whole file, is
+    recorded in ``stats`` (see ``caf.stats``).
+
+    Corruption is reported to ``reporter`` (see ``caf.report``) as soon
+    as it's found, even when it's found by a worker.  If the reporter has
+    ``max_errors``, ``caf.report.VerificationAborted`` is raised once that
+    many have been reported, and every unit stops as soon as that many
+    have been found in total.
+
+    Files are read with a ``caf.reader.FileReader`` using ``buffer_size``,
+    ``direct_io`` and ``drop_cache``, and hashed with the tree's hash
+    algorithm (see ``caf.hashes``).  Every read is limited by
+    ``throttle`` (a ``caf.throttle.Throttle``), which is shared by all
+    the workers.
+    """
+
+    def __init__(self, rootdir, jobs=1, max_memory=None, spill_dir=None,
+                 incremental=False, full_every=None,
+                 buffer_size=BUFFER_READ_SIZE, stats=None,
+                 structure_only=False, direct_io=False, drop_cache=True,
+                 walk_threads=WALK_THREADS, reporter=None, throttle=None):
         self._rootdir = rootdir
+        self._layout = load_layout(rootdir)
+        self._storage = read_storage(rootdir)
+        self._hash = read_hash(rootdir)
+        self._digest_size = self._hash.digest_size
+        self._root_hash = self._hash.root_hash
+        self._reader = FileReader(buffer_size, direct_io=direct_io,
+                                  drop_cache=drop_cache)
+        if stats is None:
+            stats = NULL_STATS
+        self._stats = stats
+        if throttle is None:
+            throttle = NULL_THROTTLE
+        self._throttle = throttle
+        if reporter is None:
+            reporter = TextReporter()
+        self._reporter = reporter
+        self._max_errors = reporter.max_errors
+        # The number of corruptions found so far, shared with the
+        # workers so they stop once there are too many between them.
+        self._errors_found = fork_context().Value('L', 0)
+        # Set in each worker, see _found_corruption.
+        self._found_queue = None
+        self._walker = TreeWalker(rootdir, self._layout, walk_threads, stats)
+        self._jobs = jobs
+        self._max_memory = max_memory
+        self._spill_dir = spill_dir
+        self._incremental = incremental
+        self._full_every = full_every
+        self._structure_only = structure_only
+        self._cache = VerifyCache(os.path.join(rootdir, CACHE_FILE),
+                                  self._digest_size)
+        self._use_cache = False
         self._verification_succeeded = True
 
     def verify_files(self):
+        """Verify every file in the tree.
+
+        If ``incremental`` is True, files whose stat hasn't changed since
+        the last successful verification are not hashed again.  Their
+        parent digests come from the cache so the reference checks still
+        cover the entire tree.  Every ``full_every`` runs, the cache is
+        ignored and every file is hashed.
+
+        """
         self._verification_succeeded = True
-        referenced = set()
-        known_roots = os.listdir(os.path.join(self._rootdir, self.ROOTS_DIR))
-        files_validated = 0
-        for root, _, filenames in os.walk(self._rootdir):
-            if '.metadata' in root:
-                # We validate the metadata directory separately.
-                continue
-            for filename in filenames:
-                full_path = os.path.join(root, filename)
-                self._validate_checksum(full_path)
-                files_validated += 1
-                parent_full_path = self._get_parent_file(full_path)
-                referenced.add(parent_full_path)
-                if parent_full_path is not None and \
-                        not os.path.isfile(parent_full_path):
-                    sys.stderr.write(
-                        "CORRUPTION: Parent hash not found: %s\n" % (
-                            parent_full_path))
-                    self._verification_succeeded = False
-        self._verify_referenced_files(referenced, known_roots)
-        self._verify_known_roots(known_roots)
+        runs_since_full = self._start_run()
+        known_roots, roots_error = RootsLog(self._rootdir, self._hash).read()
+        method_name, units = self._verification_units()
+        with self._new_digest_set(shares=3) as seen, \
+                self._new_digest_set(shares=3) as referenced, \
+                self._new_digest_set(self._cache.record_size,
+                                     shares=3) as verified:
+            for unit_seen, unit_referenced, unit_verified, _ in \
+                    self._map_units(method_name, units):
+                seen.update(unit_seen)
+                referenced.update(unit_referenced)
+                verified.update(unit_verified)
+            self._verify_referenced_files(
+                seen, referenced,
+                known_roots)
+            self._verify_known_roots(roots_error)
+            if self._incremental and self._verification_succeeded:
+                self._cache.write(verified, runs_since_full)
+        return self._verification_succeeded
+
+    def verify_shard(self, shard, shard_count, result_filename):
+        """Verify the units of work that belong to one shard of the tree.
+
+        ``shard`` is 0 based.  The digests seen and referenced by the
+        shard, along with any corruption found, are written to
+        ``result_filename``.  Returns whether the shard's files were
+        verified successfully, although the tree as a whole is only
+        verified once the results of every shard are merged.
+
+        """
+        self._verification_succeeded = True
+        method_name, units = self._verification_units()
+        units = [unit for unit in units
+                 if unit_shard(os.path.basename(unit), shard_count) == shard]
+        all_corruptions = []
+        with self._new_digest_set() as seen, \
+                self._new_digest_set() as referenced:
+            for unit_seen, unit_referenced, _, corruptions in \
+                    self._map_units(method_name, units):
+                seen.update(unit_seen)
+                referenced.update(unit_referenced)
+                all_corruptions.extend(corruptions)
+            write_shard_result(result_filename, shard, shard_count,
+                               self._digest_size, seen, referenced,
+                               all_corruptions)
+        return self._verification_succeeded
+
+    def verify_shard_results(self, result_filenames):
+        """Finish a verification from the results of every shard.
+
+        Corruption found by each shard is reported again, and then the
+        references between files and the roots are checked across the
+        whole tree.  ``ValueError`` is raised unless there's a result
+        for every shard.
+
+        """
+        self._verification_succeeded = True
+        results = load_shard_results(result_filenames)
+        if results[0].digest_size != self._digest_size:
+            raise ValueError('Shard results are for digests of %s bytes, '
+                             'but the tree uses %s.' % (
+                                 results[0].digest_size, self._hash))
+        for result in results:
+            for corruption in result.corruptions():
+                self._report_corruption(corruption)
+        known_roots, roots_error = RootsLog(self._rootdir, self._hash).read()
+        self._verify_referenced_files(
+            merge_sorted(result.iter_seen() for result in results),
+            merge_sorted(result.iter_referenced() for result in results),
+            known_roots)
+        self._verify_known_roots(roots_error)
+        return self._verification_succeeded
+
+    def _verification_units(self):
+        # Returns the name of the method that verifies each unit of
+        # work, and the units themselves.
+        if self._storage == 'pack':
+            return '_verify_pack_unit', self._pack_units()
+        return '_verify_unit', self._work_units()
+
+    def _start_run(self):
+        # Decide whether this run can use the cache, and return the
+        # number of runs since the last full run to record in the cache
+        # if this run succeeds.
+        self._use_cache = False
+        if not self._incremental:
+            return 0
+        header = self._cache.read_header()
+        if header is None:
+            return 0
+        runs_since_full = header[0] + 1
+        if self._full_every is not None and \
+                runs_since_full >= self._full_every:
+            return 0
+        self._use_cache = True
+        return runs_since_full
+
+    def verify_manifest(self):
+        """Verify the files listed in the manifest.
+
+        The chain of references is checked entirely from the manifest,
+        and then the files are hashed in digest order.  The tree is
+        still listed (but no files are opened) so that files that exist
+        but are missing from the manifest are reported.
+
+        """
+        self._verification_succeeded = True
+        manifest_file = os.path.join(self._rootdir, MANIFEST_FILE)
+        if not os.path.isfile(manifest_file):
+            self._report_corruption(Corruption(
+                MANIFEST, manifest_file,
+                "Manifest not found: %s" % manifest_file))
+            return self._verification_succeeded
+        known_roots, roots_error = RootsLog(self._rootdir, self._hash).read()
+        record_size = self._digest_size * 2
+        with self._new_digest_set(record_size, shares=3) as records, \
+                self._new_digest_set(shares=3) as referenced, \
+                self._new_digest_set(shares=3) as on_disk:
+            for digest, parent, _ in read_manifest(manifest_file,
+                                                   self._digest_size):
+                records.add(digest + parent)
+                if parent != self._root_hash:
+                    referenced.add(parent)
+            self._verify_referenced_files(
+                self._iter_manifest_digests(records), referenced,
+                known_roots)
+            for _ in self._map_units(
+                    '_verify_manifest_unit',
+                    self._iter_manifest_batches(records)):
+                pass
+            for unit_seen, _ in self._map_units(
+                    '_list_unit', self._work_units()):
+                on_disk.update(unit_seen)
+            for binary_sha1, in_manifest, _ in merge_join(
+                    self._iter_manifest_digests(records), on_disk):
+                if not in_manifest:
+                    path = self._hash_to_path(binary_sha1)
+                    self._report_corruption(Corruption(
+                        MANIFEST, path, "File not in manifest: %s" % path))
+        self._verify_known_roots(roots_error)
         return self._verification_succeeded
 
-    def _verify_known_roots(self, known_roots):
-        verify_hash = hashlib.sha1()
-        for root in known_roots:
-            verify_hash.update(root.encode('ascii'))
-        actual = verify_hash.hexdigest().encode('ascii')
-        with open(os.path.join(self._rootdir, '.metadata', 'all'), 'rb') as f:
-            expected = f.read()
-        if actual != expected:
-            sys.stderr.write("CORRUPTION: Root hash is not valid, roots are "
-                             "missing.\n")
+    def check_chain(self, root):
+        """Verify a single chain of files, following it from its root.
+
+        Unlike the ``verify_*`` methods, nothing is reported.  The
+        corruption found (a list of ``caf.report.Corruption``) is
+        returned instead, and the chain is only followed as far as the
+        first problem.  Only files storage is supported.
+
+        """
+        digest = root
+        while True:
+            full_path = self._hash_to_path(digest)
+            try:
+                parent_hash, corruption = self._check_file(full_path)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    return [Corruption(
+                        UNREADABLE, full_path,
+                        "File could not be read: %s (%s)" % (full_path, e))]
+                elif digest == root:
+                    return [Corruption(
+                        ROOTS, full_path, "Root not found: %s" % full_path)]
+                return [Corruption(
+                    MISSING_PARENT, full_path,
+                    "Parent hash not found: %s" % full_path)]
+            if corruption is not None:
+                return [corruption]
+            if parent_hash is None:
+                return []
+            digest = unhexlify(parent_hash.encode('ascii'))
+
+    def verify_sample(self, fraction=None, count=None,
+                      confidence=DEFAULT_CONFIDENCE):
+        """Verify a random sample of the files.
+
+        Either a ``fraction`` of the files or ``count`` files are picked
+        at random.  Each sampled file is verified, and its parent is
+        checked to exist.  Returns a ``caf.sampling.SampleResult``.
+
+        """
+        self._verification_succeeded = True
+        filenames = self._choose_sample(fraction, count)
+        batches = [filenames[i:i + SAMPLE_BATCH_FILES]
+                   for i in range(0, len(filenames), SAMPLE_BATCH_FILES)]
+        sampled = corrupted = 0
+        for unit_sampled, unit_corrupted, _ in self._map_units(
+                '_verify_sample_unit', batches):
+            sampled += unit_sampled
+            corrupted += unit_corrupted
+        known_roots, roots_error = RootsLog(self._rootdir, self._hash).read()
+        self._verify_known_roots(roots_error)
+        return SampleResult(sampled, corrupted, confidence,
+                            self._verification_succeeded)
+
+    def _choose_sample(self, fraction, count):
+        # Every file is in the sample with the same probability.  With a
+        # fraction, that's done by including the right number of whole
+        # leaf directories plus a matching part of one more.
+        rng = random.SystemRandom()
+        if fraction is not None:
+            leaves = fraction * leaf_prefix_count(self._layout)
+            whole_leaves = int(math.floor(leaves))
+            partial_leaf = leaves - whole_leaves
+        chosen = []
+        for i, prefix in enumerate(random_leaf_prefixes(self._layout, rng)):
+            if count is not None and len(chosen) >= count:
+                break
+            filenames = self._list_leaf(prefix)
+            if fraction is not None:
+                if i == whole_leaves:
+                    filenames = rng.sample(
+                        filenames,
+                        int(round(partial_leaf * len(filenames))))
+                elif i > whole_leaves:
+                    break
+            elif len(chosen) + len(filenames) > count:
+                filenames = rng.sample(filenames, count - len(chosen))
+            chosen.extend(filenames)
+        return chosen
+
+    def _list_leaf(self, prefix):
+        directory = os.path.join(
+            self._rootdir, *self._layout.directory_parts(prefix))
+        start = self._stats.start()
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            # Nothing has this prefix.
+            names = []
+        self._stats.stop('walk', start, len(names))
+        return [os.path.join(directory, name) for name in sorted(names)
+                if name != '.metadata']
+
+    def _verify_sample_unit(self, filenames):
+        # Returns the number of files sampled, the number of them that
+        # are corrupted, and what's wrong with them.
+        corrupted = 0
+        corruptions = _Corruptions(self._found_corruption)
+        for full_path in filenames:
+            problems = []
+            if self._expected_binary_hash(full_path) is None:
+                problems.append(Corruption(
+                    UNEXPECTED, full_path, "Unexpected file: %s" % full_path))
+            else:
+                try:
+                    parent_hash, corruption = self._check_file(full_path)
+                except (IOError, OSError) as e:
+                    parent_hash = None
+                    corruption = Corruption(
+                        UNREADABLE, full_path,
+                        "File could not be read: %s (%s)" % (full_path, e))
+                if corruption is not None:
+                    problems.append(corruption)
+                if parent_hash is not None and not os.path.isfile(
+                        os.path.join(self._rootdir, hash_to_file_path(
+                            parent_hash, self._layout))):
+                    problems.append(Corruption(
+                        MISSING_PARENT, full_path,
+                        "Parent hash not found for: %s" % full_path))
+            if problems:
+                corrupted += 1
+                corruptions.extend(problems)
+        return len(filenames), corrupted, corruptions
+
+    def _new_digest_set(self, digest_size=None, shares=2):
+        # The memory budget is split evenly between
+        # all the digest sets in use.
+        if digest_size is None:
+            digest_size = self._digest_size
+        max_memory = self._max_memory
+        if max_memory is not None:
+            max_memory //= shares
+        return DigestSet(digest_size=digest_size, max_memory=max_memory,
+                         spill_dir=self._spill_dir)
+
+    def _map_units(self, method_name, units):
+        # Yields the result of calling ``method_name`` on each unit.
+        # Results are yielded in the order they complete.  The
+        # corruption each unit finds has already been reported by
+        # then, see _found_corruption.
+        if self._jobs <= 1:
+            try:
+                for unit in units:
+                    yield getattr(self, method_name)(unit)
+            finally:
+                self._walker.close()
+            return
+        context = fork_context()
+        found_queue = context.SimpleQueue()
+        pool = context.Pool(self._jobs, initializer=_init_worker,
+                            initargs=(self, found_queue))
+        try:
+            results = pool.imap_unordered(
+                _run_unit_in_worker,
+                ((method_name, unit) for unit in units))
+            while True:
+                try:
+                    result, stats_snapshot = results.next(
+                        FOUND_POLL_SECONDS)
+                except TimeoutError:
+                    self._report_queued(found_queue)
+                    continue
+                except StopIteration:
+                    break
+                # Everything the unit found was queued before its
+                # result was sent.
+                self._report_queued(found_queue)
+                self._stats.merge(stats_snapshot)
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _report_queued(self, found_queue):
+        while not found_queue.empty():
             self._verification_succeeded = False
+            self._reporter.report(found_queue.get())
 
-    def _verify_referenced_files(self, referenced, known_roots):
-        for root, _, filenames in os.walk(self._rootdir):
-            if '.metadata' in root:
+    def _work_units(self):
+        # Each ``ab`` prefix directory is a unit of work.  Anything
+        # else that happens to be in the rootdir is its own unit so
+        # that it still gets verified.  A flat layout has no prefix
+        # directories, so the whole rootdir is a single unit.
+        if self._layout.depth == 0:
+            return [self._rootdir]
+        return [os.path.join(self._rootdir, name)
+                for name in sorted(os.listdir(self._rootdir))
+                if name != '.metadata']
+
+    def _pack_units(self):
+        # Each pack is a unit of work.  Anything else in the tree is
+        # its own unit, so that it's reported as unexpected.
+        units = [os.path.join(self._rootdir, name)
+                 for name in sorted(os.listdir(self._rootdir))
+                 if name not in ('.metadata', PACKS_DIR)]
+        packs_dir = os.path.join(self._rootdir, PACKS_DIR)
+        if not os.path.isdir(packs_dir):
+            return units
+        for name in sorted(os.listdir(packs_dir)):
+            path = os.path.join(packs_dir, name)
+            if name.endswith(INDEX_SUFFIX) and os.path.isfile(
+                    path[:-len(INDEX_SUFFIX)] + PACK_SUFFIX):
+                # Verified along with its pack.
                 continue
-            for filename in filenames:
-                full_path = os.path.join(root, filename)
-                if full_path not in referenced and \
-                        file_path_to_hash(full_path) not in known_roots:
-                    sys.stderr.write(
-                        "CORRUPTION: File not referenced by any files: %s\n" %
-                        (full_path))
-                    self._verification_succeeded = False
-
-    def _get_parent_file(self, full_path):
-        with open(full_path, 'rb') as f:
-            binary_sha1 = f.read(20)
-            if binary_sha1 == b'\x00' * 20:
-                # This is the root file so it has no parent hash.
+            units.append(path)
+        return units
+
+    def _verify_pack_unit(self, path):
+        # Returns the same results as _verify_unit, except nothing is
+        # ever cached.
+        seen = bytearray()
+        referenced = bytearray()
+        corruptions = _Corruptions(self._found_corruption)
+        if not path.endswith(PACK_SUFFIX) or not os.path.isfile(path):
+            corruptions.append(Corruption(
+                UNEXPECTED, path, "Unexpected file: %s" % path))
+            return bytes(seen), bytes(referenced), b'', corruptions
+        entries = []
+        try:
+            checksum = self._scan_pack(path, seen, referenced, entries,
+                                       corruptions)
+        except (IOError, OSError) as e:
+            corruptions.append(Corruption(
+                UNREADABLE, path,
+                "Pack could not be read: %s (%s)" % (path, e)))
+            checksum = None
+        if checksum is None:
+            return bytes(seen), bytes(referenced), b'', corruptions
+        idx_filename = index_filename(path)
+        try:
+            records, index_checksum = PackIndex(
+                idx_filename, self._digest_size).read()
+        except (IOError, OSError, ValueError) as e:
+            corruptions.append(Corruption(
+                PACK, idx_filename,
+                "Pack index could not be read: %s (%s)" % (idx_filename, e)))
+        else:
+            entries.sort()
+            if index_checksum != checksum or records != b''.join(entries):
+                corruptions.append(Corruption(
+                    PACK, idx_filename,
+                    "Pack index does not match its pack: %s" % idx_filename))
+        return bytes(seen), bytes(referenced), b'', corruptions
+
+    def _scan_pack(self, path, seen, referenced, entries, corruptions):
+        # Read every object in a pack, adding the digests of the objects
+        # and their parents to ``seen`` and ``referenced`` and their index
+        # records to ``entries``.  Returns the pack's checksum, or None
+        # if the pack is malformed.
+        stats = self._stats
+        throttle = self._throttle
+        reader = self._reader
+        digest_size = self._digest_size
+        index_record = index_record_struct(digest_size)
+        checksum = self._hash.new()
+        f = reader.open(path)
+        try:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                corruptions.append(Corruption(
+                    PACK, path, "Not a pack file: %s" % path))
                 return None
-            hex_sha1 = hexlify(binary_sha1).decode('ascii')
-            return os.path.join(self._rootdir,
-                                hex_sha1[:2],
-                                hex_sha1[2:4],
-                                hex_sha1[4:])
+            offset = len(PACK_MAGIC)
+            while True:
+                header = f.read(LENGTH.size)
+                if len(header) != LENGTH.size:
+                    corruptions.append(Corruption(
+                        PACK, path, "Pack is truncated: %s" % path))
+                    return None
+                length, = LENGTH.unpack(header)
+                offset += LENGTH.size
+                if length == END_OF_PACK:
+                    break
+                file_start = stats.start()
+                content_hash = self._hash.new()
+                binary_parent = None
+                remaining = length
+                while remaining:
+                    start = stats.start()
+                    io_start = throttle.start()
+                    chunk = reader.read_chunk(f, remaining)
+                    stats.stop('read', start, len(chunk))
+                    throttle.stop(io_start, len(chunk))
+                    if not chunk:
+                        break
+                    if binary_parent is None:
+                        binary_parent = bytes(chunk[:digest_size])
+                    start = stats.start()
+                    content_hash.update(chunk)
+                    stats.stop('hash', start, len(chunk))
+                    remaining -= len(chunk)
+                digest = f.read(digest_size)
+                if remaining or len(digest) != digest_size:
+                    corruptions.append(Corruption(
+                        PACK, path, "Pack is truncated: %s" % path))
+                    return None
+                stats.stop('file', file_start, length)
+                if content_hash.digest() != digest:
+                    hex_digest = hexlify(digest).decode('ascii')
+                    corruptions.append(Corruption(
+                        CHECKSUM, hex_digest,
+                        'Invalid checksum for object %s in pack "%s": '
+                        'actual %s %s' % (
+                            hex_digest, path, self._hash.name,
+                            content_hash.hexdigest())))
+                    if self._too_many_errors():
+                        return None
+                seen.extend(digest)
+                if binary_parent is not None and \
+                        len(binary_parent) == digest_size and \
+                        binary_parent != self._root_hash:
+                    referenced.extend(binary_parent)
+                entries.append(index_record.pack(digest, offset, length))
+                checksum.update(header + digest)
+                offset += length + digest_size
+            trailer = f.read(COUNT.size + digest_size)
+            trailing_data = f.read(1)
+        finally:
+            reader.close(f)
+        if len(trailer) != COUNT.size + digest_size or trailing_data:
+            corruptions.append(Corruption(
+                PACK, path, "Pack has an invalid trailer: %s" % path))
+            return None
+        count, = COUNT.unpack_from(trailer)
+        expected = trailer[COUNT.size:]
+        if count != len(entries) or expected != checksum.digest():
+            corruptions.append(Corruption(
+                PACK, path, "Invalid pack checksum: %s" % path))
+            return None
+        return expected
 
-    def _validate_checksum(self, filename):
-        sha1 = hashlib.sha1()
-        expected_sha1 = ''.join(filename.split(os.sep)[-3:])
+    def _verify_unit(self, path):
+        # Every file is opened exactly once.  The hex digest of each file
+        # comes from its path, and its parent's hex digest comes from its
+        # header.  Whether or not the parents actually exist is checked
+        # once all the units have been merged.  The digests are returned
+        # packed so they're cheap to send back from worker processes.
+        seen = bytearray()
+        referenced = bytearray()
+        verified = bytearray()
+        corruptions = _Corruptions(self._found_corruption)
+        cached = {}
+        if self._use_cache:
+            cached = self._cache.lookup_prefix(file_path_to_hash(
+                os.path.relpath(path, self._rootdir)))
+        for full_path, binary_sha1, entry in self._iter_unit_files(path):
+            if self._too_many_errors():
+                break
+            if binary_sha1 is None and entry is not None:
+                corruptions.append(Corruption(
+                    UNEXPECTED, full_path, "Unexpected file: %s" % full_path))
+                continue
+            if binary_sha1 is not None:
+                seen.extend(binary_sha1)
+            if self._incremental:
+                key = stat_key(entry.stat() if entry is not None
+                               else os.stat(full_path))
+                cached_entry = cached.get(binary_sha1)
+                if cached_entry is not None and cached_entry[1] == key:
+                    binary_parent = cached_entry[0]
+                    if binary_parent != self._root_hash:
+                        referenced.extend(binary_parent)
+                    verified.extend(
+                        self._cache.pack(binary_sha1, binary_parent, key))
+                    continue
+            parent_hash, corruption = self._check_file(full_path)
+            if corruption is not None:
+                corruptions.append(corruption)
+            if parent_hash is not None:
+                binary_parent = unhexlify(parent_hash.encode('ascii'))
+                if len(binary_parent) == self._digest_size:
+                    referenced.extend(binary_parent)
+            else:
+                binary_parent = self._root_hash
+            if self._incremental and corruption is None and \
+                    binary_sha1 is not None:
+                verified.extend(
+                    self._cache.pack(binary_sha1, binary_parent, key))
+        return bytes(seen), bytes(referenced), bytes(verified), corruptions
+
+    def _list_unit(self, path):
+        # Like _verify_unit, except no files are opened.
+        seen = bytearray()
+        corruptions = _Corruptions(self._found_corruption)
+        for full_path, binary_sha1, _ in self._iter_unit_files(path):
+            if self._too_many_errors():
+                break
+            if binary_sha1 is None:
+                corruptions.append(Corruption(
+                    UNEXPECTED, full_path, "Unexpected file: %s" % full_path))
+            else:
+                seen.extend(binary_sha1)
+        return bytes(seen), corruptions
+
+    def _iter_manifest_digests(self, records):
+        # The manifest records are sorted by digest, so
+        # any duplicate digests will be next to each other.
+        last = None
+        for record in records:
+            binary_sha1 = record[:self._digest_size]
+            if binary_sha1 != last:
+                yield binary_sha1
+                last = binary_sha1
+
+    def _iter_manifest_batches(self, records):
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= MANIFEST_BATCH_RECORDS:
+                yield b''.join(batch)
+                batch = []
+        if batch:
+            yield b''.join(batch)
+
+    def _verify_manifest_unit(self, packed_records):
+        corruptions = _Corruptions(self._found_corruption)
+        record_size = self._digest_size * 2
+        for offset in range(0, len(packed_records), record_size):
+            if self._too_many_errors():
+                break
+            binary_sha1 = packed_records[offset:offset + self._digest_size]
+            binary_parent = packed_records[offset + self._digest_size:
+                                           offset + record_size]
+            full_path = self._hash_to_path(binary_sha1)
+            try:
+                parent_hash, corruption = self._validate_checksum(full_path)
+            except (IOError, OSError) as e:
+                corruptions.append(Corruption(
+                    UNREADABLE, full_path,
+                    "File in manifest could not be read: %s (%s)" % (
+                        full_path, e)))
+                continue
+            if corruption is not None:
+                corruptions.append(corruption)
+            if binary_parent == self._root_hash:
+                expected_parent = None
+            else:
+                expected_parent = hexlify(binary_parent).decode('ascii')
+            if parent_hash != expected_parent:
+                corruptions.append(Corruption(
+                    MANIFEST, full_path,
+                    "Parent hash does not match the manifest: %s" %
+                    full_path))
+        return corruptions
+
+    def _iter_unit_files(self, path):
+        # Yields the path, binary digest and DirEntry of each file.  The
+        # digest is None for anything that isn't where the layout puts
+        # files.  A unit that isn't a directory is just a stray file in
+        # the rootdir, which has no entry and fails its checksum.
+        if not os.path.isdir(path):
+            yield path, self._expected_binary_hash(path), None
+            return
+        for digest, entry in self._walker.iter_files(path):
+            if digest is not None:
+                digest = self._binary_digest(digest)
+            yield entry.path, digest, entry
+
+    def _report_corruption(self, corruption):
+        with self._errors_found.get_lock():
+            self._errors_found.value += 1
+        self._verification_succeeded = False
+        self._reporter.report(corruption)
+
+    def _found_corruption(self, corruption):
+        # Called by a unit as soon as it finds a problem.  In a worker,
+        # it's queued for the parent to report.
+        if self._found_queue is None:
+            self._report_corruption(corruption)
+            return
+        with self._errors_found.get_lock():
+            self._errors_found.value += 1
+        self._found_queue.put(corruption)
+
+    def _too_many_errors(self):
+        # Whether enough corruption has been found, by every unit
+        # between them, to abort the verification, so there's no point
+        # carrying on with a unit.
+        return self._max_errors is not None and \
+            self._errors_found.value >= self._max_errors
+
+    def _verify_known_roots(self, roots_error):
+        # The roots log is checked against .metadata/all as it's read,
+        # see caf.roots.
+        if roots_error is not None:
+            self._report_corruption(Corruption(
+                ROOTS, os.path.join(self._rootdir, ROOTS_LOG), roots_error))
+
+    def _verify_referenced_files(self, seen, referenced, known_roots):
+        # Both sets iterate in sorted order, so a single merge join
+        # finds the referenced parents that were never seen and the
+        # seen files that are never referenced.
+        for binary_sha1, was_seen, was_referenced in merge_join(
+                seen, referenced):
+            if not was_seen:
+                path = self._hash_to_path(binary_sha1)
+                self._report_corruption(Corruption(
+                    MISSING_PARENT, path, "Parent hash not found: %s" % path))
+            elif not was_referenced and binary_sha1 not in known_roots:
+                path = self._hash_to_path(binary_sha1)
+                self._report_corruption(Corruption(
+                    UNREFERENCED, path,
+                    "File not referenced by any files: %s" % path))
+
+    def _hash_to_path(self, binary_sha1):
+        hex_sha1 = hexlify(binary_sha1).decode('ascii')
+        if self._storage == 'pack':
+            # Objects in packs don't have a path of their own.
+            return hex_sha1
+        return os.path.join(self._rootdir,
+                            hash_to_file_path(hex_sha1, self._layout))
+
+    def _expected_hash(self, filename):
+        return file_path_to_hash(filename, self._layout)
+
+    def _expected_binary_hash(self, filename):
+        return self._binary_digest(self._expected_hash(filename))
+
+    def _binary_digest(self, expected):
+        if len(expected) != self._digest_size * 2:
+            # Not a generated file, its checksum will already
+            # have been reported as invalid.
+            return None
+        try:
+            return unhexlify(expected.encode('ascii'))
+        except (TypeError, ValueError):
+            return None
+
+    def _check_file(self, filename):
+        if self._structure_only:
+            return self._read_header(filename)
+        return self._validate_checksum(filename)
+
+    def _read_header(self, filename):
+        """Read just the header of a single file.
+
+        Returns the same tuple as ``_validate_checksum``, without
+        checking the file's checksum.
+
+        """
+        start = self._stats.start()
+        io_start = self._throttle.start()
         with open(filename, 'rb') as f:
-            for chunk in iter(lambda: f.read(BUFFER_READ_SIZE), b''):
-                sha1.update(chunk)
-        actual = sha1.hexdigest()
+            binary_parent = f.read(self._digest_size)
+        self._stats.stop('read', start, len(binary_parent))
+        self._throttle.stop(io_start, len(binary_parent))
+        self._stats.stop('file', start, len(binary_parent))
+        if len(binary_parent) != self._digest_size:
+            return None, Corruption(
+                HEADER, filename,
+                'File is too short to have a header: "%s"' % filename)
+        if binary_parent == self._root_hash:
+            return None, None
+        return hexlify(binary_parent).decode('ascii'), None
+
+    def _validate_checksum(self, filename):
+        """Validate the checksum of a single file.
+
+        The file's header is picked up while it's being read, so this
+        returns a tuple of the parent hex digest (``None`` for the first
+        file in a chain) and a ``caf.report.Corruption`` (``None`` if the
+        checksum is valid).
+
+        """
+        stats = self._stats
+        throttle = self._throttle
+        content_hash = self._hash.new()
+        expected_sha1 = self._expected_hash(filename)
+        file_start = start = stats.start()
+        io_start = throttle.start()
+        file_size = 0
+        binary_parent = None
+        # Each chunk is a view of the reader's buffer, which is
+        # reused for the next chunk.
+        for chunk in self._reader.iter_chunks(filename):
+            stats.stop('read', start, len(chunk))
+            throttle.stop(io_start, len(chunk))
+            if binary_parent is None:
+                binary_parent = bytes(chunk[:self._digest_size])
+            file_size += len(chunk)
+            start = stats.start()
+            content_hash.update(chunk)
+            stats.stop('hash', start, len(chunk))
+            start = stats.start()
+            io_start = throttle.start()
+        stats.stop('file', file_start, file_size)
+        if binary_parent is None or \
+                len(binary_parent) != self._digest_size:
+            return None, Corruption(
+                HEADER, filename,
+                'File is too short to have a header: "%s"' % filename)
+
+        if binary_parent == self._root_hash:
+            # This is the root file so it has no parent hash.
+            parent_hash = None
+        else:
+            parent_hash = hexlify(binary_parent).decode('ascii')
+        actual = content_hash.hexdigest()
         if actual != expected_sha1:
             # Better error message.
-            sys.stderr.write(
-                'CORRUPTION: Invalid checksum for file "%s": '
-                'actual sha1 %s\n' % (filename, actual))
-            self._verification_succeeded = False
+            return parent_hash, Corruption(
+                CHECKSUM, filename,
+                'Invalid checksum for file "%s": actual %s %s' % (
+                    filename, self._hash.name, actual))
+        return parent_hash, None
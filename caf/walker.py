@@ -0,0 +1,139 @@
+"""List the files of a tree using its layout.
+
+``os.walk`` lists one directory at a time and has to check every entry to
+find out whether it's a directory to descend into, so on a network
+filesystem listing a tree is serialized on the latency of each readdir.
+The layout of a tree (see ``caf.layout``) already says where every file
+is: each level of directories is named after ``width`` hex characters,
+and files are only ever in the directories at the bottom level.
+
+A ``TreeWalker`` lists the tree a level at a time, with every directory
+of a level listed by ``os.scandir`` in a pool of threads.  Only the
+directories named the way the layout says are followed, and as soon as a
+leaf directory has been listed its files are yielded as a batch of
+``(digest, entry)`` tuples while the other threads carry on listing.
+``digest`` is the hex digest of the file according to its path, and
+``entry`` is its ``os.DirEntry``.  Anything that doesn't belong in the
+layout (e.g. a file in one of the upper directories, or a directory in a
+leaf directory) is yielded with a digest of ``None``.  ``.metadata`` in
+the rootdir is skipped.
+
+"""
+import os
+import errno
+from multiprocessing.pool import ThreadPool
+
+from caf.stats import NULL_STATS
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+
+WALK_THREADS = 8
+METADATA_DIR = '.metadata'
+HEX_CHARS = frozenset('0123456789abcdef')
+
+
+class _ListdirEntry(object):
+    # The parts of os.DirEntry that are used, for Pythons without
+    # os.scandir.
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def list_directory(directory):
+    """Return the entries of a directory, or [] if it doesn't exist."""
+    try:
+        if scandir is None:
+            return [_ListdirEntry(directory, name)
+                    for name in os.listdir(directory)]
+        return list(scandir(directory))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+
+class TreeWalker(object):
+    def __init__(self, rootdir, layout, threads=WALK_THREADS,
+                 stats=NULL_STATS):
+        self._rootdir = rootdir
+        self._layout = layout
+        self._threads = threads
+        self._stats = stats
+        self._pool = None
+        self._pool_pid = None
+
+    def walk(self, path=None):
+        """Yield a batch of ``(digest, entry)`` tuples for each directory.
+
+        ``path`` is the rootdir (the default), or a directory at one of
+        the levels of the layout, in which case only the files under it
+        are listed.
+        """
+        if path is None:
+            path = self._rootdir
+        relative = os.path.relpath(path, self._rootdir)
+        parts = [] if relative == os.curdir else relative.split(os.sep)
+        pending = [(path, ''.join(parts), len(parts))]
+        while pending:
+            next_level = []
+            for prefix, level, entries in self._get_pool().imap_unordered(
+                    self._list, pending):
+                batch = []
+                for entry in entries:
+                    if level == 0 and entry.name == METADATA_DIR:
+                        continue
+                    if level < self._layout.depth and \
+                            self._is_layout_directory(entry):
+                        next_level.append(
+                            (entry.path, prefix + entry.name, level + 1))
+                    elif level == self._layout.depth and \
+                            not entry.is_dir():
+                        batch.append((prefix + entry.name, entry))
+                    else:
+                        batch.append((None, entry))
+                if batch:
+                    yield batch
+            pending = next_level
+
+    def iter_files(self, path=None):
+        """Yield the ``(digest, entry)`` of every file, one at a time."""
+        for batch in self.walk(path):
+            for digest, entry in batch:
+                yield digest, entry
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
+
+    def _get_pool(self):
+        # Forked workers each need a pool of their own, which lasts
+        # as long as the worker.
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPool(self._threads)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def _list(self, args):
+        directory, prefix, level = args
+        start = self._stats.start()
+        entries = list_directory(directory)
+        self._stats.stop('walk', start, len(entries))
+        return prefix, level, entries
+
+    def _is_layout_directory(self, entry):
+        name = entry.name
+        return len(name) == self._layout.width and \
+            HEX_CHARS.issuperset(name) and entry.is_dir()
@@ -0,0 +1,182 @@
+"""Write large files at the sequential bandwidth of the storage.
+
+Writing a multi-GB file one buffer at a time into a file that grows with
+every write means the filesystem allocates extents as it goes (and may
+fragment them), and hashing each buffer holds up the next write.  A
+``LargeFileWriter`` instead:
+
+* Reserves the whole file up front with ``posix_fallocate``, where the
+  platform has it.  Filesystems that can't preallocate are written to as
+  usual.
+* Writes the header along with the first buffer of content with a single
+  ``os.writev``, sized so that every later buffer is written with
+  ``os.pwrite`` at an offset that's a multiple of ``WRITE_ALIGNMENT``.
+  The buffer size is rounded up to a multiple of it too.  Where the
+  platform doesn't have them, ``os.write`` and ``os.lseek`` are used.
+* Hashes each buffer on a separate thread while the next buffer is
+  generated and written.  Both ``hashlib`` and the writes release the GIL
+  for buffers this size, so hashing overlaps with the I/O.  At most
+  ``HASH_QUEUE_BUFFERS`` buffers wait to be hashed at once.
+
+``caf.generator.FileGenerator`` uses it for files of at least
+``large_file_size`` bytes.
+
+"""
+import os
+import errno
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from caf.stats import NULL_STATS
+from caf.throttle import NULL_THROTTLE
+
+
+WRITE_ALIGNMENT = 4096
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+HASH_QUEUE_BUFFERS = 4
+
+_can_fallocate = hasattr(os, 'posix_fallocate')
+# Without writev and pwrite, the same writes are made with lseek and
+# write instead.
+_can_writev = hasattr(os, 'writev')
+_can_pwrite = hasattr(os, 'pwrite')
+# Errors that mean the filesystem can't preallocate the file.
+_FALLOCATE_UNSUPPORTED = (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS)
+
+
+def aligned_buffer_size(buffer_size):
+    """Round a buffer size up to a multiple of ``WRITE_ALIGNMENT``."""
+    return max(1, -(-buffer_size // WRITE_ALIGNMENT)) * WRITE_ALIGNMENT
+
+
+class _HashingThread(threading.Thread):
+    def __init__(self, content_hash, stats):
+        super(_HashingThread, self).__init__()
+        self.daemon = True
+        self._hash = content_hash
+        self._stats = stats
+        self._queue = Queue(HASH_QUEUE_BUFFERS)
+
+    def update(self, data):
+        self._queue.put(data)
+
+    def finish(self):
+        """Wait for every buffer to be hashed."""
+        self._queue.put(None)
+        self.join()
+
+    def digest(self):
+        self.finish()
+        return self._hash.digest()
+
+    def run(self):
+        for data in iter(self._queue.get, None):
+            start = self._stats.start()
+            self._hash.update(data)
+            self._stats.stop('hash', start, len(data))
+
+
+class LargeFileWriter(object):
+    """Write the header and content of large files.
+
+    The time spent in each phase ("fallocate", "rng", "write" and
+    "hash") is recorded in ``stats``, and every write is limited by
+    ``throttle``.
+    """
+    def __init__(self, algorithm, stats=None, throttle=None):
+        self._algorithm = algorithm
+        if stats is None:
+            stats = NULL_STATS
+        self._stats = stats
+        if throttle is None:
+            throttle = NULL_THROTTLE
+        self._throttle = throttle
+
+    def write(self, fd, parent_hash, file_size, buffer_size,
+              content_source):
+        """Write a new file to ``fd``, and return its digest.
+
+        The file is ``parent_hash`` followed by random content from
+        ``content_source``, for ``file_size`` bytes in total.  The
+        content is written ``buffer_size`` bytes (rounded up to a
+        multiple of ``WRITE_ALIGNMENT``) at a time.
+        """
+        buffer_size = aligned_buffer_size(buffer_size)
+        self._preallocate(fd, file_size)
+        hasher = _HashingThread(self._algorithm.new(), self._stats)
+        hasher.start()
+        try:
+            hasher.update(parent_hash)
+            # A file smaller than the header is just the header, the
+            # same as caf.generator writes small files.
+            chunk = self._read(content_source, max(0, min(
+                buffer_size, file_size) - len(parent_hash)))
+            hasher.update(chunk)
+            self._writev(fd, [parent_hash, chunk])
+            offset = len(parent_hash) + len(chunk)
+            while offset < file_size:
+                chunk = self._read(content_source,
+                                   min(buffer_size, file_size - offset))
+                hasher.update(chunk)
+                self._pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        except BaseException:
+            hasher.finish()
+            raise
+        return hasher.digest()
+
+    def _preallocate(self, fd, size):
+        if not _can_fallocate:
+            return
+        start = self._stats.start()
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno not in _FALLOCATE_UNSUPPORTED:
+                raise
+            return
+        self._stats.stop('fallocate', start, size)
+
+    def _read(self, content_source, size):
+        start = self._stats.start()
+        data = content_source.read(size)
+        self._stats.stop('rng', start, size)
+        return data
+
+    def _writev(self, fd, buffers):
+        # The file is new, so its offset is still 0.
+        size = sum(len(data) for data in buffers)
+        start = self._stats.start()
+        io_start = self._throttle.start()
+        if _can_writev:
+            written = os.writev(fd, buffers)
+        else:
+            data = b''.join(buffers)
+            written = os.write(fd, data)
+        if written < size:
+            self._pwrite_all(fd, b''.join(buffers)[written:], written)
+        self._stats.stop('write', start, size)
+        self._throttle.stop(io_start, size)
+
+    def _pwrite(self, fd, data, offset):
+        start = self._stats.start()
+        io_start = self._throttle.start()
+        self._pwrite_all(fd, data, offset)
+        self._stats.stop('write', start, len(data))
+        self._throttle.stop(io_start, len(data))
+
+    def _pwrite_all(self, fd, data, offset):
+        view = memoryview(data)
+        if not _can_pwrite:
+            os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            if _can_pwrite:
+                written = os.pwrite(fd, view, offset)
+            else:
+                written = os.write(fd, view)
+            view = view[written:]
+            offset += written
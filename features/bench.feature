@@ -0,0 +1,10 @@
+Feature: Benchmark Generating and Verifying Files
+
+  As a user
+  I want to be able to benchmark caf against my storage
+  So that I can track performance across releases and backends.
+
+  Scenario: Running a small benchmark
+    Given a new working directory
+    When I run "caf bench --max-disk-usage 1MB --file-size 4kb --workers 1 --workers 2 --output results.json"
+    Then the file "results.json" should contain 4 benchmark results
@@ -0,0 +1,39 @@
+Feature: Churn
+
+  As a user
+  I want to keep generating, verifying and deleting files in a directory
+  So that I can measure how the storage performs as it ages.
+
+  Scenario Outline: The directory still verifies after churning
+    Given a new working directory
+    When I run "caf gen --max-files 200 --workers 2"
+     and I run "caf churn --target-fill 200KB --chain-files 20 <arguments>"
+     and I run the verification process
+    Then the verification should succeed
+     and the command output should contain "churn summary"
+
+    Examples:
+      | arguments                                     |
+      | --max-operations 100                          |
+      | --max-operations 100 --workers 4              |
+      | --max-operations 50 --mix gen=1,delete=1      |
+      | --duration 1s --workers 2 --durability syncfs |
+
+  Scenario: Deleted files are removed from the manifest
+    Given a new working directory
+    When I run "caf gen --max-files 100 --workers 4"
+     and I run "caf churn --target-fill 100KB --max-operations 4 --mix delete=1"
+     and I run the verification process with "--manifest"
+    Then the verification should succeed
+     and the total number of files created should be 0
+
+  Scenario: The throughput of each interval is written as JSON
+    Given a new working directory
+    When I run "caf churn --directory data --target-fill 1MB --duration 1s --report-interval 0.2 --throughput-json churn.jsonl"
+    Then the file "churn.jsonl" should contain ""type": "interval""
+     and the file "churn.jsonl" should contain ""type": "summary""
+
+  Scenario: Churn can't be used with pack storage
+    Given a new working directory
+    When I run "caf gen --storage pack --max-files 10"
+    Then running "caf churn --target-fill 1MB --max-operations 1" should fail
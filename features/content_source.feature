@@ -0,0 +1,17 @@
+Feature: Choose the Source of Random Content
+
+  As a user
+  I want to be able to choose where the random file content comes from
+  So that I can generate files faster or reproducibly.
+
+  Scenario: Generating files with the fast content source
+    Given a new working directory
+    When I run "caf gen --content-source fast --max-files 20 --file-size 1mb"
+     and I run the verification process
+    Then the verification should succeed
+
+  Scenario: Generating files with the seeded content source
+    Given a new working directory
+    When I run "caf gen --content-source seeded --seed 42 --max-files 20"
+     and I run the verification process
+    Then the verification should succeed
@@ -0,0 +1,24 @@
+Feature: Durable file generation
+
+  As a user
+  I want generated files to be synced to disk
+  So that a crash doesn't leave a tree that fails verification.
+
+  Scenario Outline: Generating files with a durability mode
+    Given a new working directory
+    When I run "caf gen --max-files 50 --durability <mode>"
+     and I run the verification process
+    Then the total number of files created should be 50
+     and the verification should succeed
+
+    Examples:
+      | mode   |
+      | file   |
+      | batch  |
+      | syncfs |
+
+  Scenario: Syncing small batches of files from multiple workers
+    Given a new working directory
+    When I run "caf gen --workers 2 --max-files 50 --durability batch --durability-batch-files 7"
+     and I run the verification process
+    Then the verification should succeed
@@ -23,3 +23,18 @@ Feature: Specify Size of Created Files
     Given a new working directory
     When I run "caf gen --file-size 4048-8096 --max-files 5"
     Then the size of each generated file should be between 4048 and 8096
+
+  Scenario: Specify sizes from a histogram
+    Given a new working directory
+      and a file "sizes.csv" containing
+        """
+        size,count
+        4kb,1
+        8kb,1
+        """
+    When I run "caf gen --directory data --file-size histogram=sizes.csv --max-files 50"
+    Then the sizes of the generated files in "data" should be "4096,8192"
+
+  Scenario: Specify sizes from a missing histogram
+    Given a new working directory
+    Then running "caf gen --file-size histogram=missing.csv" should fail
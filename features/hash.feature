@@ -0,0 +1,55 @@
+Feature: Hash algorithm
+
+  As a user
+  I want to choose the hash algorithm files are named after
+  So that generating and verifying files isn't limited by sha1.
+
+  Scenario Outline: Generating and verifying files with a hash algorithm
+    Given a new working directory
+    When I run "caf gen --max-files 50 --hash <hash>"
+     and I run the verification process with "<arguments>"
+    Then the total number of files created should be 50
+     and each generated file should be named after a <digest_size> byte digest
+     and the file ".metadata/hash" should contain "<hash> <digest_size>"
+     and the verification should succeed
+
+    Examples:
+      | hash    | digest_size | arguments     |
+      | sha1    | 20          | --jobs 2      |
+      | blake2b | 32          | --manifest    |
+      | sha256  | 32          | --incremental |
+
+  Scenario: Verification detects corruption with blake2b
+    Given a new working directory
+    When I run "caf gen --max-files 50 --hash blake2b"
+     and I run remove a random file
+     and I run the verification process
+    Then the verification should fail
+
+  Scenario: Generating and verifying packs with blake2b
+    Given a new working directory
+    When I run "caf gen --max-files 50 --storage pack --hash blake2b --workers 2"
+     and I run the verification process
+    Then there should be pack files
+     and the verification should succeed
+
+  Scenario: Sharded verification with sha256
+    Given a new working directory
+    When I run "caf gen --directory data --max-files 50 --hash sha256"
+     and I run "caf verify data --shard 1/2 --shard-result one"
+     and I run "caf verify data --shard 2/2 --shard-result two"
+     and I run "caf verify-merge data one two"
+    Then the command output should contain "All files successfully verified."
+
+  Scenario: Resuming an interrupted run keeps its hash algorithm
+    Given a new working directory
+    When I interrupt "caf gen --max-files 1000000 --file-size 1kb --checkpoint-files 100 --hash blake2b" after 1 seconds
+     and I run "caf gen --resume --max-files 10"
+     and I run the verification process with "--manifest"
+    Then each generated file should be named after a 32 byte digest
+     and the verification should succeed
+
+  Scenario: The hash algorithm of existing files can't be changed
+    Given a new working directory
+    When I run "caf gen --max-files 5 --hash blake2b"
+    Then running "caf gen --max-files 5 --hash sha1" should fail
@@ -0,0 +1,25 @@
+Feature: Large files
+
+  As a user
+  I want large files to be written with preallocation and aligned writes
+  So that generating multi-GB files runs at the bandwidth of the storage.
+
+  Scenario Outline: Generating large files
+    Given a new working directory
+    When I run "caf gen --max-files 3 --large-file-size 1MB <arguments>"
+     and I run the verification process
+    Then the total number of files created should be 3
+     and the verification should succeed
+
+    Examples:
+      | arguments                                       |
+      | --file-size 3MB                                 |
+      | --file-size 3MB --buffer-size 100000            |
+      | --file-size 1MB-5MB --content-source fast       |
+      | --file-size 3MB --workers 3 --durability file   |
+      | --file-size 3MB --max-bandwidth 50MB/s          |
+
+  Scenario: Large files are the requested size
+    Given a new working directory
+    When I run "caf gen --max-files 2 --file-size 2MB --large-file-size 1MB --buffer-size 300KB"
+    Then the size of each generated file should be 2097152
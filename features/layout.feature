@@ -0,0 +1,38 @@
+Feature: Directory layout
+
+  As a user
+  I want to choose how many levels of directories files are stored in
+  So that directories stay a reasonable size on huge trees.
+
+  Scenario Outline: Generating and verifying files with a layout
+    Given a new working directory
+    When I run "caf gen --max-files 50 --layout <layout>"
+     and I run the verification process with "<arguments>"
+    Then the total number of files created should be 50
+     and each generated file should be <depth> directories deep
+     and the verification should succeed
+
+    Examples:
+      | layout          | depth | arguments     |
+      | depth=3,width=1 | 3     | --jobs 2      |
+      | depth=1,width=3 | 1     | --manifest    |
+      | depth=0,width=2 | 0     | --incremental |
+
+  Scenario: Verification detects corruption with a layout
+    Given a new working directory
+    When I run "caf gen --max-files 50 --layout depth=3,width=1"
+     and I run remove a random file
+     and I run the verification process
+    Then the verification should fail
+
+  Scenario: The layout of existing files can't be changed
+    Given a new working directory
+    When I run "caf gen --max-files 5 --layout depth=3,width=1"
+    Then running "caf gen --max-files 5 --layout depth=1,width=1" should fail
+
+  Scenario: Verification detects files outside of the layout
+    Given a new working directory
+    When I run "caf gen --max-files 50 --layout depth=2,width=1"
+     and I run "mkdir -p a && touch a/stray"
+     and I run the verification process with "--walk-threads 4"
+    Then the verification should fail
@@ -0,0 +1,18 @@
+Feature: Manifest Driven Verification
+
+  As a user
+  I want to be able to verify files from the manifest written by caf gen
+  So that I don't have to rediscover the tree by walking it.
+
+  Scenario: Manifest verification succeeds
+    Given a new working directory
+    When I run "caf gen --workers 2 --max-files 100"
+     and I run the verification process with "--manifest"
+    Then the verification should succeed
+
+  Scenario: Manifest verification fails
+    Given a new working directory
+      and a new caf directory
+    When I run remove a random file
+     and I run the verification process with "--manifest"
+    Then the verification should fail
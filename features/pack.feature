@@ -0,0 +1,31 @@
+Feature: Pack storage
+
+  As a user
+  I want to be able to store lots of small files in pack files
+  So that I can test sequential I/O without per file overhead.
+
+  Scenario: Generating and verifying files in packs
+    Given a new working directory
+    When I run "caf gen --storage pack --pack-size 64kb --workers 2 --max-files 200"
+     and I run the verification process with "--jobs 2"
+    Then the verification should succeed
+     and there should be pack files
+
+  Scenario: Verification detects a corrupted pack
+    Given a new working directory
+    When I run "caf gen --storage pack --pack-size 64kb --max-files 200"
+     and I corrupt a random pack file
+     and I run the verification process
+    Then the verification should fail
+
+  Scenario: Verification detects a missing pack
+    Given a new working directory
+    When I run "caf gen --storage pack --pack-size 64kb --max-files 200"
+     and I remove a random pack file
+     and I run the verification process
+    Then the verification should fail
+
+  Scenario: The storage of existing files can't be changed
+    Given a new working directory
+    When I run "caf gen --storage pack --max-files 5"
+    Then running "caf gen --storage files --max-files 5" should fail
@@ -0,0 +1,34 @@
+Feature: Parallel file generation and verification
+
+  As a user
+  I want to be able to generate and verify files in parallel
+  So that I can make use of all the cores and disks I have.
+
+  Scenario: Generating files with multiple workers
+    Given a new working directory
+    When I run "caf gen --workers 4 --max-files 50"
+    Then the total number of files created should be 50
+
+  Scenario: Parallel generation shares the disk usage budget
+    Given a new working directory
+    When I run "caf gen --workers 4 --max-disk-usage 1MB"
+    Then the total disk usage of files generated should be 1048576
+
+  Scenario: Verifying files generated by multiple workers
+    Given a new working directory
+    When I run "caf gen --workers 4 --max-files 50"
+     and I run the verification process
+    Then the verification should succeed
+
+  Scenario: Verifying files with multiple jobs
+    Given a new working directory
+    When I run "caf gen --workers 4 --max-files 200"
+     and I run the verification process with "--jobs 4"
+    Then the verification should succeed
+
+  Scenario: Parallel verification detects missing files
+    Given a new working directory
+      and a new caf directory
+    When I run remove a random file
+     and I run the verification process with "--jobs 4"
+    Then the verification should fail
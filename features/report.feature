@@ -0,0 +1,39 @@
+Feature: Corruption reports
+
+  As a user
+  I want corruption reported in a structured form, and as soon as possible
+  So that I can alert on it without waiting for the whole tree to be verified.
+
+  Scenario: Reporting corruption as JSON lines
+    Given a new working directory
+    When I run "caf gen --directory data --max-files 50"
+     and I remove a random file from "data"
+    Then running "caf verify data --report jsonl --report-file report.jsonl" should fail verification
+     and the file "report.jsonl" should contain ""type": "corruption""
+     and the file "report.jsonl" should contain ""succeeded": false"
+
+  Scenario: A successful verification reports a summary
+    Given a new working directory
+    When I run "caf gen --directory data --max-files 50"
+     and I run "caf verify data --report jsonl --report-file report.jsonl"
+    Then the file "report.jsonl" should contain ""corruptions": 0"
+
+  Scenario Outline: Stopping after the maximum number of errors
+    Given a new working directory
+    When I run "caf gen --directory data --max-files 50"
+     and I remove a random file from "data"
+     and I remove a random file from "data"
+     and I remove a random file from "data"
+    Then running "caf verify data <arguments> --report jsonl --report-file report.jsonl" should fail verification
+     and the file "report.jsonl" should contain ""corruptions": <errors>"
+     and the file "report.jsonl" should contain ""aborted": true"
+
+    Examples:
+      | arguments      | errors |
+      | --fail-fast    | 1      |
+      | --max-errors 2 | 2      |
+
+  Scenario: --fail-fast and --max-errors can't be used together
+    Given a new working directory
+    When I run "caf gen --max-files 5"
+    Then running "caf verify --fail-fast --max-errors 2" should fail
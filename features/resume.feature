@@ -0,0 +1,31 @@
+Feature: Resume interrupted generation
+
+  As a user
+  I want to be able to resume an interrupted caf gen run
+  So that a multi-day run doesn't have to start over.
+
+  Scenario: An interrupted run fails verification
+    Given a new working directory
+    When I interrupt "caf gen --max-files 1000000 --file-size 1kb --checkpoint-files 100" after 1 seconds
+     and I run the verification process
+    Then the verification should fail
+
+  Scenario: Resuming an interrupted run
+    Given a new working directory
+    When I interrupt "caf gen --max-files 1000000 --file-size 1kb --checkpoint-files 100" after 1 seconds
+     and I run "caf gen --resume --max-files 10"
+     and I run the verification process with "--manifest"
+    Then the verification should succeed
+     and the directory ".metadata/tmp" should be empty
+
+  Scenario: Resuming an interrupted run with pack storage
+    Given a new working directory
+    When I interrupt "caf gen --max-files 1000000 --file-size 1kb --storage pack --pack-size 100kb" after 1 seconds
+     and I run "caf gen --resume --max-files 10"
+     and I run the verification process
+    Then the verification should succeed
+     and the directory ".metadata/tmp" should be empty
+
+  Scenario: Resuming without an interrupted run
+    Given a new working directory
+    Then running "caf gen --resume" should fail
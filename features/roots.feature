@@ -0,0 +1,28 @@
+Feature: Root registry
+
+  As a user
+  I want the roots of every chain to be recorded safely
+  So that I can generate files into a directory many times, even at once.
+
+  Scenario: Verifying files from repeated generation runs
+    Given a new working directory
+    When I run "caf gen --max-files 20"
+     and I run "caf gen --max-files 20 --workers 2"
+     and I run "caf gen --max-files 20"
+     and I run the verification process
+    Then the verification should succeed
+
+  Scenario: Verifying files from concurrent generation runs
+    Given a new working directory
+    When I run "caf gen --max-files 50 & caf gen --max-files 50 & caf gen --max-files 50 & wait"
+     and I run the verification process
+    Then the verification should succeed
+     and the total number of files created should be 150
+
+  Scenario: Verification detects a truncated roots log
+    Given a new working directory
+    When I run "caf gen --max-files 20"
+     and I run "caf gen --max-files 20"
+     and I truncate the roots log
+     and I run the verification process
+    Then the verification should fail
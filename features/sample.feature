@@ -0,0 +1,39 @@
+Feature: Sampling verification
+
+  As a user
+  I want to be able to verify a random sample of files
+  So that I can check the health of a huge tree quickly.
+
+  Scenario: Verifying a percentage of the files
+    Given a new working directory
+    When I run "caf gen --max-files 200"
+     and I run the verification process with "--sample 50% --jobs 2"
+    Then the verification should succeed
+     and the verification should report the corruption rate
+
+  Scenario: Verifying a number of files
+    Given a new working directory
+    When I run "caf gen --max-files 200"
+     and I run the verification process with "--sample-count 20"
+    Then the verification should succeed
+     and the verification should report the corruption rate
+
+  Scenario: Sampling every file detects a missing file
+    Given a new working directory
+    When I run "caf gen --max-files 200"
+     and I run remove a random file
+     and I run the verification process with "--sample 100%"
+    Then the verification should fail
+
+  Scenario: Checking only the structure of the files
+    Given a new working directory
+    When I run "caf gen --max-files 200"
+     and I run the verification process with "--structure-only"
+    Then the verification should succeed
+
+  Scenario: Checking only the structure detects a missing file
+    Given a new working directory
+    When I run "caf gen --max-files 200"
+     and I run remove a random file
+     and I run the verification process with "--structure-only --jobs 2"
+    Then the verification should fail
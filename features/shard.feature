@@ -0,0 +1,28 @@
+Feature: Sharded verification
+
+  As a user
+  I want to be able to verify parts of a tree on different hosts
+  So that verification can scale out across many hosts.
+
+  Scenario: Verifying every shard and merging the results
+    Given a new working directory
+    When I run "caf gen --directory data --workers 2 --max-files 300"
+     and I run "caf verify data --shard 1/3"
+     and I run "caf verify data --shard 2/3 --jobs 2"
+     and I run "caf verify data --shard 3/3 --structure-only"
+     and I run "caf verify-merge data caf-shard-1-of-3.result caf-shard-2-of-3.result caf-shard-3-of-3.result"
+    Then the command output should contain "All files successfully verified."
+
+  Scenario: Merging detects a missing file in another shard
+    Given a new working directory
+    When I run "caf gen --directory data --max-files 300"
+     and I remove a random file from "data"
+     and I run "caf verify data --shard 1/2 --shard-result one"
+     and I run "caf verify data --shard 2/2 --shard-result two"
+    Then running "caf verify-merge data one two" should fail verification
+
+  Scenario: Merging requires every shard
+    Given a new working directory
+    When I run "caf gen --directory data --max-files 30"
+     and I run "caf verify data --shard 1/2 --shard-result one"
+    Then running "caf verify-merge data one" should fail verification
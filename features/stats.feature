@@ -0,0 +1,16 @@
+Feature: Stats reporting
+
+  As a user
+  I want to see how fast files are being generated and verified
+  So that I can tell where the time is being spent.
+
+  Scenario: Writing stats as JSON
+    Given a new working directory
+    When I run "caf gen --directory data --workers 2 --max-files 20 --stats-json stats.json"
+    Then the stats file "stats.json" should count 20 files
+
+  Scenario: Writing stats for Prometheus
+    Given a new working directory
+    When I run "caf gen --directory data --max-files 20 --progress --prometheus-textfile caf.prom"
+     and I run "caf verify data --progress --prometheus-textfile caf.prom"
+    Then the file "caf.prom" should contain "caf_phase_seconds_count{operation="verify",phase="file"} 20"
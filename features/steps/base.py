@@ -1,9 +1,15 @@
 from behave import *
+import json
 import random
 import contextlib
+import signal
+import time
 import os
 from subprocess import Popen, PIPE
-from hamcrest import assert_that, equal_to
+from hamcrest import assert_that, equal_to, contains_string
+
+from caf.layout import load_layout
+from caf.walker import TreeWalker
 
 import tempfile
 
@@ -19,14 +25,12 @@ def cd(dirname):
 
 
 def get_all_generated_files(rootdir):
-    for root, _, filenames in os.walk(rootdir):
-        if '.metadata' in root:
-            # Don't iterate over the files in .metadata,
-            # these aren't the randomly generates files.
-            continue
-        for filename in filenames:
-            full_path = os.path.join(root, filename)
-            yield full_path
+    # Only the files where the tree's layout puts them, so nothing in
+    # .metadata (or anywhere else) is counted as a generated file.
+    walker = TreeWalker(rootdir, load_layout(rootdir))
+    for digest, entry in walker.iter_files():
+        if digest is not None:
+            yield entry.path
 
 
 class CommandResult(object):
@@ -111,8 +115,17 @@ def step_impl(context):
 
 @when(u'I run the verification process')
 def step_impl(context):
+    run_verify_command(context, 'caf verify')
+
+
+@when(u'I run the verification process with "{arguments}"')
+def step_impl(context, arguments):
+    run_verify_command(context, 'caf verify %s' % arguments)
+
+
+def run_verify_command(context, command):
     with cd(context.working_dir):
-        p = Popen('caf verify', shell=True,
+        p = Popen(command, shell=True,
                   stderr=PIPE, stdout=PIPE)
         stdout, stderr = p.communicate()
         result = CommandResult(stdout, stderr, p.returncode)
@@ -124,3 +137,147 @@ def step_impl(context):
     filenames = list(get_all_generated_files(context.working_dir))
     filename = random.choice(filenames)
     os.remove(filename)
+
+
+@when(u'I remove a random file from "{dirname}"')
+def step_impl(context, dirname):
+    filenames = list(get_all_generated_files(
+        os.path.join(context.working_dir, dirname)))
+    os.remove(random.choice(filenames))
+
+
+@then(u'the file "{filename}" should contain {num_results} benchmark results')
+def step_impl(context, filename, num_results):
+    with open(os.path.join(context.working_dir, filename)) as f:
+        report = json.load(f)
+    assert_that(len(report['results']), equal_to(int(num_results)))
+
+
+@then(u'the stats file "{filename}" should count {num_files} files')
+def step_impl(context, filename, num_files):
+    with open(os.path.join(context.working_dir, filename)) as f:
+        stats = json.load(f)
+    assert_that(stats['phases']['file']['count'], equal_to(int(num_files)))
+
+
+@then(u'the file "{filename}" should contain "{text}"')
+def step_impl(context, filename, text):
+    with open(os.path.join(context.working_dir, filename)) as f:
+        contents = f.read()
+    assert_that(contents, contains_string(text))
+
+
+@then(u'each generated file should be {depth} directories deep')
+def step_impl(context, depth):
+    for full_path in get_all_generated_files(context.working_dir):
+        relative_path = os.path.relpath(full_path, context.working_dir)
+        assert_that(len(relative_path.split(os.sep)) - 1,
+                    equal_to(int(depth)), relative_path)
+
+
+@then(u'running "{command}" should fail')
+def step_impl(context, command):
+    with cd(context.working_dir):
+        p = Popen(command, shell=True, stderr=PIPE, stdout=PIPE)
+        p.communicate()
+    assert_that(p.returncode, equal_to(2))
+
+
+def get_pack_files(rootdir):
+    packs_dir = os.path.join(rootdir, 'packs')
+    return [os.path.join(packs_dir, name)
+            for name in sorted(os.listdir(packs_dir))
+            if name.endswith('.pack')]
+
+
+@then(u'there should be pack files')
+def step_impl(context):
+    assert_that(len(get_pack_files(context.working_dir)) > 0,
+                equal_to(True))
+
+
+@when(u'I corrupt a random pack file')
+def step_impl(context):
+    filename = random.choice(get_pack_files(context.working_dir))
+    with open(filename, 'r+b') as f:
+        # Flip a bit in the middle of the pack.
+        f.seek(os.path.getsize(filename) // 2)
+        byte = bytearray(f.read(1))
+        byte[0] ^= 1
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes(byte))
+
+
+@when(u'I remove a random pack file')
+def step_impl(context):
+    filename = random.choice(get_pack_files(context.working_dir))
+    os.remove(filename)
+    os.remove(filename[:-len('.pack')] + '.idx')
+
+
+@then(u'the verification should report the corruption rate')
+def step_impl(context):
+    stdout = context.verify_command_result.stdout.decode('utf-8')
+    assert_that(stdout, contains_string('of all files are corrupted'))
+
+
+@then(u'the command output should contain "{text}"')
+def step_impl(context, text):
+    stdout = context.command_result.stdout.decode('utf-8')
+    assert_that(stdout, contains_string(text))
+
+
+@then(u'running "{command}" should fail verification')
+def step_impl(context, command):
+    with cd(context.working_dir):
+        p = Popen(command, shell=True, stderr=PIPE, stdout=PIPE)
+        p.communicate()
+    assert_that(p.returncode, equal_to(1))
+
+
+@when(u'I truncate the roots log')
+def step_impl(context):
+    filename = os.path.join(context.working_dir, '.metadata', 'roots.log')
+    with open(filename, 'r+b') as f:
+        # Drop the last record, as if a root had gone missing.
+        f.truncate(os.path.getsize(filename) - 41)
+
+
+@given(u'a file "{filename}" containing')
+def step_impl(context, filename):
+    with open(os.path.join(context.working_dir, filename), 'w') as f:
+        f.write(context.text)
+
+
+@then(u'the sizes of the generated files in "{dirname}" should be "{sizes}"')
+def step_impl(context, dirname, sizes):
+    actual_sizes = set(
+        os.stat(full_path).st_size for full_path in
+        get_all_generated_files(os.path.join(context.working_dir, dirname)))
+    assert_that(sorted(actual_sizes),
+                equal_to([int(size) for size in sizes.split(',')]))
+
+
+@when(u'I interrupt "{command}" after {seconds} seconds')
+def step_impl(context, command, seconds):
+    with cd(context.working_dir):
+        # exec, so the command itself is killed rather than the shell.
+        p = Popen('exec ' + command, shell=True, stderr=PIPE, stdout=PIPE)
+        time.sleep(float(seconds))
+        # Kill it the hard way, so nothing gets cleaned up.
+        os.kill(p.pid, signal.SIGKILL)
+        p.communicate()
+
+
+@then(u'the directory "{dirname}" should be empty')
+def step_impl(context, dirname):
+    assert_that(os.listdir(os.path.join(context.working_dir, dirname)),
+                equal_to([]))
+
+
+@then(u'each generated file should be named after a {digest_size} byte digest')
+def step_impl(context, digest_size):
+    for full_path in get_all_generated_files(context.working_dir):
+        relative_path = os.path.relpath(full_path, context.working_dir)
+        assert_that(len(''.join(relative_path.split(os.sep))),
+                    equal_to(int(digest_size) * 2), relative_path)
@@ -0,0 +1,23 @@
+Feature: I/O limits
+
+  As a user
+  I want to limit the I/O of generating and verifying files
+  So that I can run them on storage that's serving live traffic.
+
+  Scenario Outline: Generating and verifying files with I/O limits
+    Given a new working directory
+    When I run "caf gen --max-files 50 --workers 2 <arguments>"
+     and I run the verification process with "--jobs 2 <arguments>"
+    Then the total number of files created should be 50
+     and the verification should succeed
+
+    Examples:
+      | arguments                                 |
+      | --max-bandwidth 50MB/s                    |
+      | --max-iops 1000                           |
+      | --latency-target 10 --max-bandwidth 100MB |
+      | --nice 5                                  |
+
+  Scenario: An invalid I/O priority is rejected
+    Given a new working directory
+    Then running "caf verify --ionice whenever" should fail
@@ -16,3 +16,50 @@ Feature: Verification of file generation
     When I run remove a random file
      and I run the verification process
     Then the verification should fail
+
+  Scenario: Verification with a memory budget
+    Given a new working directory
+    When I run "caf gen --max-files 500"
+     and I run the verification process with "--max-memory 1kb"
+    Then the verification should succeed
+
+  Scenario: Verification with a memory budget fails
+    Given a new working directory
+      and a new caf directory
+    When I run remove a random file
+     and I run the verification process with "--max-memory 1kb"
+    Then the verification should fail
+
+  Scenario: Incremental verification uses the previous verification
+    Given a new working directory
+      and a new caf directory
+    When I run the verification process with "--incremental"
+     and I run the verification process with "--incremental"
+    Then the verification should succeed
+
+  Scenario: Incremental verification still detects missing files
+    Given a new working directory
+      and a new caf directory
+    When I run the verification process with "--incremental"
+     and I run remove a random file
+     and I run the verification process with "--incremental"
+    Then the verification should fail
+
+  Scenario: Verifying files with direct I/O
+    Given a new working directory
+    When I run "caf gen --max-files 50 --file-size 10kb-100kb"
+     and I run the verification process with "--direct-io --buffer-size 8kb --jobs 2"
+    Then the verification should succeed
+
+  Scenario: Verifying files while keeping them in the page cache
+    Given a new working directory
+    When I run "caf gen --max-files 50"
+     and I run the verification process with "--keep-page-cache --buffer-size 1000"
+    Then the verification should succeed
+
+  Scenario: Direct I/O verification detects missing files
+    Given a new working directory
+    When I run "caf gen --max-files 50"
+     and I run remove a random file
+     and I run the verification process with "--direct-io"
+    Then the verification should fail
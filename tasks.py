@@ -25,6 +25,12 @@ def publish(test=False):
     run("twine upload dist/*")
 
 
+@task
+def bench_content():
+    """Show the throughput of each random content source."""
+    run("python -m caf.content")
+
+
 @task
 def features():
     run("cd features && behave")
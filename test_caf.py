@@ -1,5 +1,29 @@
+import io
+import os
+import hashlib
+from binascii import hexlify, unhexlify
 from subprocess import check_output
 
+import pytest
+
+from caf.checkpoint import interrupted_runs, write_run
+from caf.churn import ChainDeleter, ChurnRunner, ThroughputReporter, \
+    intent_filename, write_intent, parse_mix
+from caf.digests import DigestSet, merge_join
+from caf.generator import FileGenerator
+from caf.hashes import SHA1
+from caf.layout import Layout, DEFAULT_LAYOUT
+from caf.manifest import read_manifest, MANIFEST_FILE
+from caf.report import TextReporter, VerificationAborted
+from caf.roots import RootsLog
+from caf.sampling import corruption_rate_upper_bound, random_leaf_prefixes
+from caf.sizes import FixedSize, build_alias_table
+from caf.stats import Stats, thread_cpu_clock
+from caf.throttle import Throttle
+from caf.verifier import FileVerifier
+from caf.walker import TreeWalker
+from caf.writer import LargeFileWriter, WRITE_ALIGNMENT
+
 
 def test_echo():
     """An example test."""
@@ -7,6 +31,267 @@ def test_echo():
     assert result == "hello world\n"
 
 
+def test_digest_set_is_sorted_and_unique(tmpdir):
+    digests = [os.urandom(20) for _ in range(100)]
+    for max_memory in (None, 1024):
+        with DigestSet(max_memory=max_memory,
+                       spill_dir=str(tmpdir)) as digest_set:
+            for digest in digests + digests[:10]:
+                digest_set.add(digest)
+            assert list(digest_set) == sorted(digests)
+
+
+def test_layout_round_trips_paths():
+    hex_hash = 'abcdef0123456789abcdef0123456789abcdef01'
+    layout = Layout.parse('depth=3,width=1')
+    path = layout.hash_to_file_path(hex_hash)
+    assert path == os.path.join('a', 'b', 'c', hex_hash[3:])
+    assert layout.file_path_to_hash(os.path.join('/tmp', path)) == hex_hash
+    assert str(layout) == 'depth=3,width=1'
+
+
+def test_corruption_rate_upper_bound():
+    # The "rule of three": no failures in n samples bounds the
+    # rate at roughly 3/n with 95% confidence.
+    assert abs(corruption_rate_upper_bound(0, 1000) - 0.003) < 0.0001
+    assert corruption_rate_upper_bound(0, 0) == 1.0
+    bound = corruption_rate_upper_bound(10, 1000)
+    assert 0.01 < bound < 0.02
+    assert corruption_rate_upper_bound(10, 1000, 0.99) > bound
+
+
+def test_random_leaf_prefixes_draws_each_prefix_once():
+    prefixes = list(random_leaf_prefixes(Layout.parse('depth=2,width=1')))
+    assert sorted(prefixes) == ['%02x' % i for i in range(256)]
+
+
+def test_roots_log_migrates_legacy_roots(tmpdir):
+    rootdir = str(tmpdir)
+    legacy_roots = [os.urandom(20) for _ in range(3)]
+    os.makedirs(os.path.join(rootdir, '.metadata', 'roots'))
+    for root in legacy_roots:
+        open(os.path.join(rootdir, '.metadata', 'roots',
+                          hexlify(root).decode('ascii')), 'w').close()
+    roots_hash = hashlib.sha1()
+    for name in os.listdir(os.path.join(rootdir, '.metadata', 'roots')):
+        roots_hash.update(name.encode('ascii'))
+    with open(os.path.join(rootdir, '.metadata', 'all'), 'w') as f:
+        f.write(roots_hash.hexdigest())
+    roots_log = RootsLog(rootdir)
+    assert roots_log.read() == (set(legacy_roots), None)
+    new_root = os.urandom(20)
+    roots_log.append([new_root], removed=[legacy_roots[0]])
+    assert roots_log.read() == (set(legacy_roots[1:] + [new_root]), None)
+
+
+def test_tree_walker_follows_the_layout(tmpdir):
+    rootdir = str(tmpdir)
+    for path in ['ab/cd/ef01', 'ab/cd/ef02', 'ab/stray', 'ab/cd/sub/file',
+                 '.metadata/layout']:
+        full_path = os.path.join(rootdir, *path.split('/'))
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        open(full_path, 'w').close()
+    walker = TreeWalker(rootdir, Layout(depth=2, width=2), threads=2)
+    found = sorted((os.path.relpath(entry.path, rootdir), digest)
+                   for digest, entry in walker.iter_files())
+    assert found == [
+        (os.path.join('ab', 'cd', 'ef01'), 'abcdef01'),
+        (os.path.join('ab', 'cd', 'ef02'), 'abcdef02'),
+        (os.path.join('ab', 'cd', 'sub'), None),
+        (os.path.join('ab', 'stray'), None),
+    ]
+
+
+def test_throttle_adapts_to_the_latency_target():
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    throttle = Throttle(latency_target=0.01, clock=lambda: now[0],
+                        sleep=sleep)
+    for _ in range(20):
+        # 1MB reads that take 50ms each, i.e. 20MB/s.
+        start = throttle.start()
+        now[0] += 0.05
+        throttle.stop(start, 1024 * 1024)
+    backed_off = throttle.bandwidth
+    assert backed_off < 20 * 1024 * 1024
+    for _ in range(1000):
+        start = throttle.start()
+        now[0] += 0.001
+        throttle.stop(start, 1024)
+    assert throttle.bandwidth > backed_off
+
+
+def test_disk_usage_budget_counts_the_stored_size(tmpdir):
+    # 1 byte files are stored as just their 20 byte header.
+    rootdir = str(tmpdir)
+    FileGenerator(rootdir, None, 100, FixedSize(1)).generate_files()
+    manifest = list(read_manifest(os.path.join(rootdir, MANIFEST_FILE)))
+    assert [size for _, _, size in manifest] == [20] * 5
+
+
+def test_churn_finishes_an_interrupted_delete(tmpdir):
+    rootdir = str(tmpdir)
+    # Two separate runs, so each chain is certain to get files.
+    deleted, kept = [
+        unhexlify(FileGenerator(rootdir, 10, None, FixedSize(100))
+                  .generate_files()[0].encode('ascii'))
+        for _ in range(2)]
+    # Interrupted part way through deleting a chain.
+    deleter = ChainDeleter(rootdir, DEFAULT_LAYOUT, SHA1)
+    digests = deleter.list_chain(deleted)
+    os.makedirs(os.path.join(rootdir, '.metadata', 'churn'))
+    write_intent(intent_filename(rootdir, deleted), digests)
+    deleter.remove_files(digests[:3])
+    runner = ChurnRunner(rootdir, parse_mix('verify=1'), FixedSize(100),
+                         target_usage=1024 * 1024, max_operations=1,
+                         throughput_reporter=ThroughputReporter(
+                             stream=io.StringIO()))
+    summary = runner.run()
+    assert summary['chains'] == 1
+    assert summary['corruptions'] == 0
+    assert RootsLog(rootdir).read() == (set([kept]), None)
+    assert deleter.list_chain(deleted) == []
+    assert not os.listdir(os.path.join(rootdir, '.metadata', 'churn'))
+    manifest = read_manifest(os.path.join(rootdir, MANIFEST_FILE))
+    assert not set(digests) & set(digest for digest, _, _ in manifest)
+
+
+def test_verify_reports_a_truncated_file_once(tmpdir):
+    rootdir = str(tmpdir)
+    FileGenerator(rootdir, 30, None, FixedSize(100)).generate_files()
+    # The first file in the chain has no parent, so truncating its
+    # header doesn't leave anything else unreferenced.
+    for _, entry in TreeWalker(rootdir, DEFAULT_LAYOUT).iter_files():
+        with open(entry.path, 'rb') as f:
+            if f.read(SHA1.digest_size) == SHA1.root_hash:
+                truncated = entry.path
+    with open(truncated, 'r+b') as f:
+        f.truncate(5)
+    stream = io.StringIO()
+    reporter = TextReporter(stream=stream)
+    assert not FileVerifier(rootdir, reporter=reporter).verify_files()
+    assert reporter.count == 1
+    assert truncated in stream.getvalue()
+
+
+def test_interrupted_runs_skips_live_runs(tmpdir):
+    rootdir = str(tmpdir)
+    run_lock = write_run(rootdir, 'run', 2)
+    assert interrupted_runs(rootdir) == []
+    os.close(run_lock)
+    assert interrupted_runs(rootdir) == ['run']
+
+
+def test_fail_fast_stops_part_way_through_a_unit(tmpdir):
+    # A flat layout puts every file in a single unit of work.
+    rootdir = str(tmpdir)
+    FileGenerator(rootdir, 20, None, FixedSize(100),
+                  layout=Layout.parse('depth=0,width=2')).generate_files()
+    for _, entry in TreeWalker(rootdir, Layout(depth=0)).iter_files():
+        with open(entry.path, 'r+b') as f:
+            f.seek(50)
+            f.write(b'corrupt')
+    stats = Stats()
+
+    class OpenedFilesReporter(TextReporter):
+        opened = []
+
+        def report(self, corruption):
+            self.opened.append(stats.phases['file'][0])
+            super(OpenedFilesReporter, self).report(corruption)
+
+    reporter = OpenedFilesReporter(stream=io.StringIO(), max_errors=2)
+    with pytest.raises(VerificationAborted):
+        FileVerifier(rootdir, stats=stats, reporter=reporter).verify_files()
+    # Each corruption is reported as soon as its file is checked, and
+    # none of the other files are opened.
+    assert reporter.opened == [1, 2]
+    assert stats.phases['file'][0] == 2
+
+
+class RecordingSource(object):
+    def __init__(self):
+        self.data = []
+
+    def read(self, size):
+        self.data.append(os.urandom(size))
+        return self.data[-1]
+
+
+def test_large_file_writer_aligns_writes(tmpdir):
+    filename = str(tmpdir.join('large'))
+    parent = hashlib.sha1(b'parent').digest()
+    source = RecordingSource()
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT)
+    try:
+        digest = LargeFileWriter(SHA1).write(fd, parent, 100000, 10000,
+                                             source)
+    finally:
+        os.close(fd)
+    with open(filename, 'rb') as f:
+        contents = f.read()
+    assert contents == parent + b''.join(source.data)
+    assert digest == hashlib.sha1(contents).digest()
+    # The header fills out the first buffer, and every other buffer is
+    # the aligned size.
+    assert len(parent) + len(source.data[0]) == 3 * WRITE_ALIGNMENT
+    assert [len(data) for data in source.data[1:-1]] == \
+        [3 * WRITE_ALIGNMENT] * (len(source.data) - 2)
+    # A file smaller than the header is just the header.
+    tiny_filename = str(tmpdir.join('tiny'))
+    fd = os.open(tiny_filename, os.O_WRONLY | os.O_CREAT)
+    try:
+        digest = LargeFileWriter(SHA1).write(fd, parent, 10, 10000,
+                                             RecordingSource())
+    finally:
+        os.close(fd)
+    with open(tiny_filename, 'rb') as f:
+        assert f.read() == parent
+    assert digest == hashlib.sha1(parent).digest()
+
+
+def test_large_file_writer_records_hash_cpu_time(tmpdir):
+    # The hashing thread records the CPU time it spends hashing
+    # itself, so it isn't lost by a clock of the generating thread.
+    stats = Stats(clock=thread_cpu_clock())
+    fd = os.open(str(tmpdir.join('large')), os.O_WRONLY | os.O_CREAT)
+    try:
+        LargeFileWriter(SHA1, stats).write(fd, b'\0' * 20, 32 * 1024 ** 2,
+                                           1024 ** 2, RecordingSource())
+    finally:
+        os.close(fd)
+    assert stats.phases['hash'][1] == 32 * 1024 ** 2
+    assert stats.phases['hash'][2] > 0
+
+
+def test_alias_table_preserves_probabilities():
+    probabilities = [0.5, 0.3, 0.15, 0.05]
+    keep, aliases = build_alias_table(probabilities)
+    # Row i is drawn with probability (keep[i] + the leftover of every
+    # row aliased to i) / number of rows.
+    drawn = [0.0] * len(probabilities)
+    for row, (p, alias) in enumerate(zip(keep, aliases)):
+        drawn[row] += p / len(probabilities)
+        drawn[alias] += (1 - p) / len(probabilities)
+    for expected, actual in zip(probabilities, drawn):
+        assert abs(expected - actual) < 1e-9
+
+
+def test_merge_join():
+    left = [b'a', b'b', b'd']
+    right = [b'b', b'c']
+    assert list(merge_join(left, right)) == [
+        (b'a', True, False),
+        (b'b', True, True),
+        (b'c', False, True),
+        (b'd', True, False),
+    ]
+
+
 def run_cmd(cmd):
     """Run a shell command `cmd` and return its output."""
     return check_output(cmd, shell=True).decode('utf-8')